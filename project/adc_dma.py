@@ -0,0 +1,149 @@
+from machine import ADC, mem32
+from data_processor import DataProcessor
+from fifo import Fifo
+from array import array
+import kernels
+from micropython import const
+import rp2
+
+# RP2040 ADC registers (datasheet 4.9.6)
+ADC_BASE = const(0x4004C000)
+ADC_CS = const(ADC_BASE + 0x00)
+ADC_FCS = const(ADC_BASE + 0x08)
+ADC_FIFO = const(ADC_BASE + 0x0C)
+ADC_DIV = const(ADC_BASE + 0x10)
+CS_EN = const(1 << 0)
+CS_START_MANY = const(1 << 3)
+FCS_EN = const(1 << 0)
+FCS_DREQ_EN = const(1 << 3)
+FCS_UNDER = const(1 << 10)
+FCS_OVER = const(1 << 11)
+FCS_THRESH_1 = const(1 << 24)  # DREQ as soon as there's one sample
+DREQ_ADC = const(36)
+ADC_CLOCK_HZ = const(48000000)
+MIN_RATE_HZ = ADC_CLOCK_HZ // 0x10000 + 1  # DIV's integer part is 16 bits, ~733 Hz
+BLOCK_RATE_HZ = 1000  # slowest rate that is still a whole number of ms per sample
+LPF_MS = 40  # DataProcessor's 10 sample running average at 4 ms
+
+
+class AdcDma:
+    # Free-running ADC copied into preallocated array("H") blocks by two
+    # chained DMA channels, one always writing while the other is re-armed.
+    # Python runs once per block instead of once per sample. Filled blocks
+    # are queued in ready; get() hands one out and takes the previous one
+    # back, so a block stays valid until the next get(). If processing falls
+    # behind and there's no free block, the newest one is refilled and
+    # counted in dropped().
+    def __init__(self, pin=27, rate_hz=1000, block_len=250, blocks=6):
+        if rate_hz < MIN_RATE_HZ:
+            raise ValueError("ADC can't sample slower than %d Hz" % MIN_RATE_HZ)
+        ADC(pin)  # sets the pin up as an analog input
+        self.rate_hz = rate_hz
+        self.blocks = [array("H", [0] * block_len) for _ in range(blocks)]
+        self.ready = Fifo(blocks + 1, typecode="i")  # filled block indices, oldest first
+        self.free = Fifo(blocks + 1, typecode="i")
+        for idx in range(2, blocks):
+            self.free.put(idx)
+        self.current = None  # block the consumer has
+        self.dc = 0
+        self.channels = [rp2.DMA(), rp2.DMA()]
+        self.filling = [0, 1]  # block each channel is writing
+        for idx, dma in enumerate(self.channels):
+            ctrl = dma.pack_ctrl(
+                size=1,  # 16 bit transfers
+                inc_read=False,
+                inc_write=True,
+                treq_sel=DREQ_ADC,
+                chain_to=self.channels[1 - idx].channel,
+                irq_quiet=False,
+            )
+            dma.config(read=ADC_FIFO, write=self.blocks[idx], count=block_len, ctrl=ctrl)
+            dma.irq(handler=self.block_done)
+        # ADC off, empty its FIFO, then start converting into it
+        mem32[ADC_CS] = CS_EN
+        mem32[ADC_FCS] = FCS_UNDER | FCS_OVER
+        while (mem32[ADC_FCS] >> 16) & 0xF:
+            mem32[ADC_FIFO]
+        mem32[ADC_DIV] = (ADC_CLOCK_HZ // rate_hz - 1) << 8
+        mem32[ADC_FCS] = FCS_EN | FCS_DREQ_EN | FCS_THRESH_1
+        self.channels[0].active(1)
+        mem32[ADC_CS] = CS_EN | CS_START_MANY | ((pin - 26) << 12)
+
+    def block_done(self, dma):  # DMA IRQ, the other channel is already writing
+        idx = 0 if dma is self.channels[0] else 1
+        block = self.filling[idx]
+        if self.free.has_data():
+            self.ready.put(block)
+            block = self.free.get()
+        else:
+            self.dc += 1  # nowhere to write, this block's samples are lost
+        self.filling[idx] = block
+        dma.write = self.blocks[block]
+        dma.count = len(self.blocks[block])
+
+    def has_data(self):
+        return self.ready.has_data()
+
+    def empty(self):
+        return self.ready.empty()
+
+    def get(self):
+        if self.current is not None:
+            self.free.put(self.current)
+        self.current = self.ready.get()
+        return self.blocks[self.current]
+
+    def dropped(self):  # blocks, not samples
+        return self.dc
+
+    def deinit(self):
+        mem32[ADC_CS] = CS_EN  # stop converting, ADC.read_u16 works again
+        mem32[ADC_FCS] = 0
+        for dma in self.channels:
+            dma.irq(handler=None)
+            dma.close()
+        self.channels = []
+
+
+class BlockProcessor(DataProcessor):
+    # DataProcessor fed from AdcDma blocks instead of a per-sample timer
+    # IRQ. Sampling at BLOCK_RATE_HZ gives RRIs at 1 ms resolution, the
+    # low-pass filter is widened to keep its 40 ms window. The 12 bit DMA
+    # samples are scaled to 16 bits on the way in, like ADC.read_u16.
+    def __init__(self, pin=27, stop_ms=None, **kwargs):
+        polling_rate = 1000 // BLOCK_RATE_HZ
+        kwargs.setdefault("lpf_len", LPF_MS // polling_rate)
+        super().__init__(1, polling_rate, timer=False, stop_ms=stop_ms, **kwargs)
+        self.adc = AdcDma(pin, BLOCK_RATE_HZ)
+        self.dropped_blocks = 0  # kept after stop()
+        self.block_count = len(self.adc.blocks)
+
+    def process_blocks(self):
+        while self.adc.has_data():
+            samples = self.adc.get()
+            start = 0
+            while start < len(samples):
+                count = min(len(samples) - start, self.samples_left(), len(self.block))
+                if not count:
+                    break
+                kernels.copy_block_adc(samples, start, count, self.block)
+                self.process_block(count)
+                start += count
+
+    def backlog(self):  # filled blocks waiting
+        ready = self.adc.ready
+        return (ready.head - ready.tail) % ready.size
+
+    def sampling_stats(self):
+        return {
+            "fifo_size": self.block_count,
+            "high_water": self.high_water,
+            "dropped_blocks": self.dropped_blocks if self.adc is None else self.adc.dropped(),
+            "max_stall_ms": self.max_stall_ms,
+        }
+
+    def stop(self):
+        if self.adc is not None:
+            self.dropped_blocks = self.adc.dropped()
+            self.adc.deinit()
+            self.adc = None
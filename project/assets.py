@@ -0,0 +1,72 @@
+import struct
+import framebuf
+
+# Images packed into one file by tools/build.py: the intro's logo frames
+# (img1, img2...) and the icons.py bitmaps. Boot opens one file and seeks
+# to each image instead of opening a file per frame. Running from source
+# there's no bundle and the loose files are used.
+#
+# The file is a header, an index entry per image and the image data.
+ASSETS_FILE = "assets.bin"
+ASSETS_MAGIC = b"HRMA"
+HEADER_FMT = "<4sH"  # magic, image count
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+ENTRY_FMT = "<12sHHBxII"  # name, width, height, format, offset of the data, its length
+ENTRY_SIZE = struct.calcsize(ENTRY_FMT)
+FORMATS = (framebuf.MONO_HLSB, framebuf.MONO_VLSB)  # PBMs are HLSB, icons.py is VLSB
+LOGO_FORMAT = 0
+ICON_FORMAT = 1
+
+
+class Assets:
+    def __init__(self, file=ASSETS_FILE):
+        self.file = open(file, "rb")  # kept open, images are read as they're needed
+        magic, count = struct.unpack(HEADER_FMT, self.file.read(HEADER_SIZE))
+        if magic != ASSETS_MAGIC:
+            raise ValueError("unknown asset bundle format")
+        self.index = {}  # name -> (width, height, format, offset, length)
+        for _ in range(count):
+            name, *entry = struct.unpack(ENTRY_FMT, self.file.read(ENTRY_SIZE))
+            self.index[name.rstrip(b"\0").decode()] = entry
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def image(self, name):  # -> (FrameBuffer, width, height)
+        width, height, fmt, offset, length = self.index[name]
+        data = bytearray(length)
+        self.file.seek(offset)
+        self.file.readinto(data)
+        return framebuf.FrameBuffer(data, width, height, FORMATS[fmt]), width, height
+
+
+bundle = None
+bundle_checked = False
+
+
+def get_bundle():  # the Assets, None when the device runs from source
+    global bundle, bundle_checked
+    if not bundle_checked:
+        bundle_checked = True
+        try:
+            bundle = Assets()
+        except OSError:
+            pass
+    return bundle
+
+
+icon_cache = {}  # name -> FrameBuffer, the menu redraws its icons often
+
+
+def icon(name, width, height):  # an icons.py bitmap, width and height are for the fallback
+    fbuf = icon_cache.get(name)
+    if fbuf is None:
+        assets = get_bundle()
+        if assets is not None and name in assets:
+            fbuf = assets.image(name)[0]
+        else:
+            import icons
+
+            fbuf = framebuf.FrameBuffer(getattr(icons, name), width, height, framebuf.MONO_VLSB)
+        icon_cache[name] = fbuf
+    return fbuf
@@ -1,95 +1,458 @@
-import urequests as requests
 import ujson
+import machine
 import network
-from time import sleep
+import struct
+import time
+import profiler
+import httpstream
 from hrv_analysis import basic_hrv_analysis
+from httpstream import post_steps, resolve_steps, udp_steps, run, basic_auth, JsonFields
 
+# Endpoints and client credentials, kubios.json on flash overrides any of
+# them (e.g. to point the device at a test server)
+CONFIG_FILE = "kubios.json"
+DEFAULT_CONFIG = {
+    "client_id": "3pjgjdmamlj759te85icf0lucv",
+    "client_secret": "111fqsli1eo7mejcrlffbklvftcnfl4keoadrdv1o45vt9pndlef",
+    "token_url": "https://kubioscloud.auth.eu-west-1.amazoncognito.com/oauth2/token",
+    "analysis_url": "https://analysis.kubioscloud.com/v2/analytics/analyze",
+}
+TOKEN_FILE = "kubios_token.json"  # access token and its expiry, survives a reboot
+TOKEN_MARGIN_S = 60  # token is renewed this long before it expires
+CONNECT_TIMEOUT_MS = 20000
+SYNC_POLL_MS = 20  # background sync runs this often, an upload moves on one step each time
+SYNC_IDLE_MS = 1000  # between uploads it looks at the outbox and the Wi-Fi this often
+RETRY_MIN_MS = 5000  # first wait after a failed upload, doubled on every failure after it
+RETRY_MAX_MS = 5 * 60 * 1000
+NTP_HOST = "pool.ntp.org"
+NTP_PORT = 123
+NTP_TIMEOUT_MS = 2000
+NTP_DELTA = {2000: 3155673600, 1970: 2208988800}  # NTP's 1900 to the port's time.time() epoch
 
-class Kubios:
-    def __init__(self, ssid, password):
+# Analysis request body, the RRIs are written between these as they're read
+DATASET_HEAD = b'{"type":"RRI","data":['
+DATASET_TAIL = b'],"analysis":{"type":"readiness"}}'
+WRITE_CHUNK = 256  # request bytes formatted per chunk of the body
+COMMA = 0x2C
+ZERO = 0x30
+TOKEN_FIELDS = ("access_token", "expires_in")
+RESULT_FIELDS = (  # the response has many more, only these are kept
+    "create_timestamp",
+    "mean_hr_bpm",
+    "mean_rr_ms",
+    "rmssd_ms",
+    "sdnn_ms",
+    "sns_index",
+    "pns_index",
+)
+
+# WlanLink states
+LINK_IDLE = 0
+LINK_CONNECTING = 1
+LINK_CONNECTED = 2
+LINK_FAILED = 3
+LINK_CANCELLED = 4
+LINK_ERRORS = {
+    network.STAT_WRONG_PASSWORD: "Wrong password",
+    network.STAT_NO_AP_FOUND: "No network",
+    network.STAT_CONNECT_FAIL: "Connect failed",
+}
+
+
+class KubiosRejected(Exception):  # Kubios answered, but won't analyse this data
+    pass
+
+
+def digits(value):  # RRIs are unsigned shorts
+    if value < 10:
+        return 1
+    if value < 100:
+        return 2
+    if value < 1000:
+        return 3
+    if value < 10000:
+        return 4
+    return 5
+
+
+def dataset_length(rris):  # Content-Length, without building the body
+    length = len(DATASET_HEAD) + len(DATASET_TAIL) + max(len(rris) - 1, 0)
+    for rri in rris:
+        length += digits(rri)
+    return length
+
+
+def dataset_chunks(rris):
+    # The JSON body, RRIs formatted straight into a small buffer. The buffer
+    # is reused, each chunk has to be sent before the next one is asked for.
+    buf = bytearray(WRITE_CHUNK)
+    pos = 0
+    yield DATASET_HEAD
+    for rri in rris:
+        if pos > len(buf) - 6:  # room for a comma and 5 digits
+            yield memoryview(buf)[:pos]
+            pos = 0
+        pos += digits(rri)
+        end = pos
+        while True:
+            pos -= 1
+            buf[pos] = ZERO + rri % 10
+            rri //= 10
+            if not rri:
+                break
+        pos = end
+        buf[pos] = COMMA
+        pos += 1
+    if pos:
+        pos -= 1  # no comma after the last one
+        yield memoryview(buf)[:pos]
+    yield DATASET_TAIL
+
+
+def load_config(file=CONFIG_FILE):
+    config = dict(DEFAULT_CONFIG)
+    try:
+        with open(file, "r") as config_file:
+            config.update(ujson.load(config_file))
+    except OSError:  # no overrides
+        pass
+    return config
+
+
+def clock_steps():  # -> True once the RTC is set
+    # Token expiry is kept as wall clock time, the RTC starts from 2021
+    # after every boot until NTP sets it. Same as ntptime.settime(), but in
+    # steps over httpstream's non-blocking UDP instead of waiting on a socket.
+    if not hasattr(machine, "RTC"):  # host, clock is already right
+        return True
+    try:
+        ip = yield from resolve_steps(NTP_HOST)
+        query = bytearray(48)
+        query[0] = 0x1B  # client request, NTP version 3
+        reply = yield from udp_steps((ip, NTP_PORT), query, NTP_TIMEOUT_MS)
+    except OSError:
+        return False
+    if len(reply) < 48:
+        return False
+    seconds = struct.unpack(">I", reply[40:44])[0] - NTP_DELTA[time.gmtime(0)[0]]
+    tm = time.gmtime(seconds)
+    machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+    return True
+
+
+class WlanLink:
+    # Wi-Fi association as a state machine, nothing here waits. start()
+    # reuses an association that's still up, otherwise begins a new one
+    # with a deadline, poll() moves it on and returns the state. A failed
+    # or cancelled attempt stays that way until start() is called again.
+    def __init__(self, ssid, password, timeout_ms=CONNECT_TIMEOUT_MS):
+        self.wifi = network.WLAN(network.STA_IF)
         self.ssid = ssid
         self.password = password
+        self.timeout_ms = timeout_ms
+        self.state = LINK_IDLE
+        self.started = 0  # ticks_ms of the attempt
+        self.error = None  # why the last attempt failed
+
+    def start(self):
+        if self.wifi.isconnected():
+            self.connected()
+            return self.state
+        self.wifi.active(True)
+        self.wifi.connect(self.ssid, self.password)
+        self.state = LINK_CONNECTING
+        self.started = time.ticks_ms()
+        self.error = None
+        return self.state
+
+    def poll(self):
+        if self.state == LINK_CONNECTED and not self.wifi.isconnected():
+            self.state = LINK_IDLE  # association lost, start() makes a new one
+        elif self.state == LINK_CONNECTING:
+            status = self.wifi.status()
+            if status == network.STAT_GOT_IP:
+                self.connected()
+            elif status in LINK_ERRORS:
+                self.fail(LINK_ERRORS[status])
+            elif self.elapsed_ms() >= self.timeout_ms:
+                self.fail("Timed out")
+        return self.state
+
+    def connected(self):  # host names are looked up at the DNS server DHCP gave
+        self.state = LINK_CONNECTED
+        dns = self.wifi.ifconfig()[3]
+        httpstream.dns_server = None if dns == "0.0.0.0" else (dns, httpstream.DNS_PORT)
+
+    def fail(self, error):
+        self.wifi.disconnect()  # stop the driver retrying on its own
+        self.state = LINK_FAILED
+        self.error = error
+
+    def cancel(self):
+        if self.state == LINK_CONNECTING:
+            self.wifi.disconnect()
+            self.state = LINK_CANCELLED
+            self.error = "Cancelled"
+
+    def elapsed_ms(self):
+        return time.ticks_diff(time.ticks_ms(), self.started)
+
+    def isconnected(self):
+        return self.poll() == LINK_CONNECTED
+
+
+class Kubios:
+    # Long-lived client: the WLAN association is kept between analyses and
+    # the access token is reused until it's about to expire, so an upload
+    # after the first one is a single request. The *_steps methods are
+    # generators over httpstream.post_steps(), see KubiosSync.
+    def __init__(self, ssid, password, apikey, config=None, token_file=TOKEN_FILE):
+        self.link = WlanLink(ssid, password)
+        self.apikey = apikey
+        self.config = config or load_config()
+        self.token_file = token_file
         self.connected = False
-        self.connect()
-
-    def connect(self):
-        wifi = network.WLAN(network.STA_IF)
-        wifi.active(True)
-        wifi.connect(self.ssid, self.password)
-        count = 0
-        wait = 20
-        while not wifi.isconnected():
-            print("Connecting...")
-            sleep(1)
-            count += 1
-
-        if wait > count:  # if connection isn't timed out, set "connected" to True
-            self.connected = True
-        else:
-            self.connected = False
-
-    def request(self, intervals, apikey):
-        APIKEY = apikey
-        CLIENT_ID = "3pjgjdmamlj759te85icf0lucv"
-        CLIENT_SECRET = "111fqsli1eo7mejcrlffbklvftcnfl4keoadrdv1o45vt9pndlef"
-        LOGIN_URL = "https://kubioscloud.auth.eu-west-1.amazoncognito.com/login"
-        TOKEN_URL = "https://kubioscloud.auth.eu-west-1.amazoncognito.com/oauth2/token"
-        REDIRECT_URI = "https://analysis.kubioscloud.com/v1/portal/login"
-        response = requests.post(
-            url=TOKEN_URL,
-            data="grant_type=client_credentials&client_id={}".format(CLIENT_ID),
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            auth=(CLIENT_ID, CLIENT_SECRET),
+        self.clock_set = False
+        self.access_token = None
+        self.expires_at = 0  # time.time() seconds
+        self.load_token()
+
+    def connect(self):  # blocking, for callers without an event loop
+        state = self.link.start()
+        while state == LINK_CONNECTING:
+            time.sleep_ms(100)
+            state = self.link.poll()
+        self.connected = state == LINK_CONNECTED
+        if not self.connected:
+            print("Wi-Fi:", self.link.error)
+
+    def load_token(self):
+        try:
+            with open(self.token_file, "r") as file:
+                token = ujson.load(file)
+            self.access_token = token["access_token"]
+            self.expires_at = token["expires_at"]
+        except (OSError, ValueError, KeyError):  # no token yet or a torn write
+            self.access_token = None
+            self.expires_at = 0
+
+    def save_token(self):
+        with open(self.token_file, "w") as file:
+            ujson.dump({"access_token": self.access_token, "expires_at": self.expires_at}, file)
+
+    def drop_token(self):
+        self.access_token = None
+        self.expires_at = 0
+        self.save_token()
+
+    def token_steps(self):  # cached token, a new one only when it's expiring
+        if not self.clock_set:
+            self.clock_set = yield from clock_steps()
+        if self.access_token is None or time.time() >= self.expires_at - TOKEN_MARGIN_S:
+            yield from self.fetch_token_steps()
+        return self.access_token
+
+    def fetch_token_steps(self):
+        body = "grant_type=client_credentials&client_id={}".format(self.config["client_id"])
+        body = body.encode()
+        token = JsonFields(TOKEN_FIELDS, 1)
+        status = yield from post_steps(
+            self.config["token_url"],
+            {
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Authorization": basic_auth(self.config["client_id"], self.config["client_secret"]),
+            },
+            len(body),
+            (body,),
+            token,
         )
-        response = response.json()  # Parse JSON response into a python dictionary
-        access_token = response["access_token"]  # Parse access token
-
-        # Creating dataset
-        dataset = {"type": "RRI", "data": intervals, "analysis": {"type": "readiness"}}
-
-        # Make the readiness analysis with the given data
-        response = requests.post(
-            url="https://analysis.kubioscloud.com/v2/analytics/analyze",
-            headers={
-                "Authorization": "Bearer {}".format(access_token),
-                "X-Api-Key": APIKEY,
+        if status != 200:
+            raise OSError("Kubios login failed: HTTP %d" % status)
+        self.access_token = token.values["access_token"]
+        self.expires_at = time.time() + token.values["expires_in"]
+        self.save_token()
+
+    def analyze_steps(self, rris):  # -> (HTTP status, the RESULT_FIELDS that were in the response)
+        token = yield from self.token_steps()
+        analysis = JsonFields(RESULT_FIELDS, 2)  # fields of "analysis"
+        status = yield from post_steps(
+            self.config["analysis_url"],
+            {
+                "Content-Type": "application/json",
+                "Authorization": "Bearer {}".format(token),
+                "X-Api-Key": self.apikey,
             },
-            json=dataset,
+            dataset_length(rris),
+            dataset_chunks(rris),
+            analysis,
         )
-        response = response.json()
+        return status, analysis.values
+
+    def request(self, intervals):  # blocking, for callers without an event loop
+        return run(self.request_steps(intervals))
+
+    def request_steps(self, intervals):  # anything with len() that iterates RRIs, read twice
+        # Make the readiness analysis with the given data, streamed from where it's stored
+        status, response = yield from self.analyze_steps(intervals)
+        if status == 401:  # token revoked or the clock was off, one retry with a new one
+            self.drop_token()
+            status, response = yield from self.analyze_steps(intervals)
+        if 400 <= status < 500:
+            raise KubiosRejected("HTTP %d" % status)
+        if status != 200:
+            raise OSError("Kubios analysis failed: HTTP %d" % status)
 
         results = {
-            "timestamp": response["analysis"]["create_timestamp"][
-                :16
-            ],  # OH NO IM SLICING
-            "mean_hr": round(response["analysis"]["mean_hr_bpm"], 1),
-            "mean_ppi": round(response["analysis"]["mean_rr_ms"]),
-            "rmssd": round(response["analysis"]["rmssd_ms"], 1),
-            "sdnn": round(response["analysis"]["sdnn_ms"], 1),
-            "sns": round(response["analysis"]["sns_index"], 2),
-            "pns": round(response["analysis"]["pns_index"], 2),
+            "timestamp": response["create_timestamp"][:16],  # OH NO IM SLICING
+            "mean_hr": round(response["mean_hr_bpm"], 1),
+            "mean_ppi": round(response["mean_rr_ms"]),
+            "rmssd": round(response["rmssd_ms"], 1),
+            "sdnn": round(response["sdnn_ms"], 1),
+            "sns": round(response["sns_index"], 2),
+            "pns": round(response["pns_index"], 2),
         }
 
         return results
 
 
+session = None  # the one Kubios client, created on first use
+
+
+def get_session():
+    global session
+    if session is None:
+        wlan_creds = open("./wlan_creds.txt")
+        ssid = wlan_creds.readline().strip()
+        pwd = wlan_creds.readline().strip()
+        wlan_creds.close()
+        with open("./api-key.txt", "r") as file:
+            apikey = file.readline().strip()
+        print("WLAN credentials read")
+        session = Kubios(ssid, pwd, apikey)
+    return session
+
+
 def connect_to_kubios(rri_list):
     print("Connecting to wlan")
-    wlan_creds = open("./wlan_creds.txt")
-    ssid = wlan_creds.readline().strip()
-    pwd = wlan_creds.readline().strip()
-    wlan_creds.close()
-    with open("./api-key.txt", "r") as file:
-        apikey = file.readline().strip()
-    print("WLAN credentials read")
-    kubios = Kubios(ssid, pwd)  # Initialize Kubios connection
+    kubios = get_session()
+    kubios.connect()  # reassociates only if the link was lost
     if kubios.connected:  # Check if the wifi is connected
-        results = kubios.request(
-            rri_list, apikey
-        )  # send request to the kubios. Returns dictionary with needed values
+        try:
+            results = kubios.request(
+                rri_list
+            )  # send request to the kubios. Returns dictionary with needed values
+        except (OSError, KeyError, ValueError, KubiosRejected) as error:
+            print("Kubios request failed:", error)
+            return False
         print("Kubios results:")
         print(results)
         return results
     else:
         print("not connected")
         return False
+
+
+class KubiosSync:
+    # Sends the outbox to Kubios in the background, poll() runs as a
+    # Scheduler task every SYNC_POLL_MS. An upload is a Kubios.request_steps()
+    # generator and every poll moves it on by one step (one socket call, see
+    # httpstream.post_steps), so the UI only ever waits for a step. Between
+    # uploads a poll moves the Wi-Fi link on or starts uploading the oldest
+    # recording. The recordings go out one after the other on one
+    # association and one token, each on its own connection. Failures back
+    # off exponentially, a recording Kubios rejects is dropped since sending
+    # it again won't help.
+    def __init__(self, outbox, on_result):
+        self.outbox = outbox
+        self.on_result = on_result  # called with the results of every upload
+        self.retry_ms = RETRY_MIN_MS
+        self.retry_at = None  # ticks_ms, None when not backing off
+        self.error = None  # why the last attempt failed, for the screen
+        self.link = None
+        self.upload = None  # request_steps() of the recording being sent
+        self.checked_at = None  # ticks_ms of the last look at the outbox
+        profiler.instrument(self, "step", "KubiosSync.step")
+
+    def poll(self):
+        if self.upload is not None:
+            self.step()
+            return
+        if not len(self.outbox):
+            return
+        now = time.ticks_ms()
+        if self.checked_at is not None and time.ticks_diff(now, self.checked_at) < SYNC_IDLE_MS:
+            return
+        self.checked_at = now
+        if self.retry_at is not None and time.ticks_diff(now, self.retry_at) < 0:
+            return
+        try:
+            kubios = get_session()
+        except OSError:  # credentials missing
+            self.failed(now, "No credentials")
+            return
+        self.link = kubios.link
+        state = self.link.poll()
+        if state in (LINK_FAILED, LINK_CANCELLED):
+            self.failed(now, self.link.error)
+            self.link.state = LINK_IDLE
+            return
+        if state == LINK_IDLE:
+            state = self.link.start()
+        if state != LINK_CONNECTED:
+            return
+        self.upload = kubios.request_steps(self.outbox.oldest())
+        self.step()
+
+    def check_now(self):  # poll without waiting SYNC_IDLE_MS since the last look at the outbox
+        self.checked_at = None
+        self.poll()
+
+    def step(self):  # one step of the upload, finishes it on the last one
+        try:
+            next(self.upload)
+            return
+        except StopIteration as done:
+            results = done.value
+        except KubiosRejected as error:
+            self.upload = None
+            print("Kubios rejected a recording:", error)
+            self.outbox.pop()
+            return
+        except (OSError, KeyError, ValueError, TypeError) as error:  # TypeError: a null field
+            self.upload = None
+            self.failed(time.ticks_ms(), str(error))
+            return
+        self.upload = None
+        try:
+            self.on_result(results)  # saved before the recording leaves the outbox
+        except (OSError, KeyError, ValueError, TypeError) as error:
+            self.failed(time.ticks_ms(), "Saving failed: %s" % error)
+            return
+        self.checked_at = None  # the next recording starts on the next poll
+        self.outbox.pop()
+        self.retry_ms = RETRY_MIN_MS
+        self.retry_at = None
+        self.error = None
+
+    def failed(self, now, error):
+        print("Kubios sync failed:", error)
+        self.error = error
+        self.retry_at = time.ticks_add(now, self.retry_ms)
+        self.retry_ms = min(self.retry_ms * 2, RETRY_MAX_MS)
+
+    def cancel(self):  # stop waiting for Wi-Fi, the queue is tried again later
+        if self.link is not None:
+            self.link.cancel()
+
+    def status(self):  # what the sync is doing, one short line for the screen
+        if not len(self.outbox):
+            return "All sent"
+        if self.upload is not None:
+            return "Sending"
+        if self.link is not None and self.link.state == LINK_CONNECTING:
+            return "Connecting %ds" % (self.link.elapsed_ms() // 1000)
+        if self.retry_at is not None:
+            wait_ms = time.ticks_diff(self.retry_at, time.ticks_ms())
+            if wait_ms > 0:
+                return "Retry in %ds" % ((wait_ms + 999) // 1000)
+        return "Waiting"
@@ -3,145 +3,285 @@ from fifo import Fifo
 from filefifo import Filefifo
 from machine import Pin, ADC
 from led import Led
+from hrv_analysis import HrvAnalysis
+from rri_store import RriStore
+from scheduler import Scheduler
+from pipeline import Pipeline, RunningAverage, ThresholdCrossing, Milliseconds
+from pipeline import RangeFilter, VarianceFilter, BLOCK, read_block
+from array import array
 import micropython
+import profiler
 import time
+import ujson
 
 micropython.alloc_emergency_exception_buf(200)
 
 leds = [Led(20), Led(21), Led(22)]
 
+SHORT_RECORDING_RRIS = 50  # default quick recording, stops after this many RRIs
+SHORT_TERM_S = 5 * 60  # standard short-term HRV window
+LONG_TERM_S = 24 * 60 * 60
+DUAL_CORE = False  # sample and filter on core 1, see dual_core.py
+BLOCK_CAPTURE = False  # ADC samples in blocks by DMA at 1 kHz, see adc_dma.py
+THRESHOLD_PERIOD_MS = 4000  # dynamic threshold is recalculated this often
+FIFO_SIZE = 100  # samples, 400 ms at 4 ms
+FIFO_AUTO_SIZE = False  # size the sample Fifo from the worst stall seen so far, see fifo_size()
+FIFO_MIN = 50
+FIFO_MAX = 2500  # 10 s, 10 kB
+STALL_MARGIN = 2  # auto-sized Fifo lasts this many worst stalls
+RECORDING_STATS_FILE = "recording.json"  # summary of the latest recording, next to rri.bin
+
 
 class DataProcessor:
-    def __init__(self, fifosize, polling_rate):
+    def __init__(
+        self, fifosize, polling_rate, lpf_len=10, variance_len=4, timer=True, stop_ms=None
+    ):
         self.polling_rate = polling_rate
+        self.stop_ms = stop_ms  # samples after this much signal are ignored
         self.sensor = ADC(27)  # HR sensor
-        self.rri_arr = []  # array('I') # Final data, filtered RRI's, unsigned longs
+        self.rri_arr = RriStore()  # Final data, filtered RRI's, spilled to flash in blocks
+        self.hrv = HrvAnalysis()  # HRV statistics, updated as RRIs arrive
         self.fifo = Fifo(fifosize, typecode="i")
-        self.tmr = Piotimer(
-            period=polling_rate, mode=Piotimer.PERIODIC, callback=self.read_sensor
-        )
-        self.last_val = 0
-        self.ms_count = 0
-        self.min = 0xFFFF  # these track the min and max values for dynamic threshold
-        self.max = 0x0000
-        self.threshold = (
-            0x8000  # arbitrary starting value in the middle of sensor's range
+        self.tmr = None  # without the timer the owner calls read_sensor itself
+        if timer:
+            self.tmr = Piotimer(
+                period=polling_rate, mode=Piotimer.PERIODIC, callback=self.read_sensor
+            )
+        # lpf -> dynamic threshold (70 % towards max, every 4 s) -> us between
+        # crossings -> RRIs in ms, then the RRI filters
+        lpf = RunningAverage(lpf_len)
+        self.crossing = ThresholdCrossing(
+            polling_rate * 1000, THRESHOLD_PERIOD_MS // polling_rate, weight=7
         )
-        self.last_peak_ms = 0
-        # low-pass filter
-        self.lpf_lastvals = []  # array('I') # for running average, unsigned integers
-        # variance filter
-        self.variance_avg = []  # array('H') # for running average, unsigned shorts
+        self.beats = Pipeline(lpf, self.crossing, Milliseconds())
+        self.block = array("i", [0] * BLOCK)  # samples on their way through beats
+        range_filter = RangeFilter(400, 1200)  # 50-150 BPM
+        variance_filter = VarianceFilter(variance_len, 80)  # 80 ms or more from the recent average
+        self.rri_filters = Pipeline(range_filter, variance_filter)
+        profiler.instrument(self, "get_valid_rris", "get_valid_rris")
+        profiler.instrument(lpf, "push_block", "lpf")
+        profiler.instrument(self.crossing, "push_block", "detect_slope")
+        profiler.instrument(range_filter, "push", "range_filter")
+        profiler.instrument(variance_filter, "push", "variance_filter")
         # Filefifo for testing
         # self.file = Filefifo(100, name='capture03_250Hz.txt')
         self.draw_mode_rris = []
+        # back-pressure telemetry, kept by the consumer so the IRQ doesn't pay for it
+        self.high_water = 0  # deepest backlog the consumer found
+        self.max_stall_ms = 0  # longest time the consumer didn't look at the source
+        self.drained_at = None  # ticks_ms when the source was last emptied
 
     def read_sensor(self, _):
         self.fifo.put(self.sensor.read_u16())
 
-    def detect_slope(self, value, topweight=0.7):
-        rri = False
-        self.ms_count += self.polling_rate  # tracking time
-        # Dynamic threshold
-        self.min = min(value, self.min)  # tracking highest and lowest
-        self.max = max(value, self.max)
-        if (
-            self.ms_count != 0 and self.ms_count % 4000 == 0
-        ):  # Calculates new threshold every 4 seconds
-            self.threshold = (
-                self.min * (1 - topweight) + self.max * topweight
-            )  # weighted arithmetic mean with 70% top, 30% bottom
-            self.min = 0xFFFF  # reset min and max for dynamic threshold
-            self.max = 0x0000
-
-        if (  # slope detection
-            self.last_val < self.threshold <= value
-        ):  # do this stuff if new peak is detected
-            rri = self.ms_count - self.last_peak_ms  # Distance (ms) between two peaks
-            self.last_peak_ms = self.ms_count  # detected peak to memory
-        return rri
-
-    def get_valid_rris(self, draw_mode=False):
-        while self.fifo.has_data():
-            value = self.fifo.get()
-            value = self.lpf(value)
-            if not value:
-                self.last_val = value
-                break
-            rri = self.detect_slope(value)
-            if not rri:
-                self.last_val = value
-                break
+    @property
+    def ms_count(self):  # signal time processed so far
+        return self.crossing.samples * self.polling_rate
+
+    def samples_left(self):  # before stop_ms, a block's worth when there's no stop
+        if self.stop_ms is None:
+            return BLOCK
+        left = self.stop_ms - self.ms_count
+        return max((left + self.polling_rate - 1) // self.polling_rate, 0)
+
+    def get_valid_rris(self, draw_mode=False):  # one block of samples from the Fifo per call
+        count = read_block(self.fifo, self.block, self.samples_left())
+        if count:
+            self.process_block(count, draw_mode)
+
+    def process_block(self, count, draw_mode=False):
+        # count samples in self.block through beat detection, RRIs that pass
+        # the filters are stored. A block is shorter than the shortest RRI
+        # that passes, so it gives one at most and stopping after a number
+        # of RRIs still comes out exact.
+        block = self.block
+        for idx in range(self.beats.push_block(block, count)):
+            rri = block[idx]
             if draw_mode:
-                self.last_val = value
                 self.draw_mode_rris.append(rri)
-                break
-            range_filtered_rri = self.range_filter(rri)
-            if not range_filtered_rri:
-                self.last_val = value
-                break
-            variance_filtered_rri = self.variance_filter(range_filtered_rri)
-            if not variance_filtered_rri:
-                self.last_val = value
-                break
-            self.rri_arr.append(variance_filtered_rri)
-            self.last_val = value
-
-    def lpf(self, value, amount=10):  # low pass filter
-        if len(self.lpf_lastvals) < amount:
-            self.lpf_lastvals.append(value)
-            return False
-        else:
-            self.lpf_lastvals.pop(0)
-            self.lpf_lastvals.append(value)
-            return int(sum(self.lpf_lastvals) / len(self.lpf_lastvals))
-
-    def range_filter(
-        self, value, min_rri=400, max_rri=1200
-    ):  # Filter out RRIs that are not between 50-150 BPM
-        if min_rri <= value <= max_rri:
-            return value
-        else:
-            return False
-
-    def variance_filter(
-        self, value, difference_ms=80, length=4
-    ):  # Filter out RRIs that vary 60ms or more from previous average
-        if len(self.variance_avg) < length:
-            self.variance_avg.append(value)
-            return False
-        else:
-            self.variance_avg.pop(0)
-            self.variance_avg.append(value)
-            avg = sum(self.variance_avg) / len(self.variance_avg)
-            if abs(value - avg) < difference_ms:
-                return value
-            else:
-                return False
+                continue
+            rri = self.rri_filters.push(rri)
+            if rri is not None:
+                self.store_rri(rri)
+
+    def store_rri(self, rri):
+        self.rri_arr.append(rri)
+        self.hrv.add(rri)
+
+    def stop(self):  # stop sampling
+        if self.tmr is not None:
+            self.tmr.deinit()
+            self.tmr = None
+
+    def backlog(self):  # items waiting in the source
+        return (self.fifo.head - self.fifo.tail) % self.fifo.size
+
+    def drain_begin(self):  # consumer woke up, how much piled up and for how long
+        backlog = self.backlog()
+        self.high_water = max(self.high_water, backlog)
+        # one item is just the source's own pace, more means the consumer was
+        # held up since it last emptied the source (measured by time, so it
+        # still counts when the Fifo overflowed)
+        if backlog > 1 and self.drained_at is not None:
+            stall = time.ticks_diff(time.ticks_ms(), self.drained_at)
+            self.max_stall_ms = max(self.max_stall_ms, stall)
+
+    def drain_end(self):
+        self.drained_at = time.ticks_ms()
+
+    def sampling_stats(self):
+        return {
+            "fifo_size": self.fifo.size,
+            "high_water": self.high_water,
+            "dropped_samples": self.fifo.dropped(),
+            "max_stall_ms": self.max_stall_ms,
+        }
+
+
+def load_recording_stats():
+    try:
+        with open(RECORDING_STATS_FILE, "r") as file:
+            return ujson.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_recording_stats(heart_rate, complete):
+    # Sampling telemetry with the recording it belongs to, the worst stall
+    # is carried over from earlier recordings for fifo_size()
+    stats = heart_rate.sampling_stats()
+    worst = max(load_recording_stats().get("worst_stall_ms", 0), stats["max_stall_ms"])
+    summary = {
+        "complete": complete,
+        "rris": len(heart_rate.rri_arr),
+        "signal_ms": heart_rate.ms_count,
+        "sampling": stats,
+        "worst_stall_ms": worst,
+    }
+    if complete and heart_rate.hrv.count > 1:
+        hrv = heart_rate.hrv
+        hrv.analyze()
+        summary["mean_hr"] = round(hrv.mean_hr, 1)
+        summary["sdnn"] = round(hrv.sdnn, 1)
+        summary["rmssd"] = round(hrv.rmssd, 1)
+    with open(RECORDING_STATS_FILE, "w") as file:
+        ujson.dump(summary, file)
+    print("Sampling:", stats)
+    if stats.get("dropped_samples") or stats.get("dropped_blocks") or stats.get("dropped_rris"):
+        print("WARNING: data was lost while recording, RRIs may be wrong")
 
 
-def record_heart_rate(encoder, oled):
-    heart_rate = DataProcessor(100, 4)
+def fifo_size(polling_rate, auto=FIFO_AUTO_SIZE):
+    # Sample Fifo depth. Auto-sized, it holds STALL_MARGIN times the longest
+    # the UI has kept the consumer away in earlier recordings.
+    if not auto:
+        return FIFO_SIZE
+    worst = load_recording_stats().get("worst_stall_ms")
+    if not worst:
+        return FIFO_SIZE
+    return min(max(worst * STALL_MARGIN // polling_rate + 1, FIFO_MIN), FIFO_MAX)
+
+
+def block_processor(stop_ms):  # None when there's no DMA, per-sample Fifo is used then
+    try:
+        from adc_dma import BlockProcessor
+
+        return BlockProcessor(stop_ms=stop_ms)
+    except (ImportError, AttributeError):  # no rp2 module or no rp2.DMA in this firmware
+        return None
+
+
+def record_heart_rate(
+    encoder,
+    oled,
+    duration_s=None,
+    dual_core=DUAL_CORE,
+    block_capture=BLOCK_CAPTURE,
+    auto_size=FIFO_AUTO_SIZE,
+):
+    # Without duration_s recording stops at SHORT_RECORDING_RRIS RRIs,
+    # otherwise after duration_s seconds of signal
+    stop_ms = duration_s and duration_s * 1000
+    heart_rate = None
+    if dual_core:
+        from dual_core import DualCoreProcessor
+
+        heart_rate = DualCoreProcessor(100, 4, stop_ms=stop_ms)
+        source, process = heart_rate.ring, heart_rate.collect
+    elif block_capture:
+        heart_rate = block_processor(stop_ms)
+        if heart_rate is not None:
+            source, process = heart_rate.adc, heart_rate.process_blocks
+    if heart_rate is None:
+        heart_rate = DataProcessor(fifo_size(4, auto_size), 4, stop_ms=stop_ms)
+        source, process = heart_rate.fifo, heart_rate.get_valid_rris
+    loop = Scheduler()
+    interrupted = False
     rri_arr_len = 0
     print("Recording")
-    while len(heart_rate.rri_arr) < 50:
+
+    def on_samples():
+        nonlocal rri_arr_len
+        heart_rate.drain_begin()
+        while source.has_data():
+            process()
+            if recording_done(heart_rate, duration_s):
+                loop.stop()
+                break
+        heart_rate.drain_end()
+        if len(heart_rate.rri_arr) > rri_arr_len:
+            # LED chase, toggled from the loop so samples keep flowing meanwhile
+            for i, led in enumerate(leds):
+                loop.after(i * 100, led.toggle)
+            percentage = recording_progress(heart_rate, duration_s)
+            hrv = heart_rate.hrv
+            if hrv.count > 1:  # live SDNN and RMSSD once there's something to show
+                hrv.analyze()
+                oled.show_progress(percentage, hrv.sdnn, hrv.rmssd)
+            else:
+                oled.show_progress(percentage)
+            rri_arr_len = len(heart_rate.rri_arr)
+
+    def on_turn():
         while encoder.fifo.has_data():
             encoder.fifo.get()
+
+    def on_press():
+        nonlocal interrupted
         while encoder.knob_fifo.has_data():
             encoder.knob_fifo.get()
-            heart_rate.tmr.deinit()
-            return False
-        heart_rate.get_valid_rris()
-        if len(heart_rate.rri_arr) > rri_arr_len:
-            for led in leds:
-                led.toggle()
-                time.sleep(0.1)
-            oled.show_progress(len(heart_rate.rri_arr) * 2)
-            rri_arr_len = len(heart_rate.rri_arr)
+        interrupted = True
+        loop.stop()
+
+    def check_done():  # time can run out on core 1 or mid-block without a new RRI
+        if recording_done(heart_rate, duration_s):
+            loop.stop()
+
+    loop.on(source, on_samples)
+    if duration_s is not None:
+        loop.every(100, check_done)
+    loop.on(encoder.fifo, on_turn)
+    loop.on(encoder.knob_fifo, on_press)
+    loop.run()
+    heart_rate.stop()
+    save_recording_stats(heart_rate, not interrupted)
+    if interrupted:
+        return False
+    heart_rate.rri_arr.finish()
     print("Data collected")
-    # Kill piotimer
-    heart_rate.tmr.deinit()
-    return heart_rate.rri_arr
+    return heart_rate.rri_arr, heart_rate.hrv
+
+
+def recording_done(heart_rate, duration_s):
+    if duration_s is None:
+        return len(heart_rate.rri_arr) >= SHORT_RECORDING_RRIS
+    return heart_rate.ms_count >= duration_s * 1000
+
+
+def recording_progress(heart_rate, duration_s):  # percent
+    if duration_s is None:
+        return len(heart_rate.rri_arr) * 100 // SHORT_RECORDING_RRIS
+    return min(heart_rate.ms_count // (duration_s * 10), 100)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+from machine import I2C, Pin
+from ssd1306 import SSD1306_I2C
+from micropython import const
+import profiler
+
+SET_COL_ADDR = const(0x21)
+SET_PAGE_ADDR = const(0x22)
+ALL_PAGES = const(0xFF)
+
+
+class Display(SSD1306_I2C):
+    # SSD1306 that only sends what changed. Drawing calls mark the pages
+    # (8 pixel rows) they touch, show() compares those pages with a copy of
+    # what the panel has and sends just the changed columns of changed pages.
+    # Frame pacing is up to the callers' Scheduler tasks (see FRAME_MS in
+    # measureHR.py), every show() sends.
+    def __init__(self, width, height, i2c):
+        super().__init__(width, height, i2c)
+        self.shadow = bytearray(len(self.buffer))  # what the panel is showing
+        self.dirty = ALL_PAGES  # bit per page, panel content is unknown at start
+        self.synced = False
+
+    def mark(self, y0, y1):  # rows y0..y1 have been drawn on
+        y0 = max(y0, 0)
+        y1 = min(y1, self.height - 1)
+        if y0 <= y1:
+            self.dirty |= ((1 << ((y1 >> 3) + 1)) - 1) & ~((1 << (y0 >> 3)) - 1)
+
+    def fill(self, c):
+        self.dirty = ALL_PAGES
+        super().fill(c)
+
+    def pixel(self, x, y, c=None):
+        if c is None:
+            return super().pixel(x, y)
+        self.mark(y, y)
+        super().pixel(x, y, c)
+
+    def hline(self, x, y, w, c):
+        self.mark(y, y)
+        super().hline(x, y, w, c)
+
+    def vline(self, x, y, h, c):
+        self.mark(y, y + h - 1)
+        super().vline(x, y, h, c)
+
+    def line(self, x1, y1, x2, y2, c):
+        self.mark(min(y1, y2), max(y1, y2))
+        super().line(x1, y1, x2, y2, c)
+
+    def rect(self, x, y, w, h, c, *args):
+        self.mark(y, y + h - 1)
+        super().rect(x, y, w, h, c, *args)
+
+    def fill_rect(self, x, y, w, h, c):
+        self.mark(y, y + h - 1)
+        super().fill_rect(x, y, w, h, c)
+
+    def ellipse(self, x, y, xr, yr, c, *args):
+        self.mark(y - yr, y + yr)
+        super().ellipse(x, y, xr, yr, c, *args)
+
+    def text(self, s, x, y, c=1):
+        self.mark(y, y + 7)
+        super().text(s, x, y, c)
+
+    def blit(self, *args):  # FrameBuffer doesn't tell its height, assume everything
+        self.dirty = ALL_PAGES
+        super().blit(*args)
+
+    def scroll(self, xstep, ystep):
+        self.dirty = ALL_PAGES
+        super().scroll(xstep, ystep)
+
+    def show(self):
+        if not self.synced:  # first frame goes out whole
+            super().show()
+            self.shadow[:] = self.buffer
+            self.synced = True
+            self.dirty = 0
+            return
+        buffer = memoryview(self.buffer)
+        width = self.width
+        for page in range(self.pages):
+            if not self.dirty & (1 << page):
+                continue
+            start = page * width
+            end = start + width
+            if self.buffer[start:end] == self.shadow[start:end]:
+                continue
+            x0 = 0  # narrow down to the columns that changed
+            while self.buffer[start + x0] == self.shadow[start + x0]:
+                x0 += 1
+            x1 = width - 1
+            while self.buffer[start + x1] == self.shadow[start + x1]:
+                x1 -= 1
+            self.write_cmd(SET_COL_ADDR)
+            self.write_cmd(x0)
+            self.write_cmd(x1)
+            self.write_cmd(SET_PAGE_ADDR)
+            self.write_cmd(page)
+            self.write_cmd(page)
+            self.write_data(buffer[start + x0 : start + x1 + 1])
+            self.shadow[start + x0 : start + x1 + 1] = buffer[start + x0 : start + x1 + 1]
+        self.dirty = 0
+
+
+_display = None
+
+
+def get_display():  # the one display object everything draws on
+    global _display
+    if _display is None:
+        i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
+        _display = Display(128, 64, i2c)
+        profiler.instrument(_display, "show", "oled.show")  # all screen output goes through here
+    return _display
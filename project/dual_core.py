@@ -0,0 +1,113 @@
+from data_processor import DataProcessor
+from array import array
+import _thread
+import time
+
+STOP_TIMEOUT_MS = 100  # core 1 finishes a sample and its block well within this
+
+
+class SpscRing:
+    # Lock-free ring for one producer and one consumer on different cores.
+    # Only put() writes head and only get() writes tail, and each is a single
+    # word store made after the slot itself, so neither side ever sees a
+    # half-written entry. Same interface as Fifo, one slot is kept empty.
+    def __init__(self, size, typecode="H"):
+        self.data = array(typecode, [0] * size)
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        self.dc = 0  # dropped, ring was full
+
+    def put(self, value):
+        head = self.head
+        next_head = head + 1
+        if next_head == self.size:
+            next_head = 0
+        if next_head == self.tail:
+            self.dc += 1
+            return
+        self.data[head] = value
+        self.head = next_head  # publish after the value is in place
+
+    def get(self):
+        tail = self.tail
+        value = self.data[tail]
+        tail += 1
+        if tail == self.size:
+            tail = 0
+        self.tail = tail
+        return value
+
+    def has_data(self):
+        return self.head != self.tail
+
+    def empty(self):
+        return self.head == self.tail
+
+    def dropped(self):
+        return self.dc
+
+
+class DualCoreProcessor(DataProcessor):
+    # Sampling and the filter chain run on core 1, paced by its own clock
+    # instead of a timer IRQ, so a UI core stuck drawing or uploading can't
+    # delay samples. Accepted RRIs go to core 0 through an SpscRing, collect()
+    # moves them into rri_arr and hrv on core 0, which also owns the flash.
+    def __init__(self, fifosize, polling_rate, ring_size=64, stop_ms=None, **kwargs):
+        # core 1 stops by itself after stop_ms of signal
+        super().__init__(fifosize, polling_rate, timer=False, stop_ms=stop_ms, **kwargs)
+        self.ring = SpscRing(ring_size)
+        self.late = 0  # samples taken after their slot, core 1 couldn't keep up
+        self.running = True
+        self.stopped = False
+        _thread.start_new_thread(self.sample_loop, ())
+
+    def sample_loop(self):  # core 1
+        period_us = self.polling_rate * 1000
+        next_sample = time.ticks_us()
+        try:
+            while self.running and (self.stop_ms is None or self.ms_count < self.stop_ms):
+                self.read_sensor(None)
+                while self.fifo.has_data():  # get_valid_rris takes a block per call
+                    self.get_valid_rris()
+                next_sample = time.ticks_add(next_sample, period_us)
+                wait = time.ticks_diff(next_sample, time.ticks_us())
+                if wait > 0:
+                    time.sleep_us(wait)
+                else:
+                    self.late += 1
+        finally:  # also when it raised (e.g. MemoryError), stop() waits for this
+            self.stopped = True
+
+    def store_rri(self, rri):  # core 1, the RRI store isn't safe to touch from here
+        self.ring.put(rri)
+
+    def collect(self):  # core 0
+        while self.ring.has_data():
+            rri = self.ring.get()
+            self.rri_arr.append(rri)
+            self.hrv.add(rri)
+
+    def backlog(self):  # core 0 consumes the ring, core 1 keeps its own Fifo empty
+        return (self.ring.head - self.ring.tail) % self.ring.size
+
+    def sampling_stats(self):
+        return {
+            "fifo_size": self.ring.size,
+            "high_water": self.high_water,
+            "dropped_rris": self.ring.dropped(),
+            "late_samples": self.late,
+            "max_stall_ms": self.max_stall_ms,
+        }
+
+    def stop(self, timeout_ms=STOP_TIMEOUT_MS):
+        # -> True once core 1 is done, it can be started again after. False
+        # if it didn't finish in time, core 1 is still in use then.
+        self.running = False
+        started = time.ticks_ms()
+        while not self.stopped:
+            if time.ticks_diff(time.ticks_ms(), started) >= timeout_ms:
+                print("WARNING: core 1 didn't stop")
+                return False
+            time.sleep_ms(1)
+        return True
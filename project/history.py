@@ -1,14 +1,16 @@
-from ssd1306 import SSD1306_I2C
-from machine import I2C, Pin
+from display import get_display
+from machine import Pin
 import json
+import os
+import struct
 from fifo import Fifo
 import time
+from scheduler import Scheduler
 
-i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-oled_width = 128
-oled_height = 64
+oled = get_display()
+oled_width = oled.width
+oled_height = oled.height
 char_height = 8
-oled = SSD1306_I2C(oled_width, oled_height, i2c)
 
 # data = "2024-04-28T18:58:19.061917+00:00"
 # timestamp = data.split(".")[0].replace("T", " ")
@@ -49,17 +51,106 @@ results = {
 }
 
 
+# Binary history: a header and fixed size records, so record n is at
+# HEADER_SIZE + n * RECORD_SIZE and can be read without touching the rest.
+# Values are stored as fixed point integers with the precision Kubios
+# results are rounded to.
+HISTORY_FILE = "history.bin"
+OLD_HISTORY_FILE = "history.txt"  # JSON lines, migrated once
+HISTORY_MAGIC = b"HRVH"
+HISTORY_VERSION = 1
+HEADER_FMT = "<4sHHI"  # magic, version, record size, record count
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+RECORD_FMT = "<16sHHHHhh"  # timestamp, then FIELDS
+RECORD_SIZE = struct.calcsize(RECORD_FMT)
+CACHE_SIZE = 10  # decoded records kept, a screenful plus a little
+FIELDS = (  # name, scale
+    ("mean_hr", 10),
+    ("mean_ppi", 1),
+    ("rmssd", 10),
+    ("sdnn", 10),
+    ("sns", 100),
+    ("pns", 100),
+)
+
+
+def file_exists(name):
+    try:
+        os.stat(name)
+        return True
+    except OSError:
+        return False
+
+
+class HistoryStore:
+    def __init__(self, file=HISTORY_FILE):
+        self.file = file
+        if not file_exists(self.file):
+            if file_exists(OLD_HISTORY_FILE):
+                self.migrate(OLD_HISTORY_FILE)
+            else:
+                self.write_header(0)
+        with open(self.file, "rb") as history:
+            magic, version, size, self.count = struct.unpack(
+                HEADER_FMT, history.read(HEADER_SIZE)
+            )
+        if magic != HISTORY_MAGIC or size != RECORD_SIZE:
+            raise ValueError("unknown history file format")
+
+    def write_header(self, count):
+        mode = "r+b" if file_exists(self.file) else "wb"
+        with open(self.file, mode) as history:
+            history.write(
+                struct.pack(HEADER_FMT, HISTORY_MAGIC, HISTORY_VERSION, RECORD_SIZE, count)
+            )
+        self.count = count
+
+    def migrate(self, old_file):  # one JSON record per line, oldest first
+        # Built in a temporary file and renamed into place when it's complete,
+        # so a migration cut short leaves no history.bin and runs again
+        print("Migrating", old_file)
+        history_file = self.file
+        self.file = history_file + ".tmp"
+        if file_exists(self.file):  # left by an earlier attempt
+            os.remove(self.file)
+        self.write_header(0)
+        with open(old_file, "r") as old:
+            for line in old:
+                if line.strip():
+                    self.append(json.loads(line))
+        os.rename(self.file, history_file)
+        self.file = history_file
+        os.rename(old_file, old_file + ".migrated")
+
+    def append(self, results):
+        values = [round(results[name] * scale) for name, scale in FIELDS]
+        record = struct.pack(RECORD_FMT, results["timestamp"][:16].encode(), *values)
+        with open(self.file, "r+b") as history:
+            history.seek(HEADER_SIZE + self.count * RECORD_SIZE)
+            history.write(record)
+        self.write_header(self.count + 1)  # header last, a torn write loses only the new record
+
+    def read(self, idx):  # idx 0 is the oldest record
+        with open(self.file, "rb") as history:
+            history.seek(HEADER_SIZE + idx * RECORD_SIZE)
+            fields = struct.unpack(RECORD_FMT, history.read(RECORD_SIZE))
+        record = {"timestamp": fields[0].decode().rstrip("\x00")}
+        for (name, scale), value in zip(FIELDS, fields[1:]):
+            record[name] = value if scale == 1 else value / scale
+        return record
+
+
 class History:
     def __init__(self, oled):
-        self.file = "history.txt"
+        self.store = HistoryStore()
         self.results = results
-        self.list = []
         self.menu_lowest = 1
         self.menu_highest = 8
         self.oled = oled
         self.selection_pos = 0
-        self.selection = SSD1306_I2C(oled_width, oled_height, i2c)
-        self.selection.rect(0, 0, oled_width, 10, 1)
+        self.cache = {}  # record index -> decoded record, least recently used first in cache_order
+        self.cache_order = []
+        self.drawn = None  # what's on screen, draw_menu does nothing if it hasn't changed
 
     def selection_up(self):
         if self.selection_pos > 0:
@@ -69,44 +160,52 @@ class History:
             self.menu_lowest -= 1
 
     def selection_down(self):
-        if self.selection_pos < 54 and self.selection_pos / 9 + 1 < len(self.list):
+        if self.selection_pos < 54 and self.selection_pos / 9 + 1 < self.store.count:
             self.selection_pos += char_height + 1
-        elif self.menu_highest <= len(self.list):
+        elif self.menu_highest <= self.store.count:
             self.menu_highest += 1
             self.menu_lowest += 1
 
     def load_history(self):
-        with open(self.file, "r") as history:
-            lines = history.readlines()
-            if len(lines) == 0:
-                print("no recorded history")
-                return False
-            else:
-                with open(self.file, "r") as history:
-                    for line in history:
-                        record = json.loads(line.strip())
-                        self.list.append(record)
-                    return True
+        if self.store.count == 0:
+            print("no recorded history")
+            return False
+        return True
+
+    def record(self, idx):  # records are read from flash only when they're not cached
+        if idx in self.cache:
+            self.cache_order.remove(idx)
+        else:
+            if len(self.cache_order) >= CACHE_SIZE:
+                del self.cache[self.cache_order.pop(0)]
+            self.cache[idx] = self.store.read(idx)
+        self.cache_order.append(idx)
+        return self.cache[idx]
 
     def draw_menu(self):
+        state = (self.menu_lowest, self.selection_pos)
+        if state == self.drawn:
+            return
         y = 0
         char_height = 8
         self.oled.fill(0)
-        for i in range(self.menu_lowest, min(self.menu_highest, len(self.list) + 1)):
-            self.oled.text(self.list[len(self.list) - i]["timestamp"], 2, 2 + y, 1)
+        for i in range(self.menu_lowest, min(self.menu_highest, self.store.count + 1)):
+            self.oled.text(self.record(self.store.count - i)["timestamp"], 2, 2 + y, 1)
             y += char_height + 1
-        self.oled.blit(self.selection, 0, self.selection_pos, 0)
+        self.draw_selection()
         self.oled.show()
+        self.drawn = state
+
+    def selected_index(self):
+        return int(self.store.count - (self.selection_pos / 9)) - self.menu_lowest
 
     def draw_selection(self):
-        self.oled.rect()
+        self.oled.rect(0, self.selection_pos, oled_width, 10, 1)
 
     def display_history(self):
         y = 0
         oled.fill(0)
-        record_json = self.list[
-            (int(len(self.list) - (self.selection_pos / 9)) - self.menu_lowest)
-        ]
+        record_json = self.record(self.selected_index())
         for item, value in record_json.items():
             if item != "timestamp":
                 oled.text(item + ":", 0, y, 1)
@@ -114,90 +213,65 @@ class History:
                 y += 8
         oled.text("Press to exit >", 8, 56, 1)
         oled.show()
+        self.drawn = None  # menu needs a redraw when we go back
 
     def print_selected_item(
         self,
     ):  # Prints the timestamp that is currently selected to console
-        print(
-            self.list[
-                (int(len(self.list) - (self.selection_pos / 9)) - self.menu_lowest)
-            ]
-        )
+        print(self.record(self.selected_index()))
 
 
 def save_to_history(results):
-    with open("history.txt", "a") as history:
-        json.dump(results, history)
-        history.write("\n")
+    HistoryStore().append(results)
 
 
-def history_mode(encoder, menu):
+def history_mode(encoder, menu=None):  # menu button goes back, knob toggles record view
     rot = encoder
     his = History(oled)
     history_exists = his.load_history()  # we can catch true/false here if needed
-    if history_exists:
-        his.print_selected_item()
-        his.draw_menu()
-        while True:
-            while rot.fifo.has_data():
-                val = rot.fifo.get()
-                if val == 1:
-                    his.selection_down()
-                    his.print_selected_item()
-                else:
-                    his.selection_up()
-                    his.print_selected_item()
+    if not history_exists:
+        return
+    his.print_selected_item()
+    his.draw_menu()
+    loop = Scheduler()
+    showing = False
+
+    def on_turn():
+        while rot.fifo.has_data():
+            val = rot.fifo.get()
+            if showing:  # ignore knob turns while a record is shown
+                continue
+            if val == 1:
+                his.selection_down()
+            else:
+                his.selection_up()
+            his.print_selected_item()
+        if not showing:
+            his.draw_menu()
+
+    def on_press():  # show the record, press again to go back to browsing
+        nonlocal showing
+        while rot.knob_fifo.has_data():
+            rot.knob_fifo.get()
+        while rot.fifo.has_data():
+            rot.fifo.get()
+        showing = not showing
+        if showing:
+            his.display_history()
+        else:
             his.draw_menu()
-            if menu.fifo.has_data():
-                while menu.fifo.has_data():
-                    menu.fifo.get()
-                return
-            # Press knob to show history, press again to go back to browsing
-            # There must be prettier way to accomplish this but cba for now
-            if rot.knob_fifo.has_data():
-                rot.empty_fifos()
-                while rot.knob_fifo.empty():  # ... to keep on displaying history
-                    his.display_history()
-                    if menu.fifo.has_data():
-                        while menu.fifo.has_data():
-                            menu.fifo.get()
-                        return
-                    while rot.fifo.has_data():  # ignore knob turns meanwhile
-                        rot.fifo.get()  # and make sure fifo doesnt fill up
-                while (
-                    rot.knob_fifo.has_data()
-                ):  # go back to browsing history entries with knob press
-                    rot.knob_fifo.get()  # empty fifo
+
+    def on_back():
+        while menu.fifo.has_data():
+            menu.fifo.get()
+        loop.stop()
+
+    loop.on(rot.fifo, on_turn)
+    loop.on(rot.knob_fifo, on_press)
+    if menu is not None:
+        loop.on(menu.fifo, on_back)
+    loop.run()
 
 
 if __name__ == "__main__":
-    rot = Encoder()
-    his = History(oled)
-    history_exists = his.load_history()  # we can catch true/false here if needed
-    if history_exists:
-        his.print_selected_item()
-        his.draw_menu()
-        while True:
-            while rot.fifo.has_data():
-                val = rot.fifo.get()
-                if val == 1:
-                    his.selection_down()
-                    his.print_selected_item()
-                else:
-                    his.selection_up()
-                    his.print_selected_item()
-            his.draw_menu()
-            # Press knob to show history, press again to go back to browsing
-            # There must be prettier way to accomplish this but cba for now
-            if rot.knob_fifo.has_data():
-                # This gets very ugly
-                while rot.knob_fifo.has_data():  # empty knob press fifo...
-                    rot.knob_fifo.get()
-                while rot.knob_fifo.empty():  # ... to keep on displaying history
-                    his.display_history()
-                    while rot.fifo.has_data():  # ignore knob turns meanwhile
-                        rot.fifo.get()  # and make sure fifo doesnt fill up
-                while (
-                    rot.knob_fifo.has_data()
-                ):  # go back to browsing history entries with knob press
-                    rot.knob_fifo.get()  # empty fifo
+    history_mode(Encoder())
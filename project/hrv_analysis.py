@@ -1,31 +1,94 @@
+from array import array
+import math
+import time
 import ujson
 
+HIST_BIN_MS = 1000 / 128  # standard 1/128 s bins for the triangular index
+HIST_BINS = 257  # covers RRIs up to 2000 ms
+LF_BAND = (0.04, 0.15)  # Hz
+HF_BAND = (0.15, 0.4)
+MAX_FREQS = 64  # frequencies evaluated over LF+HF, 0.0056 Hz steps at the most
+MAX_SPECTRAL_RRIS = 512  # latest RRIs used for LF/HF, with MAX_FREQS bounds the time it takes
+MIN_RRIS = 2  # fewer than this and every statistic is 0 (flat signal, nothing detected)
+
 
 class HrvAnalysis:
-    def __init__(self, rri_list):
-        self.rri_list = rri_list
+    # Statistics are accumulated one RRI at a time (Welford's algorithm for
+    # the variance), so results are available while recording and the RRIs
+    # themselves don't have to be kept around
+    def __init__(self, rri_list=()):
+        self.count = 0
         self.mean_rri = 0
+        self.m2 = 0  # sum of squared distances from the mean
+        self.first_rri = 0
+        self.last_rri = 0
+        self.ssd = 0  # sum of squared successive differences
+        self.nn50 = 0  # successive differences over 50 ms
+        self.histogram = array("H", [0] * HIST_BINS)
         self.mean_hr = 0
         self.sdnn = 0
         self.rmssd = 0
+        self.pnn50 = 0
+        self.sd1 = 0  # Poincaré plot, short-term variability
+        self.sd2 = 0  # Poincaré plot, long-term variability
+        self.tri_index = 0
+        self.lf = 0  # ms^2
+        self.hf = 0
+        self.lf_hf = 0
+        self.spectrum_ms = 0  # how long LF/HF took, see tools/bench_baseline.json
+        for rri in rri_list:
+            self.add(rri)
+
+    def add(self, rri):
+        self.count += 1
+        delta = rri - self.mean_rri
+        self.mean_rri += delta / self.count
+        self.m2 += delta * (rri - self.mean_rri)
+        if self.count > 1:
+            diff = rri - self.last_rri
+            self.ssd += diff**2
+            if abs(diff) > 50:
+                self.nn50 += 1
+        else:
+            self.first_rri = rri
+        self.last_rri = rri
+        hist_bin = min(int(rri / HIST_BIN_MS), HIST_BINS - 1)
+        self.histogram[hist_bin] += 1
 
-    def calc_mean_rri(self):
-        self.mean_rri = sum(self.rri_list) / len(self.rri_list)
+    def enough_data(self):
+        return self.count >= MIN_RRIS
 
     def calc_mean_hr(self):
-        self.mean_hr = (60 / self.mean_rri) * 1000
+        self.mean_hr = (60 / self.mean_rri) * 1000 if self.enough_data() else 0
 
     def calc_sdnn(self):
-        sum = 0
-        for rri in self.rri_list:
-            sum += (rri - self.mean_rri) ** 2
-        self.sdnn = (sum / (len(self.rri_list) - 1)) ** (0.5)
+        self.sdnn = (self.m2 / (self.count - 1)) ** (0.5) if self.enough_data() else 0
 
     def calc_rmssd(self):
-        sum = 0
-        for i in range(len(self.rri_list) - 1):
-            sum += (self.rri_list[i + 1] - self.rri_list[i]) ** 2
-        self.rmssd = (sum / (len(self.rri_list) - 1)) ** (0.5)
+        self.rmssd = (self.ssd / (self.count - 1)) ** (0.5) if self.enough_data() else 0
+
+    def calc_pnn50(self):
+        self.pnn50 = self.nn50 / (self.count - 1) * 100 if self.enough_data() else 0
+
+    def calc_poincare(self):
+        if not self.enough_data():
+            self.sd1 = self.sd2 = 0
+            return
+        # SDSD from the successive difference sums, the differences add up to last - first
+        diffs = self.count - 1
+        mean_diff = (self.last_rri - self.first_rri) / diffs
+        sdsd_sq = (self.ssd - diffs * mean_diff**2) / (diffs - 1) if diffs > 1 else 0
+        self.sd1 = (0.5 * sdsd_sq) ** 0.5
+        self.sd2 = max(2 * self.sdnn**2 - 0.5 * sdsd_sq, 0) ** 0.5
+
+    def calc_tri_index(self):
+        self.tri_index = self.count / max(self.histogram) if self.enough_data() else 0
+
+    def calc_frequency_domain(self, rri_list):
+        start = time.ticks_ms()
+        self.lf, self.hf = lomb_scargle_bands(rri_list)
+        self.spectrum_ms = time.ticks_diff(time.ticks_ms(), start)
+        self.lf_hf = self.lf / self.hf if self.hf else 0
 
     def get_analysis(self):
         return ujson.dumps(
@@ -34,20 +97,110 @@ class HrvAnalysis:
                 "mean_ppi": self.mean_rri,
                 "rmssd": self.rmssd,
                 "sdnn": self.sdnn,
+                "pnn50": self.pnn50,
+                "sd1": self.sd1,
+                "sd2": self.sd2,
+                "tri_index": self.tri_index,
+                "lf": self.lf,
+                "hf": self.hf,
+                "lf_hf": self.lf_hf,
             }
         )
 
-    def analyze(self):
-        self.calc_mean_rri()
+    def analyze(self, rri_list=None):  # the RRIs themselves are only needed for LF/HF
         self.calc_mean_hr()
         self.calc_sdnn()
         self.calc_rmssd()
+        self.calc_pnn50()
+        self.calc_poincare()
+        self.calc_tri_index()
+        if rri_list is not None:
+            self.calc_frequency_domain(rri_list)
+
+
+# Preallocated work buffers for the spectrum
+_times = array("f", [0] * MAX_SPECTRAL_RRIS)
+_values = array("f", [0] * MAX_SPECTRAL_RRIS)
+_cos = array("f", [0] * MAX_SPECTRAL_RRIS)
+_sin = array("f", [0] * MAX_SPECTRAL_RRIS)
+_cos_step = array("f", [0] * MAX_SPECTRAL_RRIS)
+_sin_step = array("f", [0] * MAX_SPECTRAL_RRIS)
+
+
+def lomb_scargle_bands(rri_list):
+    # Lomb-Scargle periodogram straight from the uneven beat times, no
+    # resampling needed. Returns (LF, HF) power in ms^2. Frequency step is
+    # the recording's resolution 1/duration, or coarser if that would need
+    # more than MAX_FREQS frequencies. sin/cos are only evaluated for the
+    # first frequency, the next ones rotate them by the step (angle addition).
+    start = max(len(rri_list) - MAX_SPECTRAL_RRIS, 0)
+    n = len(rri_list) - start
+    if n < 4:
+        return 0, 0
+    t = 0
+    mean = 0
+    for i in range(n):
+        rri = rri_list[start + i]
+        t += rri / 1000
+        _times[i] = t
+        mean += rri
+    mean /= n
+    for i in range(n):
+        _values[i] = rri_list[start + i] - mean
+    duration = _times[n - 1] - _times[0]
+    step = max(1 / duration, (HF_BAND[1] - LF_BAND[0]) / MAX_FREQS)
+    w = 2 * math.pi * LF_BAND[0]
+    dw = 2 * math.pi * step
+    s2 = 0  # sum of sin(2wt) and cos(2wt) for the time offset tau
+    c2 = 0
+    for i in range(n):
+        c = math.cos(w * _times[i])
+        s = math.sin(w * _times[i])
+        _cos[i] = c
+        _sin[i] = s
+        _cos_step[i] = math.cos(dw * _times[i])
+        _sin_step[i] = math.sin(dw * _times[i])
+        s2 += 2 * s * c
+        c2 += c * c - s * s
+    lf = 0
+    hf = 0
+    f = LF_BAND[0]
+    while f < HF_BAND[1]:
+        wtau = math.atan2(s2, c2) / 2
+        cos_wtau = math.cos(wtau)
+        sin_wtau = math.sin(wtau)
+        yc = ys = cc = ss = 0
+        s2 = c2 = 0
+        for i in range(n):
+            c = _cos[i]
+            s = _sin[i]
+            c_tau = c * cos_wtau + s * sin_wtau  # cos(w(t - tau)) by angle difference
+            s_tau = s * cos_wtau - c * sin_wtau
+            yc += _values[i] * c_tau
+            ys += _values[i] * s_tau
+            cc += c_tau * c_tau
+            ss += s_tau * s_tau
+            c_step = _cos_step[i]  # on to the next frequency
+            s_step = _sin_step[i]
+            c, s = c * c_step - s * s_step, s * c_step + c * s_step
+            _cos[i] = c
+            _sin[i] = s
+            s2 += 2 * s * c
+            c2 += c * c - s * s
+        power = 0.5 * (yc * yc / cc + ys * ys / ss)
+        psd = 2 * power * duration / n  # ms^2/Hz, so the bands sum up to the variance
+        if f < LF_BAND[1]:
+            lf += psd * step
+        else:
+            hf += psd * step
+        f += step
+    return lf, hf
 
 
-def basic_hrv_analysis(rri_list):
-    analysis = HrvAnalysis(rri_list)
-    analysis.analyze()
-    print("Data analyzed")
+def basic_hrv_analysis(rri_list, hrv=None):  # hrv: HrvAnalysis filled while recording
+    analysis = hrv if hrv is not None else HrvAnalysis(rri_list)
+    analysis.analyze(rri_list)
+    print("Data analyzed, LF/HF took", analysis.spectrum_ms, "ms")
     return analysis.get_analysis()
 
 
@@ -0,0 +1,424 @@
+import socket
+import select
+import struct
+import binascii
+import errno
+import time
+
+# Minimal HTTP/1.1 POST over a plain or TLS socket, for bodies too big to
+# build in RAM. The caller gives the body's length up front and the body as
+# chunks of bytes; the response body is fed chunk by chunk to a parser
+# instead of being read whole.
+#
+# post_steps() does it on a non-blocking socket as a generator, so an event
+# loop can send a request a little at a time: every next() makes at most one
+# connect, send or receive call and waits at most STEP_WAIT_MS for the
+# socket. post() runs the same steps to the end for callers that can wait.
+#
+# MicroPython's getaddrinfo() blocks for as long as the DNS server takes, so
+# once dns_server is set host names are looked up with a query of our own
+# on a non-blocking UDP socket (udp_steps(), also used for NTP), and kept
+# for the rest of the run.
+CHUNK = 256  # response bytes read at a time
+TIMEOUT_S = 15  # a request gives up when it makes no progress for this long
+STEP_WAIT_MS = 5  # longest a step waits for the socket to become ready
+WOULD_BLOCK = (errno.EAGAIN, errno.EINPROGRESS, errno.ETIMEDOUT)
+DNS_PORT = 53
+DNS_TIMEOUT_MS = 5000
+DNS_ID = 0x4852
+DNS_HEADER_FMT = ">HHHHHH"  # id, flags, questions, answers, authority and additional records
+DNS_HEADER_SIZE = struct.calcsize(DNS_HEADER_FMT)
+DNS_A = 1  # record type and class of an IPv4 address
+DNS_IN = 1
+dns_server = None  # (ip, port), None leaves lookups to getaddrinfo()
+addresses = {}  # host -> ip, looked up once
+try:
+    import ssl
+
+    # CPython's TLS socket says it wants to read or write with its own errors
+    TLS_WOULD_BLOCK = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+except (ImportError, AttributeError):
+    TLS_WOULD_BLOCK = ()
+
+
+def split_url(url):  # -> (https?, host, port, path)
+    scheme, _, rest = url.partition("://")
+    host, slash, path = rest.partition("/")
+    https = scheme == "https"
+    port = 443 if https else 80
+    if ":" in host:
+        host, port = host.split(":")
+        port = int(port)
+    return https, host, port, slash + path
+
+
+def basic_auth(user, password):
+    token = binascii.b2a_base64("{}:{}".format(user, password).encode())
+    return "Basic " + token.decode().strip()
+
+
+def run(steps):  # drives a step generator to the end -> its return value
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+def post(url, headers, length, body, parser):
+    # Sends the request, feeds the response body to parser.feed() and
+    # returns the status code
+    return run(post_steps(url, headers, length, body, parser))
+
+
+def post_steps(url, headers, length, body, parser):
+    https, host, port, path = split_url(url)
+    ip = yield from resolve_steps(host)
+    sock = socket.socket()
+    try:
+        sock.setblocking(False)
+        try:
+            sock.connect((ip, port))
+        except OSError as error:
+            if error.errno not in WOULD_BLOCK:
+                raise
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        if https:  # the handshake happens in the first sends and receives
+            import ssl
+
+            poller.unregister(sock)
+            sock = ssl.wrap_socket(sock, server_hostname=host, do_handshake=False)
+            poller.register(sock, select.POLLOUT)
+        progress = time.ticks_ms()
+
+        head = b"POST %s HTTP/1.1\r\nHost: %s\r\n" % (path.encode(), host.encode())
+        for name, value in headers.items():
+            head += b"%s: %s\r\n" % (name.encode(), value.encode())
+        head += b"Content-Length: %d\r\nConnection: close\r\n\r\n" % length
+        for chunk in chain(head, body):
+            view = memoryview(chunk)
+            while len(view):
+                sent = send_some(sock, view)
+                if sent:
+                    view = view[sent:]
+                    progress = time.ticks_ms()
+                else:
+                    wait(poller, progress)
+                yield
+
+        poller.modify(sock, select.POLLIN)
+        response = Response(parser)
+        buf = bytearray(CHUNK)
+        while not response.done():
+            got = receive_some(sock, buf)
+            if got is None:
+                wait(poller, progress)
+            elif got:
+                response.feed(memoryview(buf)[:got])
+                progress = time.ticks_ms()
+            else:
+                response.closed()
+            yield
+        return response.status
+    except OSError:
+        addresses.pop(host, None)  # the server may have moved, look it up again next time
+        raise
+    finally:
+        sock.close()
+
+
+def is_ip(host):
+    parts = host.split(".")
+    return len(parts) == 4 and all(part.isdigit() for part in parts)
+
+
+def resolve_steps(host):  # -> the host's IPv4 address as a string
+    if is_ip(host):
+        return host
+    if host not in addresses:
+        if dns_server is None:
+            addresses[host] = socket.getaddrinfo(host, 0, 0, socket.SOCK_STREAM)[0][-1][0]
+        else:
+            reply = yield from udp_steps(dns_server, dns_query(host), DNS_TIMEOUT_MS)
+            addresses[host] = dns_answer(reply)
+    return addresses[host]
+
+
+def dns_query(host):  # a recursive query for the host's A record
+    query = struct.pack(DNS_HEADER_FMT, DNS_ID, 0x0100, 1, 0, 0, 0)
+    for label in host.split("."):
+        query += bytes([len(label)]) + label.encode()
+    return query + struct.pack(">BHH", 0, DNS_A, DNS_IN)
+
+
+def dns_answer(reply):  # -> the first IPv4 address in a reply to dns_query()
+    ident, flags, questions, answers, _, _ = struct.unpack(
+        DNS_HEADER_FMT, reply[:DNS_HEADER_SIZE]
+    )
+    if ident != DNS_ID or flags & 0x000F:  # not ours, or an error code
+        raise OSError("DNS lookup failed")
+    pos = DNS_HEADER_SIZE
+    for _ in range(questions):
+        pos = skip_name(reply, pos) + 4  # type and class
+    for _ in range(answers):
+        pos = skip_name(reply, pos)
+        kind, klass, _, size = struct.unpack(">HHIH", reply[pos : pos + 10])
+        pos += 10
+        if kind == DNS_A and klass == DNS_IN and size == 4:
+            return "%d.%d.%d.%d" % tuple(reply[pos : pos + 4])
+        pos += size
+    raise OSError("DNS lookup failed")
+
+
+def skip_name(reply, pos):  # -> position after the (maybe compressed) name at pos
+    while True:
+        size = reply[pos]
+        if size >= 0xC0:  # pointer to a name elsewhere, always the end
+            return pos + 2
+        pos += size + 1
+        if not size:
+            return pos
+
+
+def udp_steps(address, request, timeout_ms):
+    # Sends one datagram and -> the first one that comes back, in steps like
+    # post_steps(). Gives up with OSError after timeout_ms.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(request, address)
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        sent = time.ticks_ms()
+        while True:
+            try:
+                return sock.recv(512)
+            except OSError as error:
+                if error.errno not in WOULD_BLOCK:
+                    raise
+            wait(poller, sent, timeout_ms)
+            yield
+    finally:
+        sock.close()
+
+
+def chain(first, rest):
+    yield first
+    for chunk in rest:
+        yield chunk
+
+
+def send_some(sock, data):  # -> bytes sent, 0 when the socket can't take any yet
+    try:
+        sent = sock.send(data) if hasattr(sock, "send") else sock.write(data)
+    except TLS_WOULD_BLOCK:
+        return 0
+    except OSError as error:
+        if error.errno in WOULD_BLOCK:
+            return 0
+        raise
+    return sent or 0  # MicroPython streams return None for nothing written
+
+
+def receive_some(sock, buf):  # -> bytes read, 0 when the server closed, None when none yet
+    try:
+        if hasattr(sock, "readinto"):
+            return sock.readinto(buf)
+        return sock.recv_into(buf)
+    except TLS_WOULD_BLOCK:
+        return None
+    except OSError as error:
+        if error.errno in WOULD_BLOCK:
+            return None
+        raise
+
+
+def wait(poller, progress, timeout_ms=TIMEOUT_S * 1000):  # nothing moved: wait a moment, or give up
+    if time.ticks_diff(time.ticks_ms(), progress) >= timeout_ms:
+        raise OSError("Timed out")
+    poller.poll(STEP_WAIT_MS)
+
+
+# Response states
+STATUS_LINE = 0
+HEADERS = 1
+BODY = 2  # Content-Length bytes, or up to the close without one
+CHUNK_SIZE = 3
+CHUNK_DATA = 4
+CHUNK_END = 5  # CRLF after the chunk's data
+DONE = 6
+
+
+class Response:
+    # Incremental HTTP response reader, feed() takes whatever the socket
+    # gave. The status line and headers are taken apart line by line, the
+    # body (de-chunked) goes on to parser.feed().
+    def __init__(self, parser):
+        self.parser = parser
+        self.status = None
+        self.state = STATUS_LINE
+        self.line = b""
+        self.left = None  # body or chunk bytes still to come, None reads up to the close
+        self.chunked = False
+
+    def done(self):
+        return self.state == DONE
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data) and self.state != DONE:
+            if self.state == BODY or self.state == CHUNK_DATA:
+                take = len(data) - pos
+                if self.left is not None:
+                    take = min(take, self.left)
+                self.parser.feed(data[pos : pos + take])
+                pos += take
+                if self.left is not None:
+                    self.left -= take
+                    if not self.left:
+                        self.state = CHUNK_END if self.state == CHUNK_DATA else DONE
+            else:
+                rest = bytes(data[pos:])
+                end = rest.find(b"\n")
+                if end < 0:
+                    self.line += rest
+                    return
+                line = self.line + rest[: end + 1]
+                self.line = b""
+                pos += end + 1
+                self.end_of_line(line)
+
+    def end_of_line(self, line):
+        if self.state == STATUS_LINE:
+            self.status = int(line.split(None, 2)[1])
+            self.state = HEADERS
+        elif self.state == HEADERS:
+            if not line.strip():  # end of the headers
+                if self.chunked:
+                    self.state = CHUNK_SIZE
+                else:
+                    self.state = DONE if self.left == 0 else BODY
+                return
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                self.left = int(value)
+            elif name == b"transfer-encoding" and b"chunked" in value.lower():
+                self.chunked = True
+        elif self.state == CHUNK_SIZE:
+            self.left = int(line.split(b";")[0], 16)
+            self.state = CHUNK_DATA if self.left else DONE  # trailers aren't read
+        elif self.state == CHUNK_END:
+            self.state = CHUNK_SIZE
+
+    def closed(self):  # the server closed the connection
+        if self.state == BODY and self.left is None:
+            self.state = DONE
+        else:
+            raise OSError("connection closed mid-response")
+
+
+# JsonFields states
+OUTSIDE = 0  # between tokens
+STRING = 1
+AFTER_STRING = 2  # a string ended, a ':' makes it a key
+VALUE = 3  # after a wanted key's ':'
+VALUE_STRING = 4
+VALUE_SCALAR = 5
+QUOTE = 0x22
+BACKSLASH = 0x5C
+COLON = 0x3A
+WHITESPACE = b" \t\r\n"
+SCALAR_END = b",}] \t\r\n"
+OPENERS = b"{["
+CLOSERS = b"}]"
+MAX_STRING = 32  # longer strings can't be a wanted key and aren't kept
+
+
+class JsonFields:
+    # Incremental JSON scanner that only keeps the values of the given keys,
+    # first occurrence wins. With depth, only keys of objects nested that
+    # deep count (1 is the top level object). Values are strings, numbers,
+    # booleans or None, nothing else of the document is held in memory.
+    def __init__(self, keys, depth=None):
+        self.keys = [key.encode() for key in keys]
+        self.depth = depth
+        self.values = {}
+        self.level = 0  # how many objects/arrays we're in
+        self.state = OUTSIDE
+        self.text = bytearray()
+        self.escaped = False
+        self.key = None
+
+    def feed(self, data):
+        for byte in data:
+            state = self.state
+            outside = state == OUTSIDE
+            if state == STRING or state == VALUE_STRING:
+                if self.escaped:
+                    self.escaped = False
+                    self.add(byte)
+                elif byte == BACKSLASH:
+                    self.escaped = True
+                elif byte == QUOTE:
+                    if state == STRING:
+                        self.state = AFTER_STRING
+                    else:
+                        self.store(self.text.decode())
+                else:
+                    self.add(byte)
+            elif state == AFTER_STRING:
+                if byte == COLON:
+                    key = bytes(self.text)
+                    self.state = OUTSIDE
+                    if key in self.keys and (self.depth is None or self.level == self.depth):
+                        key = key.decode()
+                        if key not in self.values:
+                            self.key = key
+                            self.state = VALUE
+                elif byte not in WHITESPACE:
+                    outside = True  # a string value, this byte is the next token
+            elif state == VALUE:
+                if byte == QUOTE:
+                    self.start(VALUE_STRING)
+                elif byte in OPENERS:  # object or array, not a value we keep
+                    outside = True
+                elif byte not in WHITESPACE:
+                    self.start(VALUE_SCALAR)
+                    self.add(byte)
+            elif state == VALUE_SCALAR:
+                if byte in SCALAR_END:
+                    self.store(self.scalar())
+                    outside = True
+                else:
+                    self.add(byte)
+            if outside:
+                self.state = OUTSIDE
+                if byte == QUOTE:
+                    self.start(STRING)
+                elif byte in OPENERS:
+                    self.level += 1
+                elif byte in CLOSERS:
+                    self.level -= 1
+
+    def start(self, state):
+        self.state = state
+        self.text = bytearray()
+        self.escaped = False
+
+    def add(self, byte):
+        if len(self.text) < MAX_STRING or self.state == VALUE_STRING:
+            self.text.append(byte)
+
+    def scalar(self):
+        text = self.text.decode()
+        if text in ("true", "false", "null"):
+            return {"true": True, "false": False, "null": None}[text]
+        if "." in text or "e" in text or "E" in text:
+            return float(text)
+        return int(text)
+
+    def store(self, value):
+        self.values[self.key] = value
+        self.state = OUTSIDE
@@ -1,26 +1,32 @@
 # Code modified from https://github.com/kevinmcaleer/pico_ssd1306/blob/master/display.py
 
-from machine import Pin, I2C
-from ssd1306 import SSD1306_I2C
+from display import get_display
+from assets import get_bundle, FORMATS, LOGO_FORMAT
 import framebuf, time
 
-i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-oled_width = 128
-oled_height = 64
-oled = SSD1306_I2C(oled_width, oled_height, i2c)
+oled = get_display()
+oled_width = oled.width
+oled_height = oled.height
 
-for n in range(1, 22):
+
+def logo_frame(n):  # (FrameBuffer, width, height), from the asset bundle if there is one
+    bundle = get_bundle()
+    if bundle is not None:
+        return bundle.image('img%s' % n)
     with open('/logo/img%s.pbm' % n, 'rb') as f:
         f.readline()  # Magic number
         f.readline()  # Creator comment
         dimensions = f.readline().split()  # Read dimensions
         width, height = int(dimensions[0]), int(dimensions[1])
         logo = bytearray(f.read())
-    
-    fbuf = framebuf.FrameBuffer(logo, width, height, framebuf.MONO_HLSB)
+    return framebuf.FrameBuffer(logo, width, height, FORMATS[LOGO_FORMAT]), width, height
+
+
+for n in range(1, 22):
+    fbuf, width, height = logo_frame(n)
     oled.blit(fbuf, (oled_width - width) // 2, (oled_height - height) // 2)
     oled.show()
-    
+
     if n == 17:  # logo file
         time.sleep(1)
     else:
@@ -0,0 +1,155 @@
+import sys
+
+# Per-sample loops of the filter stages, run over a block of samples in an
+# array("i") at a time. Each kernel works in place: it reads count values
+# from block, writes its outputs to the start of block and returns how many
+# there are. Stage state lives in array("i")s the stage owns, so the loops
+# only touch local ints and preallocated buffers.
+#
+# On MicroPython the same functions compiled with the viper emitter are
+# used (kernels_viper.py), here is the plain Python version for the host and
+# for firmware built without the native emitters. Both must give the same
+# outputs. Viper ints are 32 bit and wrap silently, see threshold_crossing
+# for the limits that keeps.
+
+NO_MIN = 0x3FFFFFFF  # min/max starting points, any sample replaces them (largest small int)
+NO_MAX = -0x3FFFFFFF
+WEIGHT_SCALE = 10  # threshold_crossing weights are in tenths
+IDLE_SAMPLES = 0x10000  # longest gap between crossings that's measured, longer ones are clipped
+
+# running_average state
+AVG_IDX = 0  # next slot to overwrite
+AVG_FILLED = 1  # how many slots are filled, nothing comes out until all are
+AVG_SUM = 2
+AVG_LENGTH = 3
+
+# threshold_crossing params
+CROSS_SAMPLE_US = 0
+CROSS_PERIOD = 1  # samples between threshold updates
+CROSS_WEIGHT = 2  # tenths towards max, -1 for halfway
+CROSS_OFFSET = 3
+# threshold_crossing state
+CROSS_THRESHOLD = 0  # tenths of an ADC step
+CROSS_SAMPLES = 1  # samples seen
+CROSS_COUNT = 2  # samples since the threshold was updated
+CROSS_MIN = 3
+CROSS_MAX = 4
+CROSS_LAST = 5  # previous sample
+CROSS_CROSSED = 6  # sample of the latest crossing
+CROSS_CROSSED_US = 7  # how long before that sample it crossed
+
+
+def running_average(block, count, values, state):
+    # Average of the latest len(values) samples, ring buffer with running sum
+    idx = state[AVG_IDX]
+    filled = state[AVG_FILLED]
+    total = state[AVG_SUM]
+    length = state[AVG_LENGTH]
+    out = 0
+    for i in range(count):
+        value = block[i]
+        total += value - values[idx]  # drop oldest, add newest
+        values[idx] = value
+        idx += 1
+        if idx == length:
+            idx = 0
+        if filled < length:
+            filled += 1
+        else:
+            block[out] = total // length
+            out += 1
+    state[AVG_IDX] = idx
+    state[AVG_FILLED] = filled
+    state[AVG_SUM] = total
+    return out
+
+
+def pair_average(block, count, state):  # average of the sample and the previous output
+    last = state[0]
+    for i in range(count):
+        last = (block[i] + last) // 2
+        block[i] = last
+    state[0] = last
+    return count
+
+
+def threshold_crossing(block, count, params, state):
+    # Rising edges over the dynamic threshold, outputs the us since the
+    # previous crossing. The threshold is in tenths of an ADC step, the
+    # crossing is interpolated between two samples and rounded down to the
+    # us. Samples times 10 and sample_us times the biggest step between two
+    # samples times 10 have to fit in 31 bits, gaps are clipped to
+    # IDLE_SAMPLES so the interval does too.
+    sample_us = params[CROSS_SAMPLE_US]
+    period = params[CROSS_PERIOD]
+    weight = params[CROSS_WEIGHT]
+    offset = params[CROSS_OFFSET]
+    threshold = state[CROSS_THRESHOLD]
+    samples = state[CROSS_SAMPLES]
+    since = state[CROSS_COUNT]
+    low = state[CROSS_MIN]
+    high = state[CROSS_MAX]
+    last = state[CROSS_LAST]
+    crossed = state[CROSS_CROSSED]
+    crossed_us = state[CROSS_CROSSED_US]
+    out = 0
+    for i in range(count):
+        value = block[i]
+        samples += 1
+        if value < low:
+            low = value
+        if value > high:
+            high = value
+        since += 1
+        if since == period:
+            if weight < 0:
+                threshold = ((low + high) // 2 + offset) * WEIGHT_SCALE
+            else:
+                threshold = (
+                    low * (WEIGHT_SCALE - weight) + high * weight + offset * WEIGHT_SCALE
+                )
+            low = NO_MIN
+            high = NO_MAX
+            since = 0
+        previous = last * WEIGHT_SCALE
+        last = value
+        value *= WEIGHT_SCALE
+        if previous < threshold and threshold <= value:
+            if samples - crossed > IDLE_SAMPLES:
+                crossed = samples - IDLE_SAMPLES
+            back = sample_us * (value - threshold) // (value - previous)
+            block[out] = (samples - crossed) * sample_us + crossed_us - back
+            out += 1
+            crossed = samples
+            crossed_us = back
+    state[CROSS_THRESHOLD] = threshold
+    state[CROSS_SAMPLES] = samples
+    state[CROSS_COUNT] = since
+    state[CROSS_MIN] = low
+    state[CROSS_MAX] = high
+    state[CROSS_LAST] = last
+    state[CROSS_CROSSED] = crossed
+    state[CROSS_CROSSED_US] = crossed_us
+    return out
+
+
+def copy_block(source, start, count, block):  # count values from source[start] to block
+    for i in range(count):
+        block[i] = source[start + i]
+
+
+def copy_block_adc(source, start, count, block):
+    # Same for array("H") blocks of raw 12 bit ADC results (DMA), scaled up
+    # to the 16 bits ADC.read_u16 gives so the thresholds fit both
+    for i in range(count):
+        block[i] = source[start + i] << 4
+
+compiled = False
+if sys.implementation.name == "micropython":
+    try:
+        from kernels_viper import running_average, pair_average, threshold_crossing
+        from kernels_viper import copy_block, copy_block_adc
+
+        compiled = True
+    except (ImportError, SyntaxError):  # firmware without the viper emitter
+        pass
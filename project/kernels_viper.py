@@ -0,0 +1,114 @@
+import micropython
+from micropython import const
+
+# kernels.py compiled with the viper emitter, imported by kernels.py on
+# MicroPython only (ptr32 and friends don't exist elsewhere). Same
+# arguments, same outputs, see kernels.py for what each one does. Viper
+# can't look up module globals as ints, so the constants are repeated as
+# const() here and have to be kept in step with kernels.py.
+_NO_MIN = const(0x3FFFFFFF)
+_NO_MAX = const(-0x3FFFFFFF)
+_WEIGHT_SCALE = const(10)
+_IDLE_SAMPLES = const(0x10000)
+
+
+@micropython.viper
+def running_average(block: ptr32, count: int, values: ptr32, state: ptr32) -> int:
+    idx = int(state[0])
+    filled = int(state[1])
+    total = int(state[2])
+    length = int(state[3])
+    out = 0
+    for i in range(count):
+        value = int(block[i])
+        total += value - int(values[idx])
+        values[idx] = value
+        idx += 1
+        if idx == length:
+            idx = 0
+        if filled < length:
+            filled += 1
+        else:
+            block[out] = total // length
+            out += 1
+    state[0] = idx
+    state[1] = filled
+    state[2] = total
+    return out
+
+
+@micropython.viper
+def pair_average(block: ptr32, count: int, state: ptr32) -> int:
+    last = int(state[0])
+    for i in range(count):
+        last = (int(block[i]) + last) // 2
+        block[i] = last
+    state[0] = last
+    return count
+
+
+@micropython.viper
+def threshold_crossing(block: ptr32, count: int, params: ptr32, state: ptr32) -> int:
+    sample_us = int(params[0])
+    period = int(params[1])
+    weight = int(params[2])
+    offset = int(params[3])
+    threshold = int(state[0])
+    samples = int(state[1])
+    since = int(state[2])
+    low = int(state[3])
+    high = int(state[4])
+    last = int(state[5])
+    crossed = int(state[6])
+    crossed_us = int(state[7])
+    out = 0
+    for i in range(count):
+        value = int(block[i])
+        samples += 1
+        if value < low:
+            low = value
+        if value > high:
+            high = value
+        since += 1
+        if since == period:
+            if weight < 0:
+                threshold = ((low + high) // 2 + offset) * _WEIGHT_SCALE
+            else:
+                threshold = (
+                    low * (_WEIGHT_SCALE - weight) + high * weight + offset * _WEIGHT_SCALE
+                )
+            low = _NO_MIN
+            high = _NO_MAX
+            since = 0
+        previous = last * _WEIGHT_SCALE
+        last = value
+        value *= _WEIGHT_SCALE
+        if previous < threshold and threshold <= value:
+            if samples - crossed > _IDLE_SAMPLES:
+                crossed = samples - _IDLE_SAMPLES
+            back = sample_us * (value - threshold) // (value - previous)
+            block[out] = (samples - crossed) * sample_us + crossed_us - back
+            out += 1
+            crossed = samples
+            crossed_us = back
+    state[0] = threshold
+    state[1] = samples
+    state[2] = since
+    state[3] = low
+    state[4] = high
+    state[5] = last
+    state[6] = crossed
+    state[7] = crossed_us
+    return out
+
+
+@micropython.viper
+def copy_block(source: ptr32, start: int, count: int, block: ptr32):
+    for i in range(count):
+        block[i] = source[start + i]
+
+
+@micropython.viper
+def copy_block_adc(source: ptr16, start: int, count: int, block: ptr32):
+    for i in range(count):
+        block[i] = source[start + i] << 4
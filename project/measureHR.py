@@ -3,13 +3,24 @@ from machine import Pin, ADC
 from time import sleep
 from piotimer import Piotimer
 from fifo import Fifo
+from array import array
+from scheduler import Scheduler
+import profiler
+from pipeline import Pipeline, Tee, SampleRing, PairAverage, ThresholdCrossing, Milliseconds
+from pipeline import RangeFilter, BLOCK, read_block
+
+
+WAVEFORM_EVERY = 5 # samples per waveform point, 20 ms at 4 ms sampling
+FRAME_MS = 40 # BPM view redraws at 25 fps
 
 
 class HeartLine:
+    # Draws the waveform from a SampleRing filled by the BPM sampling, each
+    # frame adds the points that arrived since the last one
     
-    
-    def __init__(self, pin, oled):
-        self.sensor = ADC(pin)  # Sensor pin
+    def __init__(self, oled, ring):
+        self.ring = ring
+        self.read_count = ring.written # points already drawn
         self.oled = oled.display  # Nichakon's oled != SSD1306 object
         self.oled.fill(0)    # empty screen before first line drawing
         self.minval = 0      # needed for scaling
@@ -19,13 +30,10 @@ class HeartLine:
         self.pixel_range = 64  # resolution (Recommended 128 or 64)
         self.x_add = round(128 / self.pixel_range) # next x is relative to drawing resolution
         self.last_y = 20 # make the new line start from previous height
+        self.x = 0 # where the next line starts
+        profiler.instrument(self, "draw", "HeartLine.draw")
     
-    def read_raw(self):
-        return self.sensor.read_u16() # raw value
-
-    
-    def scale_data(self):
-        value = self.read_raw()  # get raw value
+    def scale_data(self, value):
         # dynamic range needed for scaling
         self.maxval = max(self.maxval, value)
         self.minval = min(self.minval, value)
@@ -33,30 +41,37 @@ class HeartLine:
         scaled = round(((value - self.minval) / (self.maxval - self.minval)) * self.scale_factor)
         return scaled
     
-        
-    def display(self):
-        #self.oled.text(str(self.scale_factor),104,24,1)
-        x = 0 # resetting line start position to beggining
-        y1 = self.last_y # resetting line height
-        for _ in range(self.pixel_range): # amount of values per pixel. (Max 1 value per pixel) 
-            y2 = self.offset - self.scale_data() # turning upside down the scaled value
+    def draw(self): # draws the new points, returns True if a sweep was finished
+        values = self.ring.values
+        if self.ring.written - self.read_count > len(values): # fell behind, skip to what's kept
+            self.read_count = self.ring.written - len(values)
+        swept = False
+        while self.read_count < self.ring.written:
+            value = values[self.read_count % len(values)]
+            self.read_count += 1
+            y2 = self.offset - self.scale_data(value) # turning upside down the scaled value
             y2 = min(max(y2, 2), 20)  # Ensure y2 is within the valid range
-            self.oled.line(x, y1, x + self.x_add, y2, 1) # drawing a line from value to value
-            self.oled.show() 
-            x += self.x_add # next position of x is relative to drawing resolution
-            y1 = y2  # Update y1 for the next line
-        self.last_y = y1
-        self.oled.fill(0)
+            self.oled.line(self.x, self.last_y, self.x + self.x_add, y2, 1) # drawing a line from value to value
+            self.x += self.x_add # next position of x is relative to drawing resolution
+            self.last_y = y2  # next line starts from here
+            if self.x >= self.pixel_range * self.x_add:
+                self.oled.show() # whole sweep on screen before clearing
+                self.oled.fill(0)
+                self.x = 0 # resetting line start position to beggining
+                swept = True
+        self.oled.show() # only the changed columns go out
+        return swept
         
         
 class bpmCalc:
     
     
-    def __init__(self,oled):
-        self.sensor = ADC(27) # HR sensor
+    def __init__(self, oled, waveform=None):
+        self.sensor = ADC(27) # HR sensor, the only place the BPM view reads it
         self.oled = oled.display # Nichakon's oled != SSD1306 object
         
-        self.bpm_list = [] # used for averages
+        self.bpm_sum = 0 # used for averages, a running sum so nothing is allocated per beat
+        self.bpm_count = 0
         self.minbpm = 1200 # 1200 ms PPI equals 50 BPM 
         self.maxbpm = 375 # 375 ms PPI is about 160 BPM 
         self.lastbpm = 75 # used to filter out unnatural fluctuations
@@ -66,65 +81,50 @@ class bpmCalc:
         self.last_average_bpm = 0 # used to update average bpm
         self.reset_counter = 0
         
-        self.lastval = 99999 # used for peak detection and average
-        self.ms_counter = 0  # used for calculating PPI
-        self.maxval = 0 # maximum value for a period
-        self.minval = 99999 # minimum value for a period
-        self.threshold = 33600 # register peaks over this value
-        self.threshold_offset = 200 # Offset threshold so it is above middle
-        self.readcount = 0 # used to update threshold
+        # pair average -> threshold halfway between min and max plus 200, updated
+        # every 501 samples -> us between crossings -> PPIs in ms inside human heart rate
+        self.beats = Pipeline(
+            PairAverage(99999),
+            ThresholdCrossing(4000, 501, offset=200, initial=33600, last=99999),
+            Milliseconds(),
+            RangeFilter(self.maxbpm + 1, self.minbpm - 1),
+        )
+        # the waveform, if any, gets the same samples before beat detection
+        self.stream = self.beats if waveform is None else Pipeline(Tee(waveform), self.beats)
         
         # timer adds 1 to a counter every 4 ms and puts raw value into fifo
         self.fifo = Fifo(1000, typecode='i')
+        self.block = array('i', [0] * BLOCK) # samples on their way through stream
         self.tmr = Piotimer(period=4, mode=Piotimer.PERIODIC, callback=self.counter)
+        profiler.instrument(self, "detect", "bpmCalc.detect")
+        profiler.instrument(self, "process", "bpmCalc.process")
         
         
     def counter(self, _):
         self.fifo.put(self.sensor.read_u16()) # Put raw value in fifo
       
       
-    def SLPF(self, value): # Simple LowPass Filter for Dummies
-        new_val = (value + self.lastval) // 2
-        return new_val
-    
-    
     def detect(self, average): # main algorythm
-        
+        self.process(average)
+        self.bpm_show() # call show BPM show method 
+
+    def process(self, average): # samples to BPM averages, nothing is drawn
+        block = self.block
         while self.fifo.has_data(): # Run only when fifo not empty. 
-            # Get raw value from fifo and average it with the previous
-            raw = self.fifo.get()
-            self.ms_counter += 4 # adding one each 4 ms
-            newval = self.SLPF(raw)
-            
-            # Update min and max values for dynamic threshold
-            self.maxval = max(self.maxval, newval)
-            self.minval = min(self.minval, newval)
-            
-            # Recalculate new threshold every 500 values and reset values.
-            self.readcount += 1 # for threshold update
-            if self.readcount > 500:
-                self.threshold = ((self.minval + self.maxval) // 2) + self.threshold_offset
-                self.minval = 99999
-                self.maxval = 0
-                self.readcount = 0
+            count = self.stream.push_block(block, read_block(self.fifo, block)) # ms between beats
+            for idx in range(count):
+                bpm = 60000 // block[idx] # calculate BPM, rounded down
+                if abs(self.lastbpm - bpm) < 20: # Ignore fluctuations of more than 10 BPM between beats
+                    self.last_bpm = bpm
+                    self.bpm_sum += bpm # add BPM to the average
+                    self.bpm_count += 1
                 
-            # Check if new value is bigger that previous value and is above thershold
-            if self.lastval < self.threshold <= newval: # basic rising edge peak detection 
-                if self.minbpm > self.ms_counter > self.maxbpm: # skip values outside human heart rate. 
-                    seconds = self.ms_counter / 1000 # caclulate seconds between peaks
-                    bpm = 60 // seconds # calculate BPM
-                    if abs(self.lastbpm - bpm) < 20: # Ignore fluctuations of more than 10 BPM between beats
-                        self.last_bpm = bpm
-                        self.bpm_list.append(bpm) # add BPM to a list 
-                self.ms_counter = 0 # Reset counter after rising edge was detected 
-            self.lastval = newval # save current value as lastvalue for filtering
-            
-            # List for averages
-            if len(self.bpm_list) > average: # Check if list has enough values
-                self.bpm_fifo.put(int(sum(self.bpm_list) / (average + 1)))
-                
-                self.bpm_list = [] # empty the list
-        self.bpm_show() # call show BPM show method 
+                # Sum for averages
+                if self.bpm_count > average: # Check if there are enough values
+                    self.bpm_fifo.put(self.bpm_sum // (average + 1))
+                    
+                    self.bpm_sum = 0 # start the next average
+                    self.bpm_count = 0
                 
     
     def bpm_show(self):
@@ -148,17 +148,27 @@ class bpmCalc:
                 
 
 def display_bpm(encoder,oled):
-    bpm = bpmCalc(oled)
-    heartline = HeartLine(27,oled) # 27 for sensor pin
+    waveform = SampleRing(64, WAVEFORM_EVERY) # a sweep's worth of points
+    bpm = bpmCalc(oled, waveform)
+    heartline = HeartLine(oled, waveform)
+    loop = Scheduler()
+
+    def frame():
+        bpm.process(4) # average of 5 PPIs (In BPM)
+        if heartline.draw(): # BPM is drawn on the fresh screen after each sweep
+            bpm.bpm_show()
 
-    while True:
-        heartline.display()
-        bpm.detect(4) # average of 5 PPIs (In BPM)
+    def on_turn():
         while encoder.fifo.has_data():
             encoder.fifo.get()
-        if encoder.knob_fifo.has_data():
-            while encoder.knob_fifo.has_data():
-                encoder.knob_fifo.get()
-            bpm.tmr.deinit()
-            return
 
+    def on_press():
+        while encoder.knob_fifo.has_data():
+            encoder.knob_fifo.get()
+        loop.stop()
+
+    loop.every(FRAME_MS, frame)
+    loop.on(encoder.fifo, on_turn)
+    loop.on(encoder.knob_fifo, on_press)
+    loop.run()
+    bpm.tmr.deinit()
@@ -1,26 +1,29 @@
-import time, framebuf, micropython
+import time, micropython, machine, gc
 from machine import UART, Pin, I2C, Timer, ADC
-from ssd1306 import SSD1306_I2C
+from display import get_display
 from fifo import Fifo
 import ujson
 
 
 # Classes from other files need to be imported here if they're used
-from data_processor import record_heart_rate
+from data_processor import record_heart_rate, SHORT_TERM_S, LONG_TERM_S
 from hrv_analysis import basic_hrv_analysis
-from cloudconnection import connect_to_kubios
+from cloudconnection import KubiosSync, SYNC_POLL_MS
+from outbox import Outbox
 from history import save_to_history, history_mode
 from measureHR import display_bpm
-import icons, intro
+from scheduler import Scheduler, wait_for_press
+import assets, intro
+import profiler
 
 micropython.alloc_emergency_exception_buf(200)
 
 class Screen:
     def __init__(self):
-        self.i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
-        self.width = 128
-        self.height = 64
-        self.display = SSD1306_I2C(self.width, self.height, self.i2c)
+        self.display = get_display()  # shared with intro and history, changed pages only
+        self.i2c = self.display.i2c
+        self.width = self.display.width
+        self.height = self.display.height
         self.padding = 5
         self.gap = 10
         self.letter_size = 8
@@ -36,20 +39,16 @@ class Screen:
         self.display.blit(framebuffer, x, y)
         
     def heart_icon(self):
-        heart_framebuf = framebuf.FrameBuffer(icons.heartlogo, 27, 24, framebuf.MONO_VLSB)
-        self.display_icon(heart_framebuf, 51, 21)  # aligns icon in center
+        self.display_icon(assets.icon("heartlogo", 27, 24), 51, 21)  # aligns icon in center
         
     def kubios_icon(self):
-        kubwifi_framebuf = framebuf.FrameBuffer(icons.kubwifi, 35, 30, framebuf.MONO_VLSB)
-        self.display_icon(kubwifi_framebuf, 48, 18)
+        self.display_icon(assets.icon("kubwifi", 35, 30), 48, 18)
         
     def hrv_icon(self):
-        hrv_framebuf = framebuf.FrameBuffer(icons.hrv, 39, 16, framebuf.MONO_VLSB)
-        self.display_icon(hrv_framebuf, 46, 23)
+        self.display_icon(assets.icon("hrv", 39, 16), 46, 23)
         
     def history_icon(self):
-        his_framebuf = framebuf.FrameBuffer(icons.his, 24, 22, framebuf.MONO_VLSB)
-        self.display_icon(his_framebuf, 53, 20)
+        self.display_icon(assets.icon("his", 24, 22), 53, 20)
 
     def alignment(self, text, results, y_pos):
         text_width = len(text) * self.letter_size
@@ -77,13 +76,13 @@ class Screen:
         # self.display.text("Press to exit >", 0, self.height - self.letter_size - self.padding, 1)
         self.display.show()
         encoder.empty_fifos()
-        while encoder.knob_fifo.empty():
-            while encoder.fifo.has_data():
-                encoder.fifo.get()
-            self.display.show()  # Sorry for hacky way to keep showing the results
+        wait_for_press(encoder)  # results stay on screen, nothing to redraw meanwhile
 
-    def show_progress(self, percentage):
+    def show_progress(self, percentage, sdnn=None, rmssd=None):
         self.display.fill(0)
+        if sdnn is not None:  # live values while measuring
+            self.alignment("SDNN:", round(sdnn, 1), self.padding)
+            self.alignment("RMSSD:", round(rmssd, 1), self.padding + self.gap)
         message1 = "Measuring... "
         # Displaying and aligning text to center
         self.centered(message1)
@@ -91,45 +90,70 @@ class Screen:
         self.display.show()
 
         
-    def hrv_dis(self, mean_hr, mean_ppi, rmssd, sdnn):
+    def hrv_dis(self, mean_hr, mean_ppi, rmssd, sdnn, pnn50=None, lf_hf=None):
         results = {
             "MEAN HR:": round(mean_hr, 1),
             "MEAN PPI:": round(mean_ppi),
             "RMSSD:": round(rmssd, 2),
             "SDNN:": round(sdnn, 2),
         }
+        if pnn50 is not None:
+            results["PNN50:"] = round(pnn50, 1)
+        if lf_hf is not None:
+            results["LF/HF:"] = round(lf_hf, 2)
         self.display_data(results)
 
+    def select_duration(self):  # returns recording length in seconds, None for the quick one
+        options = (("50 beats", None), ("5 min", SHORT_TERM_S), ("24 h", LONG_TERM_S))
+        selected = 0
+        drawn = None
+        encoder.empty_fifos()
+        while encoder.knob_fifo.empty():
+            while encoder.fifo.has_data():
+                selected = (selected + encoder.fifo.get()) % len(options)
+            if selected == drawn:
+                machine.idle()  # wait for the next knob turn or press
+                continue
+            drawn = selected
+            self.display.fill(0)
+            self.display.text("Duration:", self.padding, self.padding, 1)
+            y_pos = self.padding + self.gap
+            for i, (text, _) in enumerate(options):
+                self.display.text(text, self.padding + self.letter_size, y_pos, 1)
+                if i == selected:
+                    self.display.text(">", self.padding, y_pos, 1)
+                y_pos += self.gap
+            self.display.show()
+        encoder.empty_fifos()
+        return options[selected][1]
+
     def centered(self, message):
         x_pos = (self.width - ((len(message) * self.letter_size))) // 2
         y_pos = (self.height - self.letter_size) // 2
         self.display.text(message, x_pos, y_pos, 1)
 
-    def hrv_first(self):
+    def notice(self, message):  # message until the knob is pressed
         encoder.empty_fifos()
-        message111 = 'USE HRV FIRST'
         self.display.fill(0)
-        self.centered(message111)
+        self.centered(message)
         self.display.text("Press to exit >", 0, self.height - self.letter_size, 1)
-        while encoder.knob_fifo.empty():
-            self.display.show()
+        self.display.show()
+        wait_for_press(encoder)
+
+    def hrv_first(self):
+        self.notice('USE HRV FIRST')
+
+    def no_data(self):  # recording gave too few RRIs to analyze, e.g. sensor not on a finger
+        self.notice('BAD SIGNAL')
         
-    def kubios_dis(self, results, connecting=False):
-        if connecting: # Displaying and aligning text to center
-            text1 = 'Connecting...'
-            self.display.fill(0)
-            self.centered(text1)
-            self.display.show()  # Connecting message
-        else:
-            self.display.fill(0)
-            y_pos = self.padding
-            parsed_results = {"MEAN HR:": results["mean_hr"],
-                              "MEAN PPI:": results["mean_ppi"],
-                              "RMSSD:": results["rmssd"],
-                              "SDNN:": results["sdnn"],
-                              "SNS:": results["sns"],
-                              "PNS:": results["pns"]}
-            self.display_data(parsed_results)
+    def kubios_dis(self, pending, status, error=None):  # results go to history when the upload is done
+        self.display.fill(0)
+        self.display.text("Kubios queue: " + str(pending), 0, self.padding, 1)
+        self.display.text(status, 0, self.padding + 2 * self.gap, 1)
+        if error:
+            self.display.text(error[:16], 0, self.padding + 3 * self.gap, 1)
+        self.display.text("Press to exit >", 0, self.height - self.letter_size, 1)
+        self.display.show()
 
 class MenuButton:
     def __init__(self, pin):
@@ -187,9 +211,64 @@ encoder = Encoder(10, 11)
 enc_value = 0b0001  # b0 for Q1
 rotval = 0
 rri_list = False
+rri_queued = False  # the latest recording is already in the outbox
+outbox = Outbox()  # recordings waiting for Kubios, survives a reboot
+
+
+def on_kubios_result(results):
+    save_to_history(results)
+    print("Kubios results saved to history:", results)
+
+
+kubios_sync = KubiosSync(outbox, on_kubios_result)
+KUBIOS_STATUS_MS = 250  # status screen redraw
+
+
+def kubios_mode():  # live upload status, a press goes back and stops waiting for Wi-Fi
+    loop = Scheduler()
+    drawn = None
+
+    def draw():
+        nonlocal drawn
+        state = (len(outbox), kubios_sync.status(), kubios_sync.error)
+        if state != drawn:
+            oled.kubios_dis(*state)
+            drawn = state
+
+    def on_turn():
+        while encoder.fifo.has_data():
+            encoder.fifo.get()
+
+    def on_press():
+        encoder.empty_fifos()
+        kubios_sync.cancel()
+        loop.stop()
+
+    loop.every(SYNC_POLL_MS, kubios_sync.poll)
+    loop.every(KUBIOS_STATUS_MS, draw)
+    loop.on(encoder.fifo, on_turn)
+    loop.on(encoder.knob_fifo, on_press)
+    draw()
+    kubios_sync.check_now()  # start connecting right away
+    loop.run()
+
+
+def draw_main_menu():  # sphere graphics, only drawn when the selection changes
+    oled.draw_menu(enc_value)
+    if enc_value == 0b0001:
+        oled.heart_icon()
+    elif enc_value == 0b1000:  # 2nd selection
+        oled.hrv_icon()
+    elif enc_value == 0b0100:  # 3rd selection
+        oled.kubios_icon()
+    elif enc_value == 0b0010:
+        oled.history_icon()
+    oled.display.show()
 
-while True:
-    # sphere graphics
+
+def on_rotate():
+    global rotval, enc_value
+    old_value = enc_value
     while encoder.fifo.has_data():
         rotval += encoder.fifo.get()
         if not encoder.pressed:  # This check here to not change menus when inside one
@@ -203,81 +282,96 @@ while True:
                 enc_value <<= 1  # changing Q
                 if enc_value == 0b10000:  # from Q4 to Q1
                     enc_value = 0b0001
+    if enc_value != old_value:
+        draw_main_menu()
 
-    # displays menu
-    oled.draw_menu(enc_value)
-    if enc_value == 0b0001:
-        oled.heart_icon()
-    elif enc_value == 0b1000:  # 2nd selection
-        oled.hrv_icon()
-    elif enc_value == 0b0100:  # 3rd selection
-        oled.kubios_icon()
-    elif enc_value == 0b0010:
-        oled.history_icon()
-    
-    if encoder.knob_fifo.has_data(): # BPM VIEW ################################
-        encoder.pressed = True
-        if enc_value == 0b0001:
-            while encoder.knob_fifo.has_data():
-                encoder.knob_fifo.get()
-            encoder.pressed = False
-            print("BPM selected")
-            display_bpm(encoder, oled)
-        
-        elif enc_value == 0b1000:  # HRV ANALYSIS #############################
-            while (
-                encoder.knob_fifo.has_data()
-            ):  # Emptying the fifo if multiple presses are recognized
-                encoder.knob_fifo.get()
-            encoder.pressed = False
-            print("HRV selected")
-            oled.show_progress(0)
-            rri_list = record_heart_rate(encoder, oled)
-            if (
-                not rri_list
-            ):  # this should be True if recording is interrupted by knob press
-                print("recording interrupted")
-                pass
+
+def on_knob():
+    global rri_list, rri_queued
+    encoder.pressed = True
+    if enc_value == 0b0001: # BPM VIEW ########################################
+        while encoder.knob_fifo.has_data():
+            encoder.knob_fifo.get()
+        encoder.pressed = False
+        print("BPM selected")
+        display_bpm(encoder, oled)
+
+    elif enc_value == 0b1000:  # HRV ANALYSIS #################################
+        while (
+            encoder.knob_fifo.has_data()
+        ):  # Emptying the fifo if multiple presses are recognized
+            encoder.knob_fifo.get()
+        encoder.pressed = False
+        print("HRV selected")
+        duration_s = oled.select_duration()
+        rri_list = False  # a new recording replaces the last one, even if it's interrupted
+        rri_queued = False
+        oled.show_progress(0)
+        recording = record_heart_rate(encoder, oled, duration_s)
+        if (
+            not recording
+        ):  # this should be True if recording is interrupted by knob press
+            print("recording interrupted")
+            pass
+        else:
+            rri_list, hrv = recording
+            rri_queued = False
+            if not hrv.enough_data():
+                print("not enough RRIs to analyze")
+                rri_list = False  # nothing for Kubios either
+                oled.no_data()
             else:
-                results_dict = ujson.loads(basic_hrv_analysis(rri_list))
+                results_dict = ujson.loads(basic_hrv_analysis(rri_list, hrv))
                 oled.hrv_dis(
                     results_dict["mean_hr"],
                     results_dict["mean_ppi"],
                     results_dict["rmssd"],
-                    results_dict["sdnn"])
-                encoder.empty_fifos()
-                pass
-
-        elif enc_value == 0b0100: # KUBIOS ###################################
-            while encoder.knob_fifo.has_data():
-                encoder.knob_fifo.get()
-            encoder.pressed = False
-            if not rri_list:
-                oled.hrv_first()
-            else:
-                print("Kubios selected")
-                oled.kubios_dis("_", connecting=True)
-                kubios_results = connect_to_kubios(rri_list)
-                print("saving results to history")
-                if kubios_results:
-                    oled.kubios_dis(kubios_results)
-                    save_to_history(kubios_results)
-                    print("Record saved to history")
-                else:
-                    print("Failed to connect to Kubios")  #prompt user if empty
-                    connected = False
+                    results_dict["sdnn"],
+                    results_dict["pnn50"],
+                    results_dict["lf_hf"])
             encoder.empty_fifos()
-
-        elif enc_value == 0b0010: # HISTORY ##################################
-            while encoder.knob_fifo.has_data():
-                encoder.knob_fifo.get()
-            encoder.pressed = False
-            print("History selected")
-            history_mode(encoder, menubutton)
             pass
-        
+
+    elif enc_value == 0b0100: # KUBIOS #######################################
+        while encoder.knob_fifo.has_data():
+            encoder.knob_fifo.get()
+        encoder.pressed = False
+        if not rri_list:
+            oled.hrv_first()
+        else:
+            print("Kubios selected")
+            if not rri_queued:  # sent in the background by kubios_sync
+                outbox.append(rri_list)
+                rri_queued = True
+            kubios_mode()
+        encoder.empty_fifos()
+
+    elif enc_value == 0b0010: # HISTORY ######################################
+        while encoder.knob_fifo.has_data():
+            encoder.knob_fifo.get()
+        encoder.pressed = False
+        print("History selected")
+        history_mode(encoder, menubutton)
+        pass
+
+    while menubutton.fifo.has_data():  # presses made inside a mode don't count here
+        menubutton.fifo.get()
+    draw_main_menu()  # back from a mode, screen has something else on it
+
+
+def on_menubutton():
     while menubutton.fifo.has_data():
         menubutton.fifo.get()
-        
-    oled.display.show()
 
+
+main_loop = Scheduler()
+main_loop.on(encoder.fifo, on_rotate)
+main_loop.on(encoder.knob_fifo, on_knob)
+main_loop.on(menubutton.fifo, on_menubutton)
+main_loop.every(SYNC_POLL_MS, kubios_sync.poll)
+main_loop.every(200, profiler.poll_console)  # p/d/r over serial, see profiler.py
+draw_main_menu()
+gc.collect()
+# ticks_ms counts from reset, so this is the time from power-on to a usable menu
+print("Boot: menu after %d ms, %d bytes free" % (time.ticks_ms(), gc.mem_free()))
+main_loop.run()
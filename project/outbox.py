@@ -0,0 +1,120 @@
+from array import array
+import os
+import struct
+
+# Recordings waiting to be sent to Kubios, oldest first, kept on flash so
+# nothing is lost when there's no network or the device is switched off.
+# The file is a header and the recordings one after another, each an RRI
+# count and the RRIs as unsigned shorts. Sent recordings are skipped by
+# moving head forward, the file is truncated when everything is sent. A
+# file that can't be read (e.g. torn by a power cut) is kept as outbox.bin.bad
+# and the device starts with an empty queue.
+OUTBOX_FILE = "outbox.bin"
+OUTBOX_MAGIC = b"HRVQ"
+HEADER_FMT = "<4sIII"  # magic, offset of the oldest recording, end of the last one, count
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+ENTRY_FMT = "<I"  # RRIs in the recording
+ENTRY_SIZE = struct.calcsize(ENTRY_FMT)
+COPY_RRIS = 128  # RRIs copied per write
+
+
+class Outbox:
+    def __init__(self, file=OUTBOX_FILE):
+        self.file = file
+        try:
+            self.load()
+        except OSError:  # no outbox yet
+            self.clear()
+        except ValueError as error:
+            print("Outbox unreadable (%s), moved to %s.bad" % (error, self.file))
+            os.rename(self.file, self.file + ".bad")
+            self.clear()
+
+    def load(self):
+        with open(self.file, "rb") as outbox:
+            header = outbox.read(HEADER_SIZE)
+            size = outbox.seek(0, 2)
+        if len(header) < HEADER_SIZE:
+            raise ValueError("truncated header")
+        magic, head, tail, count = struct.unpack(HEADER_FMT, header)
+        if magic != OUTBOX_MAGIC:
+            raise ValueError("unknown outbox file format")
+        if not HEADER_SIZE <= head <= tail <= size or (head == tail) != (count == 0):
+            raise ValueError("header doesn't match the file")
+        self.head = head
+        self.tail = tail
+        self.count = count
+
+    def write_header(self, head, tail, count):
+        with open(self.file, "r+b") as outbox:
+            outbox.write(struct.pack(HEADER_FMT, OUTBOX_MAGIC, head, tail, count))
+        self.head = head
+        self.tail = tail
+        self.count = count
+
+    def clear(self):
+        with open(self.file, "wb") as outbox:
+            outbox.write(struct.pack(HEADER_FMT, OUTBOX_MAGIC, HEADER_SIZE, HEADER_SIZE, 0))
+        self.head = self.tail = HEADER_SIZE
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, rris):  # rris can be an RriStore, it's copied a block at a time
+        block = array("H", [0] * COPY_RRIS)
+        filled = 0
+        with open(self.file, "r+b") as outbox:
+            outbox.seek(self.tail)
+            outbox.write(struct.pack(ENTRY_FMT, len(rris)))
+            for rri in rris:
+                block[filled] = rri
+                filled += 1
+                if filled == len(block):
+                    outbox.write(block)
+                    filled = 0
+            if filled:
+                outbox.write(memoryview(block)[:filled])
+        tail = self.tail + ENTRY_SIZE + len(rris) * 2
+        self.write_header(self.head, tail, self.count + 1)  # header last, a torn write loses only the new recording
+
+    def oldest(self):  # the oldest recording, None if there's nothing to send
+        if not self.count:
+            return None
+        with open(self.file, "rb") as outbox:
+            outbox.seek(self.head)
+            (length,) = struct.unpack(ENTRY_FMT, outbox.read(ENTRY_SIZE))
+        return OutboxEntry(self.file, self.head + ENTRY_SIZE, length)
+
+    def pop(self):  # the oldest recording has been sent
+        if self.count == 1:
+            self.clear()
+            return
+        with open(self.file, "rb") as outbox:
+            outbox.seek(self.head)
+            (length,) = struct.unpack(ENTRY_FMT, outbox.read(ENTRY_SIZE))
+        self.write_header(self.head + ENTRY_SIZE + length * 2, self.tail, self.count - 1)
+
+
+class OutboxEntry:
+    # One queued recording. Iterating reads it from flash a block at a time,
+    # so a 24 h recording never has to fit in RAM.
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        block = array("H", [0] * COPY_RRIS)
+        left = self.length
+        with open(self.file, "rb") as outbox:
+            outbox.seek(self.offset)
+            while left:
+                count = min(left, len(block))
+                outbox.readinto(memoryview(block)[:count])
+                for idx in range(count):
+                    yield block[idx]
+                left -= count
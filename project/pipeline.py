@@ -0,0 +1,199 @@
+from array import array
+import kernels
+
+# Streaming signal processing stages. Every stage has push(value), which
+# returns the stage's output for that value or None when nothing comes out
+# (filter still warming up, sample rejected, no beat on this sample), and
+# push_block(block, count), which does the same for count values in an
+# array("i") in place and returns how many outputs it left at the start of
+# block. Pipeline chains stages and is a stage itself, Tee hands one value
+# to several consumers, so one sample stream can feed the waveform, BPM and
+# RRI outputs.
+#
+# Everything is integer so a sample allocates nothing on MicroPython (a
+# float result is a heap object, so is an int past 30 bits): averages are
+# rounded down, ThresholdCrossing keeps its threshold in tenths of an ADC
+# step and its crossing times in whole us. tools/batch_rri.py does the same
+# arithmetic and must give the same RRIs. The averages and ThresholdCrossing
+# run their loops in kernels.py, native code on the device.
+
+BLOCK = 32  # samples handed to push_block() at a time, see read_block()
+
+
+def read_block(fifo, block, limit=BLOCK):
+    # Moves up to limit samples from a Fifo to block, returns how many. Only
+    # what's in one piece of the Fifo's ring, the rest comes next time.
+    tail = fifo.tail
+    head = fifo.head
+    count = (head if head >= tail else fifo.size) - tail
+    count = min(count, limit, len(block))
+    kernels.copy_block(fifo.data, tail, count, block)
+    fifo.tail = (tail + count) % fifo.size
+    return count
+
+
+class Stage:  # push_block() for stages that work a value at a time
+    def push_block(self, block, count):
+        push = self.push
+        out = 0
+        for idx in range(count):
+            value = push(block[idx])
+            if value is not None:
+                block[out] = value
+                out += 1
+        return out
+
+
+class KernelStage:  # push() for stages that work on blocks
+    def push(self, value):
+        one = self.one
+        one[0] = value
+        if self.push_block(one, 1):
+            return one[0]
+        return None
+
+
+class Pipeline:
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def push(self, value):
+        for stage in self.stages:
+            value = stage.push(value)
+            if value is None:
+                return None
+        return value
+
+    def push_block(self, block, count):
+        for stage in self.stages:
+            count = stage.push_block(block, count)
+            if not count:
+                break
+        return count
+
+    def process(self, values):  # outputs for a block of samples
+        push = self.push
+        for value in values:
+            value = push(value)
+            if value is not None:
+                yield value
+
+
+class Tee(Stage):  # passes the value on and gives it to every sink
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def push(self, value):
+        for sink in self.sinks:
+            sink.push(value)
+        return value
+
+
+class SampleRing(Stage):
+    # Decimated copy of a sample stream for drawing: the average of every
+    # `every` samples goes into a preallocated ring. written counts points
+    # ever stored, a reader keeps its own count and reads what's new.
+    def __init__(self, size, every=1):
+        self.values = array("H", [0] * size)
+        self.every = every
+        self.written = 0
+        self.acc = 0
+        self.acc_count = 0
+
+    def push(self, value):
+        self.acc += value
+        self.acc_count += 1
+        if self.acc_count == self.every:
+            self.values[self.written % len(self.values)] = self.acc // self.every
+            self.written += 1
+            self.acc = 0
+            self.acc_count = 0
+        return value
+
+
+class RunningAverage(KernelStage):  # low-pass filter, O(1) per sample (kernels.running_average)
+    def __init__(self, length):
+        self.values = array("i", [0] * length)
+        self.state = array("i", [0, 0, 0, length])  # see kernels.AVG_*
+        self.one = array("i", [0])
+
+    def push_block(self, block, count):
+        return kernels.running_average(block, count, self.values, self.state)
+
+
+class PairAverage(KernelStage):  # average of the sample and the previous output
+    def __init__(self, initial):
+        self.state = array("i", [initial])
+        self.one = array("i", [0])
+
+    def push_block(self, block, count):
+        return kernels.pair_average(block, count, self.state)
+
+
+class ThresholdCrossing(KernelStage):
+    # Rising edge detector with a dynamic threshold. Every period samples the
+    # threshold is set from the min and max seen since the last update,
+    # weighted (weight tenths of the way towards max) or halfway when weight
+    # is None, plus offset. Returns the us since the previous crossing (the
+    # first one counts from the start), each crossing interpolated between
+    # the previous sample and this one and rounded down to the us. Time is
+    # kept as a sample count so it stays a small int in a 24 h recording.
+    # initial is the threshold until the first update. last stands in for
+    # the sample before the first one, above the threshold the first sample
+    # can't be a crossing.
+    def __init__(self, sample_us, period, weight=None, offset=0, initial=0x8000, last=0):
+        self.params = array("i", [sample_us, period, -1 if weight is None else weight, offset])
+        # see kernels.CROSS_*
+        self.state = array(
+            "i", [initial * kernels.WEIGHT_SCALE, 0, 0, kernels.NO_MIN, kernels.NO_MAX, last, 0, 0]
+        )
+        self.one = array("i", [0])
+
+    @property
+    def samples(self):  # samples seen
+        return self.state[kernels.CROSS_SAMPLES]
+
+    def push_block(self, block, count):
+        return kernels.threshold_crossing(block, count, self.params, self.state)
+
+
+class Milliseconds(Stage):  # us to ms, rounded
+    def push(self, us):
+        return (us + 500) // 1000
+
+
+class RangeFilter(Stage):  # passes values from low to high, inclusive
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def push(self, value):
+        if self.low <= value <= self.high:
+            return value
+        return None
+
+
+class VarianceFilter(Stage):
+    # Passes values that differ less than difference from the average of the
+    # last length values (the value itself included)
+    def __init__(self, length, difference):
+        self.values = array("i", [0] * length)
+        self.idx = 0
+        self.count = 0
+        self.sum = 0
+        self.difference = difference
+
+    def push(self, value):
+        idx = self.idx
+        self.sum += value - self.values[idx]
+        self.values[idx] = value
+        idx += 1
+        if idx == len(self.values):
+            idx = 0
+        self.idx = idx
+        if self.count < len(self.values):
+            self.count += 1
+            return None  # first values only fill the average
+        if abs(value * self.count - self.sum) < self.difference * self.count:
+            return value
+        return None
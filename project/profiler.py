@@ -0,0 +1,136 @@
+from array import array
+import gc
+import select
+import sys
+import time
+
+# Per-stage call counts, time and heap allocation in a fixed table.
+# Stages are methods registered with instrument(); while profiling is off
+# they're the plain methods and cost nothing, enable() wraps each one on
+# its object (an instance attribute shadowing the class method) and
+# disable() removes the wrappers again. One object per stage name, a new
+# one (e.g. the next recording's DataProcessor) takes the slot over.
+#
+# From the serial console, while the menu runs: p toggles profiling,
+# d dumps the table, r zeroes it.
+MAX_STAGES = 16
+enabled = False
+timer = time.ticks_us  # the host swaps in a wall clock, its ticks_us is virtual
+names = []
+targets = [None] * MAX_STAGES  # (object, method name)
+counts = array("L", [0] * MAX_STAGES)
+total_us = array("Q", [0] * MAX_STAGES)
+alloc_bytes = array("Q", [0] * MAX_STAGES)
+started_us = array("q", [0] * MAX_STAGES)
+started_heap = array("q", [0] * MAX_STAGES)
+
+
+def stage(name):  # slot for name, the table has room for MAX_STAGES
+    if name in names:
+        return names.index(name)
+    if len(names) == MAX_STAGES:
+        raise ValueError("profiler table is full")
+    names.append(name)
+    return len(names) - 1
+
+
+def instrument(obj, method, name):
+    idx = stage(name)
+    old = targets[idx]
+    if enabled and old is not None:
+        unwrap(*old)
+    targets[idx] = (obj, method)
+    if enabled:
+        wrap(obj, method, idx)
+
+
+def wrap(obj, method, idx):
+    func = getattr(obj, method)
+
+    def timed(*args):
+        begin(idx)
+        result = func(*args)
+        end(idx)
+        return result
+
+    setattr(obj, method, timed)
+
+
+def unwrap(obj, method):
+    try:
+        delattr(obj, method)  # the class method shows through again
+    except AttributeError:
+        pass
+
+
+def begin(idx):
+    started_heap[idx] = gc.mem_alloc()
+    started_us[idx] = timer()
+
+
+def end(idx):
+    total_us[idx] += time.ticks_diff(timer(), started_us[idx])
+    counts[idx] += 1
+    allocated = gc.mem_alloc() - started_heap[idx]
+    if allocated > 0:  # a collection in between makes it negative
+        alloc_bytes[idx] += allocated
+
+
+def enable():
+    global enabled
+    if not enabled:
+        enabled = True
+        for idx, target in enumerate(targets):
+            if target is not None:
+                wrap(target[0], target[1], idx)
+
+
+def disable():
+    global enabled
+    if enabled:
+        enabled = False
+        for target in targets:
+            if target is not None:
+                unwrap(*target)
+
+
+def reset():
+    for idx in range(MAX_STAGES):
+        counts[idx] = 0
+        total_us[idx] = 0
+        alloc_bytes[idx] = 0
+
+
+def dump():
+    print("%-18s %8s %10s %9s %9s" % ("stage", "calls", "total ms", "us/call", "B/call"))
+    for idx, name in enumerate(names):
+        calls = counts[idx]
+        if not calls:
+            continue
+        us = total_us[idx]
+        print("%-18s %8d %10d %9d %9d" % (name, calls, us // 1000, us // calls, alloc_bytes[idx] // calls))
+
+
+console = None  # select.poll on stdin, set up on first poll_console()
+
+
+def poll_console():  # Scheduler task, handles the single letter commands
+    global console
+    if console is None:
+        console = select.poll()
+        console.register(sys.stdin, select.POLLIN)
+    while console.poll(0):
+        command = sys.stdin.read(1)
+        if not command:  # stdin closed
+            console.unregister(sys.stdin)
+            return
+        if command == "p":
+            if enabled:
+                disable()
+            else:
+                enable()
+            print("profiling", "on" if enabled else "off")
+        elif command == "d":
+            dump()
+        elif command == "r":
+            reset()
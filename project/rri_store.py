@@ -0,0 +1,59 @@
+from array import array
+import os
+
+BLOCK_RRIS = 128  # RRIs per block, 256 bytes on flash
+
+
+class RriStore:
+    # RRIs (ms, unsigned shorts) for one recording. Only the block being
+    # filled is kept in RAM, full blocks are appended to a binary file, so
+    # memory use stays the same no matter how long the recording is.
+    # Reading back goes through a one block cache. Blocks are written to
+    # file.tmp and finish() renames it to file once the recording is
+    # complete, so starting a new recording (that may be interrupted) leaves
+    # the previous one intact.
+    def __init__(self, file="rri.bin", block_rris=BLOCK_RRIS):
+        self.file = file
+        self.path = file + ".tmp"  # where the flushed blocks are
+        self.block = array("H", [0] * block_rris)
+        self.block_len = 0  # RRIs in the block being filled
+        self.flushed = 0  # RRIs already on flash
+        self.cache = array("H", [0] * block_rris)
+        self.cache_idx = -1  # which flushed block is in cache
+        with open(self.path, "wb"):  # new recording, truncate an unfinished one
+            pass
+
+    def append(self, rri):
+        self.block[self.block_len] = rri
+        self.block_len += 1
+        if self.block_len == len(self.block):
+            with open(self.path, "ab") as file:
+                file.write(self.block)
+            self.flushed += self.block_len
+            self.block_len = 0
+
+    def finish(self):  # recording is complete, it replaces the previous one
+        os.rename(self.path, self.file)
+        self.path = self.file
+
+    def __len__(self):
+        return self.flushed + self.block_len
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("RRI index out of range")
+        if idx >= self.flushed:
+            return self.block[idx - self.flushed]
+        block_idx = idx // len(self.cache)
+        if block_idx != self.cache_idx:
+            with open(self.path, "rb") as file:
+                file.seek(block_idx * len(self.cache) * 2)
+                file.readinto(self.cache)
+            self.cache_idx = block_idx
+        return self.cache[idx % len(self.cache)]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
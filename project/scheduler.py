@@ -0,0 +1,59 @@
+import machine
+import time
+
+
+class Scheduler:
+    # Cooperative event loop. IRQ handlers post into Fifos, a Fifo with data
+    # runs its handler; tasks run every period_ms (or once, see after()).
+    # When there's nothing to do the CPU waits in machine.idle() for the
+    # next interrupt instead of spinning.
+    def __init__(self):
+        self.sources = []  # (fifo, handler)
+        self.tasks = []  # [due_ms, period_ms, func], period 0 runs once
+        self.running = False
+
+    def on(self, fifo, handler):  # handler has to empty the fifo
+        self.sources.append((fifo, handler))
+
+    def every(self, period_ms, func):
+        self.tasks.append([time.ticks_add(time.ticks_ms(), period_ms), period_ms, func])
+
+    def after(self, delay_ms, func):
+        self.tasks.append([time.ticks_add(time.ticks_ms(), delay_ms), 0, func])
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            busy = False
+            for fifo, handler in self.sources:
+                if fifo.has_data():
+                    handler()
+                    busy = True
+                    if not self.running:
+                        return
+            now = time.ticks_ms()
+            for task in self.tasks:
+                if time.ticks_diff(now, task[0]) >= 0:
+                    if task[1]:
+                        task[0] = time.ticks_add(task[0], task[1])
+                        if time.ticks_diff(now, task[0]) >= 0:  # fell behind, don't try to catch up
+                            task[0] = time.ticks_add(now, task[1])
+                    else:
+                        self.tasks.remove(task)
+                    task[2]()
+                    busy = True
+                    if not self.running:
+                        return
+                    break  # list may have changed, rest will run on the next round
+            if not busy:
+                machine.idle()
+
+
+def wait_for_press(encoder):  # sleep until the knob is pressed, ignoring turns
+    while encoder.knob_fifo.empty():
+        while encoder.fifo.has_data():
+            encoder.fifo.get()
+        machine.idle()
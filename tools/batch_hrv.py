@@ -0,0 +1,84 @@
+# Vectorised HRV metrics for the host, the same definitions as
+# project/hrv_analysis.py (time domain, pNN50, Poincaré SD1/SD2,
+# triangular index and Lomb-Scargle LF/HF) for reprocessing recordings in bulk.
+# LF/HF uses the firmware's window and frequency grid, tools/checks.py checks
+# the results match.
+#
+# usage: python tools/batch_hrv.py capture.txt [more captures]
+#        (captures are raw ADC values, RRIs are detected with batch_rri)
+
+import os
+import sys
+import numpy as np
+
+import batch_rri
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "project"))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "hal"))  # ujson
+
+import hrv_analysis  # noqa: E402
+from hrv_analysis import HIST_BIN_MS, HIST_BINS, HF_BAND, LF_BAND  # noqa: E402
+
+
+def frequencies(duration):
+    # The firmware's grid, stepped the same way so the band edges fall alike
+    step = max(1 / duration, (HF_BAND[1] - LF_BAND[0]) / hrv_analysis.MAX_FREQS)
+    freqs = []
+    f = LF_BAND[0]
+    while f < HF_BAND[1]:
+        freqs.append(f)
+        f += step
+    return np.array(freqs), step
+
+
+def lomb_scargle_bands(rris):
+    # All frequencies at once, (frequency, beat) matrices, over the latest
+    # MAX_SPECTRAL_RRIS RRIs like the firmware
+    rris = np.asarray(rris, dtype=np.float64)[-hrv_analysis.MAX_SPECTRAL_RRIS :]
+    n = len(rris)
+    if n < 4:
+        return 0, 0
+    times = np.cumsum(rris) / 1000
+    values = rris - rris.mean()
+    duration = times[-1] - times[0]
+    freqs, step = frequencies(duration)
+    wt = 2 * np.pi * freqs[:, None] * times
+    tau = np.arctan2(np.sin(2 * wt).sum(axis=1), np.cos(2 * wt).sum(axis=1)) / 2
+    shifted = wt - tau[:, None]
+    c = np.cos(shifted)
+    s = np.sin(shifted)
+    power = 0.5 * ((c @ values) ** 2 / (c * c).sum(axis=1) + (s @ values) ** 2 / (s * s).sum(axis=1))
+    band = (2 * power * duration / n) * step  # ms^2/Hz, so the bands sum up to the variance
+    lf = freqs < LF_BAND[1]
+    return band[lf].sum(), band[~lf].sum()
+
+
+def hrv_metrics(rris):
+    rris = np.asarray(rris, dtype=np.float64)
+    diffs = np.diff(rris)
+    mean_rri = rris.mean()
+    sdnn = rris.std(ddof=1)
+    sdsd = diffs.std(ddof=1) if len(diffs) > 1 else 0.0
+    bins = np.minimum((rris / HIST_BIN_MS).astype(np.int64), HIST_BINS - 1)
+    lf, hf = lomb_scargle_bands(rris)
+    return {
+        "mean_hr": 60000 / mean_rri,
+        "mean_ppi": mean_rri,
+        "rmssd": np.sqrt((diffs**2).sum() / len(diffs)),
+        "sdnn": sdnn,
+        "pnn50": (np.abs(diffs) > 50).sum() / len(diffs) * 100,
+        "sd1": np.sqrt(0.5) * sdsd,
+        "sd2": np.sqrt(max(2 * sdnn**2 - 0.5 * sdsd**2, 0)),
+        "tri_index": len(rris) / np.bincount(bins).max(),
+        "lf": lf,
+        "hf": hf,
+        "lf_hf": lf / hf if hf else 0,
+    }
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        rris = batch_rri.process(batch_rri.load_capture(path))
+        metrics = hrv_metrics(rris)
+        print(path + ": " + ", ".join(f"{key} {float(value):.2f}" for key, value in metrics.items()))
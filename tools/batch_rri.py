@@ -0,0 +1,108 @@
+# Offline, vectorised version of DataProcessor's RRI pipeline for the host.
+# Takes a whole capture as a NumPy array and runs the same LPF, dynamic
+# threshold, rising edge detection, range filter and variance filter as
+# data_processor.DataProcessor.get_valid_rris, giving the same RRIs. The
+# arithmetic is the firmware's integer arithmetic (see pipeline.py): the
+# threshold in tenths of an ADC step, crossings rounded down to the us,
+# averages compared as sums, so the results match bit for bit.
+#
+# usage: python tools/batch_rri.py capture03_250Hz.txt [more captures] [--verify]
+
+import sys
+import numpy as np
+
+
+def load_capture(path):  # capture files have one raw ADC value per line
+    return np.loadtxt(path, dtype=np.int64, ndmin=1)
+
+
+def lpf(samples, lpf_len=10):
+    # Running average. The first lpf_len samples only fill the window and
+    # give no output (the streaming filter returns None there), so the
+    # result is lpf_len samples shorter
+    if len(samples) <= lpf_len:
+        return np.zeros(0, dtype=np.int64)
+    csum = np.concatenate(([0], np.cumsum(samples, dtype=np.int64)))
+    sums = csum[lpf_len + 1 :] - csum[1 : len(samples) - lpf_len + 1]
+    return sums // lpf_len
+
+
+def detect_slope(values, polling_rate=4, topweight=7, period_ms=4000):
+    # topweight is in tenths, thresholds are in tenths of an ADC step
+    ms = np.cumsum(np.ones(len(values), dtype=np.int64)) * polling_rate
+    # Dynamic threshold, recalculated from min and max since the last update
+    update = np.flatnonzero(ms % period_ms == 0)
+    if len(update):
+        starts = np.concatenate(([0], update[:-1] + 1))
+        segments = values[: update[-1] + 1]  # samples after the last update don't count
+        mins = np.minimum.reduceat(segments, starts)
+        maxs = np.maximum.reduceat(segments, starts)
+        thresholds = mins * (10 - topweight) + maxs * topweight
+    else:
+        thresholds = np.zeros(0, dtype=np.int64)
+    thresholds = np.concatenate(([0x8000 * 10], thresholds))
+    is_update = np.zeros(len(values), dtype=np.int64)
+    is_update[update] = 1
+    threshold = thresholds[np.cumsum(is_update)]
+    # Rising edge detection, crossing time interpolated between the two samples
+    values = values * 10
+    prev = np.concatenate(([0], values[:-1]))  # previous sample for every sample
+    crossing = (prev < threshold) & (threshold <= values)
+    values, prev, threshold = values[crossing], prev[crossing], threshold[crossing]
+    polling_us = polling_rate * 1000
+    peaks_us = ms[crossing] * 1000 - polling_us * (values - threshold) // (values - prev)
+    return (np.diff(np.concatenate(([0], peaks_us))) + 500) // 1000
+
+
+def range_filter(rris, min_rri=400, max_rri=1200):
+    return rris[(min_rri <= rris) & (rris <= max_rri)]
+
+
+def variance_filter(rris, difference_ms=80, variance_len=4):
+    if len(rris) <= variance_len:
+        return rris[:0]
+    csum = np.concatenate(([0], np.cumsum(rris, dtype=np.int64)))
+    # sum of the variance_len latest RRIs, including the one being tested,
+    # compared with the candidate times variance_len instead of dividing
+    sums = csum[variance_len + 1 :] - csum[1 : len(rris) - variance_len + 1]
+    candidates = rris[variance_len:]
+    return candidates[np.abs(candidates * variance_len - sums) < difference_ms * variance_len]
+
+
+def process(samples, polling_rate=4, lpf_len=10, variance_len=4):
+    samples = np.asarray(samples, dtype=np.int64)
+    rris = detect_slope(lpf(samples, lpf_len), polling_rate)
+    return variance_filter(range_filter(rris), variance_len=variance_len)
+
+
+def stream_rris(samples, polling_rate=4, lpf_len=10, variance_len=4):
+    # Reference: push the capture through the firmware's own DataProcessor,
+    # running on the host HAL
+    import simulate
+
+    simulate.install(samples, root=simulate.device_root())
+    from data_processor import DataProcessor
+
+    processor = DataProcessor(len(samples) + 1, polling_rate, lpf_len, variance_len)
+    processor.tmr.deinit()  # samples come from the capture, not the sensor
+    for value in samples:
+        processor.fifo.put(int(value))
+    while processor.fifo.has_data():
+        processor.get_valid_rris()
+    return np.array(processor.rri_arr, dtype=np.int64)
+
+
+def verify(samples, **kwargs):  # True if batch and streaming paths agree
+    batch = process(samples, **kwargs)
+    stream = stream_rris(samples, **kwargs)
+    return len(batch) == len(stream) and bool(np.all(batch == stream))
+
+
+if __name__ == "__main__":
+    check = "--verify" in sys.argv
+    for path in [arg for arg in sys.argv[1:] if not arg.startswith("--")]:
+        samples = load_capture(path)
+        rris = process(samples)
+        print(f"{path}: {len(samples)} samples, {len(rris)} RRIs")
+        if check:
+            print("  matches streaming path" if verify(samples) else "  MISMATCH with streaming path")
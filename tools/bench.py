@@ -0,0 +1,308 @@
+# Benchmarks for the per-sample hot paths, replaying a PPG capture on the
+# host HAL (see simulate.py). Reports samples/second, per-call latency
+# percentiles, heap bytes allocated per sample and the sample FIFO's
+# high-water mark during a simulated HRV recording, also with the UI core
+# blocked, on one core, with an auto-sized FIFO and with sampling on core 1.
+#
+# usage: python tools/bench.py [--capture FILE] [--seconds S] [--save] [--tolerance PCT]
+#
+# Results are compared against tools/bench_baseline.json, --save rewrites it.
+# Numbers are host CPython numbers: compare them with each other, not with
+# the RP2040's 4 ms budget.
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import simulate
+import sim
+
+BASELINE = os.path.join(simulate.TOOLS_DIR, "bench_baseline.json")
+NOT_CHECKED = ("p99_us", "max_us", "virtual_s", "fifo_size")  # too noisy or not a cost
+
+
+def percentiles(latencies_ns):
+    latencies_ns = sorted(latencies_ns)
+    last = len(latencies_ns) - 1
+    return {
+        f"p{p}_us": round(latencies_ns[last * p // 100] / 1000, 2) for p in (50, 90, 99)
+    } | {"max_us": round(latencies_ns[-1] / 1000, 2)}
+
+
+def measure(call, calls):
+    # Timing pass and allocation pass are separate, tracemalloc slows everything down
+    latencies = []
+    start = time.perf_counter_ns()
+    for _ in range(calls):
+        t = time.perf_counter_ns()
+        call()
+        latencies.append(time.perf_counter_ns() - t)
+    total = time.perf_counter_ns() - start
+    return latencies, total
+
+
+def allocations(call, calls):  # transient heap bytes per call, tracemalloc peak above start
+    tracemalloc.start()
+    allocated = 0
+    for _ in range(calls):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        call()
+        allocated += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return allocated
+
+
+def result(latencies, total_ns, samples, allocated):
+    return {
+        "samples_per_s": round(samples / (total_ns / 1e9)),
+        **percentiles(latencies),
+        "alloc_bytes_per_sample": round(allocated / samples, 2),
+    }
+
+
+def bench_get_valid_rris(values):  # one call is a block of samples
+    from data_processor import DataProcessor
+    from pipeline import BLOCK
+
+    calls = len(values) // BLOCK
+
+    def run():
+        processor = DataProcessor(len(values) + 1, 4)
+        processor.tmr.deinit()
+        for value in values:
+            processor.fifo.put(value)
+        return processor
+
+    processor = run()
+    latencies, total = measure(processor.get_valid_rris, calls)
+    processor = run()
+    allocated = allocations(processor.get_valid_rris, calls)
+    return result(latencies, total, calls * BLOCK, allocated)
+
+
+def bench_bpm_detect(values, screen, samples_per_call=16):
+    from measureHR import bpmCalc
+
+    calls = len(values) // samples_per_call
+
+    def run():
+        bpm = bpmCalc(screen)
+        bpm.tmr.deinit()
+        bpm.fifo = simulate_fifo(len(values) + 1, values)
+        return bpm
+
+    bpm = run()
+    latencies, total = measure(lambda: feed(bpm, samples_per_call), calls)
+    bpm = run()
+    allocated = allocations(lambda: feed(bpm, samples_per_call), calls)
+    return result(latencies, total, calls * samples_per_call, allocated)
+
+
+def simulate_fifo(size, values):  # Fifo with the whole capture queued, handed out in slices
+    from fifo import Fifo
+
+    fifo = Fifo(size, typecode="i")
+    fifo.pending = iter(values)
+    return fifo
+
+
+def feed(bpm, count):
+    for _ in range(count):
+        bpm.fifo.put(next(bpm.fifo.pending))
+    bpm.detect(4)
+
+
+def bench_heartline(screen, values, sweeps):
+    # One call is a sweep drawn frame by frame, two waveform points a frame
+    from measureHR import HeartLine, WAVEFORM_EVERY
+    from pipeline import SampleRing
+
+    ring = SampleRing(64, WAVEFORM_EVERY)
+    heartline = HeartLine(screen, ring)
+    samples = iter(values * (sweeps * 64 * WAVEFORM_EVERY * 2 // len(values) + 1))
+
+    def sweep():
+        for _ in range(heartline.pixel_range // 2):
+            for _ in range(2 * WAVEFORM_EVERY):
+                ring.push(next(samples))
+            heartline.draw()
+
+    latencies, total = measure(sweep, sweeps)
+    allocated = allocations(sweep, sweeps)
+    return result(latencies, total, sweeps * heartline.pixel_range, allocated)
+
+
+def bench_hrv_analyze(rris, windows):
+    from hrv_analysis import HrvAnalysis
+
+    window = rris[:50]
+
+    def analyze():
+        HrvAnalysis(window).analyze(window)
+
+    latencies, total = measure(analyze, windows)
+    allocated = allocations(analyze, windows)
+    return result(latencies, total, windows * len(window), allocated)
+
+
+def bench_lomb_scargle(rris, calls):
+    # LF/HF over a full MAX_SPECTRAL_RRIS window, the worst case at the end of
+    # a long recording. On the device HrvAnalysis.spectrum_ms reports it.
+    from hrv_analysis import lomb_scargle_bands, MAX_SPECTRAL_RRIS
+
+    window = (rris * (MAX_SPECTRAL_RRIS // len(rris) + 1))[:MAX_SPECTRAL_RRIS]
+
+    def analyze():
+        lomb_scargle_bands(window)
+
+    latencies, total = measure(analyze, calls)
+    allocated = allocations(analyze, calls)
+    return result(latencies, total, calls * len(window), allocated)
+
+
+class BlockingScreen(simulate.Screen):  # UI core stuck for a while on every update
+    def __init__(self, block_ms):
+        super().__init__()
+        self.block_ms = block_ms
+
+    def show_progress(self, *args):
+        super().show_progress(*args)
+        time.sleep_ms(self.block_ms)
+
+
+def bench_record_loop(screen=None, dual_core=False, block_capture=False, auto_size=False):
+    # Full record_heart_rate on the virtual clock, reports how deep the sample
+    # FIFO gets while the loop is busy with LEDs and the OLED, and the longest
+    # consumer stall the firmware measured itself
+    import data_processor
+
+    processors = []
+    original_init = data_processor.DataProcessor.__init__
+
+    def init(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        processors.append(self)
+        fifo = self.fifo
+        fifo.max_depth = 0
+        put = fifo.put
+
+        def tracked_put(value):
+            put(value)
+            fifo.max_depth = max(fifo.max_depth, (fifo.head - fifo.tail) % fifo.size)
+
+        fifo.put = tracked_put
+
+    data_processor.DataProcessor.__init__ = init
+    try:
+        start_us = sim.clock.now_us
+        data_processor.record_heart_rate(
+            simulate.Encoder(),
+            screen or simulate.Screen(),
+            dual_core=dual_core,
+            block_capture=block_capture,
+            auto_size=auto_size,
+        )
+    finally:
+        data_processor.DataProcessor.__init__ = original_init
+    processor = processors[-1]
+    fifo = processor.fifo
+    results = {
+        "virtual_s": round((sim.clock.now_us - start_us) / 1e6, 2),
+        "fifo_size": fifo.size,
+        "max_fifo_depth": fifo.max_depth,
+        "dropped_samples": fifo.dropped(),
+        "max_stall_ms": processor.max_stall_ms,
+    }
+    if dual_core:
+        results["dropped_rris"] = processor.ring.dropped()
+        results["late_samples"] = processor.late
+    if block_capture:
+        del results["max_fifo_depth"], results["dropped_samples"]  # the Fifo isn't used
+        results["dropped_blocks"] = processor.dropped_blocks
+    return results
+
+
+def run(capture=None, seconds=120):
+    simulate.install(capture, root=simulate.device_root(), loop=True)
+    values = sim.adc_sources["default"].values[: seconds * 250]
+    screen = simulate.Screen()
+    import batch_rri
+
+    rris = [int(rri) for rri in batch_rri.process(values)]
+    results = {
+        "get_valid_rris": bench_get_valid_rris(values),
+        "bpmCalc.detect": bench_bpm_detect(values, screen),
+        "HeartLine.draw": bench_heartline(screen, values, 300),
+        "HrvAnalysis.analyze": bench_hrv_analyze(rris, 2000),
+        "lomb_scargle_bands": bench_lomb_scargle(rris, 20),
+    }
+    simulate.install(capture, root=os.getcwd(), loop=True)  # fresh clock for the loop run
+    results["record_heart_rate"] = bench_record_loop()
+    # UI core blocked 600 ms per beat, longer than the 400 ms sample Fifo lasts
+    simulate.install(capture, root=os.getcwd(), loop=True)
+    results["record_ui_blocked"] = bench_record_loop(BlockingScreen(600))
+    # same, with the Fifo sized from the stall the run before measured
+    simulate.install(capture, root=os.getcwd(), loop=True)
+    results["record_ui_blocked_auto_size"] = bench_record_loop(BlockingScreen(600), auto_size=True)
+    simulate.install(capture, root=os.getcwd(), loop=True)
+    results["record_ui_blocked_dual_core"] = bench_record_loop(BlockingScreen(600), True)
+    simulate.install(capture, root=os.getcwd(), loop=True)
+    results["record_block_capture"] = bench_record_loop(block_capture=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, metrics in results.items():
+        old = baseline.get(name, {})
+        for key, value in metrics.items():
+            if key not in old:
+                continue
+            base = old[key]
+            change = (value - base) / base * 100 if base else 0
+            marker = ""
+            worse = change < -tolerance if key == "samples_per_s" else change > tolerance
+            if key in (
+                "dropped_samples",
+                "dropped_rris",
+                "late_samples",
+                "dropped_blocks",
+                "max_stall_ms",
+            ):
+                worse = value > base
+            if worse and key not in NOT_CHECKED:
+                marker = "  <-- regression"
+                regressions.append(f"{name}.{key}")
+            print(f"  {name:22} {key:24} {base:>12} -> {value:>12} ({change:+.1f}%){marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RRI and HRV hot paths")
+    parser.add_argument("--capture", help="raw ADC values at 250 Hz (default: synthetic)")
+    parser.add_argument("--seconds", type=int, default=120, help="how much of the capture to use")
+    parser.add_argument("--save", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=35, help="allowed change in percent")
+    args = parser.parse_args()
+
+    results = run(args.capture, args.seconds)
+    print(json.dumps(results, indent=2))
+    if args.save:
+        with open(BASELINE, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+        print("baseline saved")
+    elif os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("regressions:", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
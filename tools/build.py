@@ -0,0 +1,141 @@
+# Builds what goes on the device for a fast boot: every module precompiled
+# to .mpy (nothing is compiled on the Pico at boot), the intro's logo frames
+# and the icons.py bitmaps packed into one assets.bin (see
+# project/assets.py), the other device files, and a main.py that starts the
+# menu. Copy the output directory to the device's root.
+#
+# usage: python tools/build.py [--out DIR] [--no-mpy]
+#
+# mpy-cross comes from `pip install mpy-cross` or a MicroPython checkout.
+# Its version has to match the firmware's .mpy format. Modules are built
+# for armv6m so the viper kernels (project/kernels_viper.py) are native
+# code in the .mpy. --no-mpy copies the sources instead, e.g. to try the
+# bundle in tools/simulate.py --root DIR.
+#
+# The menu prints "Boot: menu after N ms, N bytes free" on serial once it's
+# up, compare that between a source install and a build.
+
+import argparse
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.join(TOOLS_DIR, "..", "project")
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, os.path.join(TOOLS_DIR, "hal"))
+
+import assets  # noqa: E402
+
+MAIN = "import menu\n"
+ICON_HEADER = re.compile(r"^(\w+) = bytearray\(\s*\[# monovlsb : (\d+) : (\d+)", re.M)
+
+
+def mpy_cross():  # command that runs mpy-cross, None if it isn't installed
+    exe = shutil.which("mpy-cross")
+    if exe:
+        return [exe]
+    try:
+        import mpy_cross  # noqa: F401
+    except ImportError:
+        return None
+    return [sys.executable, "-m", "mpy_cross"]
+
+
+def read_pbm(path):  # -> (width, height, data) of a binary (P4) PBM
+    with open(path, "rb") as file:
+        if file.readline().strip() != b"P4":
+            raise ValueError(path + " is not a binary PBM")
+        line = file.readline()
+        while line.startswith(b"#"):  # comments
+            line = file.readline()
+        width, height = (int(value) for value in line.split())
+        return width, height, file.read()
+
+
+def read_icons(path):  # -> [(name, width, height, data)] from icons.py
+    with open(path) as file:
+        source = file.read()
+    bitmaps = {}
+    exec(source, bitmaps)
+    return [
+        (name, int(width), int(height), bytes(bitmaps[name]))
+        for name, width, height in ICON_HEADER.findall(source)
+    ]
+
+
+def logo_number(name):  # img2.pbm before img10.pbm
+    return int(re.sub(r"\D", "", name) or 0)
+
+
+def pack_assets(out_file):  # -> number of images packed
+    images = []
+    logo_dir = os.path.join(PROJECT_DIR, "logo")
+    for name in sorted(os.listdir(logo_dir), key=logo_number):
+        if name.endswith(".pbm"):
+            width, height, data = read_pbm(os.path.join(logo_dir, name))
+            images.append((name[:-4], width, height, assets.LOGO_FORMAT, data))
+    for name, width, height, data in read_icons(os.path.join(PROJECT_DIR, "icons.py")):
+        images.append((name, width, height, assets.ICON_FORMAT, data))
+
+    offset = assets.HEADER_SIZE + assets.ENTRY_SIZE * len(images)
+    with open(out_file, "wb") as out:
+        out.write(struct.pack(assets.HEADER_FMT, assets.ASSETS_MAGIC, len(images)))
+        for name, width, height, fmt, data in images:
+            if len(name) > 12:
+                raise ValueError("asset name too long: " + name)
+            out.write(
+                struct.pack(
+                    assets.ENTRY_FMT, name.encode(), width, height, fmt, offset, len(data)
+                )
+            )
+            offset += len(data)
+        for image in images:
+            out.write(image[-1])
+    return len(images)
+
+
+def build(out_dir, compile_mpy=True):
+    command = mpy_cross() if compile_mpy else None
+    if compile_mpy and command is None:
+        sys.exit("mpy-cross not found, install it (pip install mpy-cross) or use --no-mpy")
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    modules = 0
+    for name in sorted(os.listdir(PROJECT_DIR)):
+        src = os.path.join(PROJECT_DIR, name)
+        if os.path.isdir(src):  # logo/ goes into the bundle, __pycache__ is the host's
+            continue
+        if not name.endswith(".py"):
+            shutil.copy(src, out_dir)  # settings and credentials
+        elif command is None:
+            shutil.copy(src, out_dir)
+            modules += 1
+        else:
+            target = os.path.join(out_dir, name[:-3] + ".mpy")
+            subprocess.run(command + ["-march=armv6m", "-o", target, src], check=True)
+            modules += 1
+    with open(os.path.join(out_dir, "main.py"), "w") as file:
+        file.write(MAIN)
+    images = pack_assets(os.path.join(out_dir, assets.ASSETS_FILE))
+
+    size = os.path.getsize(os.path.join(out_dir, assets.ASSETS_FILE))
+    kind = ".mpy" if command else "source"
+    print(f"{out_dir}: {modules} {kind} modules, {images} images in {assets.ASSETS_FILE} ({size} B)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the device image")
+    parser.add_argument("--out", default=os.path.join(TOOLS_DIR, "..", "build"))
+    parser.add_argument("--no-mpy", action="store_true", help="copy sources, don't compile")
+    args = parser.parse_args()
+    build(os.path.abspath(args.out), not args.no_mpy)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+# Regression checks for the firmware, run on the host HAL like simulate.py.
+# Each check_* function sets up its own simulated device and raises
+# AssertionError (or whatever the firmware raised) when something's wrong.
+#
+# usage: python tools/checks.py [name ...]   (default: all checks)
+
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import runpy
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import simulate  # sets up sys.path for the HAL and the project
+import sim
+
+FLAT_LEVEL = 30000  # ADC value of a sensor lying on the table
+
+
+def run_menu(values, events, until_s, setup=None, rate_hz=250):
+    # -> serial output of the menu run. setup() runs once the HAL is in
+    # place, before the menu is imported. In the duration menu a cw step
+    # goes down the list: cw picks 5 min, cwx2 24 h.
+    simulate.install(values, rate_hz, root=simulate.device_root(), loop=True)
+    if setup is not None:
+        setup()
+    sim.clock.limit_us = until_s * 1000000
+    simulate.schedule_events(events)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            runpy.run_path(os.path.join(simulate.PROJECT_DIR, "menu.py"), run_name="__main__")
+        except sim.SimulationEnd:
+            pass
+    return output.getvalue()
+
+
+def check_flat_recording_5_min():
+    # A flat signal gives no RRIs, the menu has to say so instead of crashing
+    output = run_menu([FLAT_LEVEL] * 1000, "3000:cwx4,3500:press,4000:cw,5000:press", 320)
+    assert "not enough RRIs to analyze" in output, output
+    assert "Data analyzed" not in output, output
+
+
+def check_flat_recording_24_h():
+    # Same through the 24 h option, shortened so it runs in seconds
+    long_term_s = None
+
+    def shorten():
+        nonlocal long_term_s
+        import data_processor
+
+        long_term_s = data_processor.LONG_TERM_S
+        data_processor.LONG_TERM_S = 20  # menu imports it from here
+
+    try:
+        output = run_menu(
+            [FLAT_LEVEL] * 1000, "3000:cwx4,3500:press,4000:cwx2,5000:press", 40, shorten
+        )
+    finally:
+        if long_term_s is not None:
+            sys.modules["data_processor"].LONG_TERM_S = long_term_s
+    assert "not enough RRIs to analyze" in output, output
+    assert "Data analyzed" not in output, output
+
+
+def synthetic_rris(count, seed=1):
+    # Resting RRIs in ms with breathing (0.25 Hz) and slower (0.1 Hz) modulation
+    rng = random.Random(seed)
+    rris = []
+    t = 0
+    for _ in range(count):
+        rri = round(
+            900 + 40 * math.sin(2 * math.pi * 0.25 * t) + 30 * math.sin(2 * math.pi * 0.1 * t)
+            + rng.gauss(0, 15)
+        )
+        rris.append(rri)
+        t += rri / 1000
+    return rris
+
+
+def check_batch_rri_matches_stream():
+    # batch_rri's NumPy RRI detection gives the same RRIs as the firmware's
+    # DataProcessor fed the same capture, also for a flat one with no beats
+    import batch_rri
+    import synth_ppg
+
+    for seed in (1, 2, 3):
+        samples = synth_ppg.ppg(60, seed=seed)
+        assert len(batch_rri.process(samples)) > 0, seed
+        assert batch_rri.verify(samples), (
+            seed, batch_rri.process(samples), batch_rri.stream_rris(samples)
+        )
+    assert batch_rri.verify([FLAT_LEVEL] * 2500)
+
+
+def check_batch_hrv_matches_firmware():
+    # Past MAX_SPECTRAL_RRIS the firmware only uses the latest RRIs for LF/HF,
+    # batch_hrv has to give the same numbers. Its LF/HF is NumPy in float64,
+    # the firmware keeps beat times and sin/cos in float32 arrays.
+    import batch_hrv
+    import hrv_analysis
+
+    for count in (50, 600, 2000):
+        for seed in (1, 2, 3):
+            rris = synthetic_rris(count, seed)
+            hrv = hrv_analysis.HrvAnalysis(rris)
+            hrv.analyze(rris)
+            firmware = json.loads(hrv.get_analysis())
+            batch = batch_hrv.hrv_metrics(rris)
+            for key, value in firmware.items():
+                rel_tol = 1e-4 if key in ("lf", "hf", "lf_hf") else 1e-6
+                assert math.isclose(batch[key], value, rel_tol=rel_tol, abs_tol=1e-9), (
+                    count, seed, key, batch[key], value
+                )
+
+
+def run_sync(url, recordings, until_s, save=None):
+    # -> (KubiosSync, wall clock seconds of each step) after syncing the
+    # recordings to the Kubios at url, or until_s of virtual time. save(results)
+    # stands in for saving to history.
+    simulate.install(root=simulate.device_root())
+    simulate.use_kubios(url, os.getcwd())
+    import cloudconnection
+    from outbox import Outbox
+    from scheduler import Scheduler
+
+    cloudconnection.session = None  # left over from an earlier check
+    outbox = Outbox()
+    for rris in recordings:
+        outbox.append(rris)
+    loop = Scheduler()
+    saved = []
+
+    def on_result(results):  # the recording is still in the outbox until this returns
+        if save is not None:
+            save(results)
+        saved.append(results)
+        if len(saved) == len(recordings):
+            loop.stop()
+
+    sync = cloudconnection.KubiosSync(outbox, on_result)
+    steps = []
+    step = sync.step
+
+    def timed_step():
+        begin = time.perf_counter()
+        step()
+        steps.append(time.perf_counter() - begin)
+
+    sync.step = timed_step
+    loop.every(cloudconnection.SYNC_POLL_MS, sync.poll)
+    sim.clock.limit_us = until_s * 1000000
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            loop.run()
+        except sim.SimulationEnd:
+            pass
+    return sync, steps
+
+
+def check_kubios_sync_steps():
+    # Uploads are spread over many short polls instead of blocking the UI
+    # for a whole request
+    import kubios_mock
+
+    mock = kubios_mock.serve()
+    try:
+        sync, steps = run_sync(mock.url, [synthetic_rris(2000, seed) for seed in range(3)], 60)
+    finally:
+        mock.shutdown()
+    assert not len(sync.outbox), sync.error
+    assert mock.counts["analyze"] == 3, mock.counts
+    assert len(steps) > 3 * 20, len(steps)
+    assert max(steps) < 0.1, max(steps)
+
+
+def check_kubios_sync_stalled_server():
+    # A server that never answers fails the upload after httpstream.TIMEOUT_S
+    # and the recording is kept for a retry
+    import httpstream
+
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)  # connections complete in the backlog, nothing is read
+    try:
+        url = "http://127.0.0.1:%d" % server.getsockname()[1]
+        sync, steps = run_sync(url, [synthetic_rris(100)], httpstream.TIMEOUT_S + 5)
+    finally:
+        server.close()
+    assert len(sync.outbox) == 1
+    assert sync.error == "Timed out" and sync.retry_at is not None, sync.error
+    assert max(steps) < 0.1, max(steps)
+
+
+def check_kubios_result_not_lost():
+    # A result that can't be saved keeps its recording in the outbox, the
+    # upload is retried and the menu doesn't crash
+    import kubios_mock
+
+    failures = [OSError("history.bin is damaged"), ValueError("unknown history file format")]
+
+    def save(results):
+        if failures:
+            raise failures.pop(0)
+
+    mock = kubios_mock.serve()
+    try:
+        sync, _ = run_sync(mock.url, [synthetic_rris(100)], 60, save)
+    finally:
+        mock.shutdown()
+    assert not failures
+    assert not len(sync.outbox), sync.error
+    assert mock.counts["analyze"] == 3, mock.counts
+
+
+def check_dns_lookup_in_steps():
+    # Host names are looked up with non-blocking queries once the link knows
+    # a DNS server, the upload goes to the address in the answer
+    import httpstream
+    import kubios_mock
+
+    dns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dns.bind(("127.0.0.1", 0))
+    queries = []
+
+    def answer():
+        while True:
+            try:
+                query, client = dns.recvfrom(512)
+            except OSError:  # closed
+                return
+            queries.append(query)
+            header = query[:2] + struct.pack(">HHHHH", 0x8180, 1, 1, 0, 0)
+            record = b"\xc0\x0c" + struct.pack(">HHIH", 1, 1, 60, 4) + bytes([127, 0, 0, 1])
+            dns.sendto(header + query[12:] + record, client)
+
+    threading.Thread(target=answer, daemon=True).start()
+    mock = kubios_mock.serve()
+    server = dns.getsockname()
+    link_connected = None
+    try:
+        import cloudconnection
+
+        link_connected = cloudconnection.WlanLink.connected
+
+        def connected(link):  # the simulated access point gives no DNS server
+            link_connected(link)
+            httpstream.dns_server = server
+
+        cloudconnection.WlanLink.connected = connected
+        httpstream.addresses.clear()
+        url = "http://kubios.test:%d" % mock.server_address[1]
+        sync, steps = run_sync(url, [synthetic_rris(100)] * 2, 60)
+    finally:
+        if link_connected is not None:
+            cloudconnection.WlanLink.connected = link_connected
+        httpstream.dns_server = None
+        mock.shutdown()
+        dns.close()
+    assert not len(sync.outbox), sync.error
+    assert len(queries) == 1, queries  # looked up once for the token and both uploads
+    assert httpstream.addresses.pop("kubios.test") == "127.0.0.1"
+    assert max(steps) < 0.1, max(steps)
+
+
+def record_rris(rate_hz, block_capture, duration_s=10):
+    # -> RRIs of a timed recording of a synthetic capture
+    import synth_ppg
+
+    simulate.install(synth_ppg.ppg(20, rate_hz=rate_hz), rate_hz, root=simulate.device_root())
+    from data_processor import record_heart_rate
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        rris, hrv = record_heart_rate(
+            simulate.Encoder(), simulate.Screen(), duration_s, False, block_capture
+        )
+    return list(rris)
+
+
+def check_block_capture_timed():
+    # A timed recording from DMA blocks hands the pipeline at most a BLOCK of
+    # samples at a time, even with more than that left before the stop. The
+    # 12 bit DMA samples are scaled like read_u16's, so the beats before the
+    # first threshold update are found too, the same ones the timer path finds.
+    blocks = record_rris(1000, True)
+    timer = record_rris(250, False)
+    assert len(blocks) == len(timer), (blocks, timer)
+    for block_rri, timer_rri in zip(blocks, timer):
+        assert abs(block_rri - timer_rri) <= 4, (blocks, timer)  # 1 ms vs 4 ms samples
+
+
+def check_core1_failure_stops():
+    # An exception on core 1 still lets core 0 stop the recording
+    simulate.install(root=simulate.device_root())
+    from dual_core import DualCoreProcessor
+
+    class Failing(DualCoreProcessor):
+        def read_sensor(self, _):
+            if self.ms_count >= 1000:
+                raise MemoryError("core 1")
+            super().read_sensor(_)
+
+    sim.clock.limit_us = 10 * 1000000  # a stop() that never returns ends here
+    try:
+        processor = Failing(100, 4)
+        while True:
+            time.sleep_ms(10)  # the HAL's, simulate.install() adds it
+    except MemoryError:  # the HAL raises core 1's exception on core 0
+        pass
+    assert processor.stop() is True
+    assert processor.stopped
+
+
+def check_bpm_first_beat():
+    # The BPM view's detector starts as if the sample before the first one
+    # was far above the threshold: a signal that starts high isn't a beat,
+    # the first interval is counted from the start of the signal
+    simulate.install(root=simulate.device_root())
+    from array import array
+    from measureHR import bpmCalc
+    from pipeline import BLOCK
+
+    bpm = bpmCalc(simulate.Screen())
+    bpm.tmr.deinit()
+    signal = [40000] * 100 + ([30000] * 50 + [40000] * 150) * 3
+    block = array("i", [0] * BLOCK)
+    ppis = []
+    for start in range(0, len(signal), BLOCK):
+        count = min(BLOCK, len(signal) - start)
+        block[:count] = array("i", signal[start : start + count])
+        count = bpm.beats.push_block(block, count)
+        ppis += block[:count]
+    assert ppis == [603, 800], ppis  # 601 when the start counted as a crossing
+
+
+def check_corrupt_outbox():
+    # A damaged outbox.bin is set aside and the device boots with an empty queue
+    import outbox
+
+    good = struct.pack(outbox.HEADER_FMT, outbox.OUTBOX_MAGIC, outbox.HEADER_SIZE, 30, 1)
+    damaged = {
+        "empty": b"",
+        "truncated header": good[:7],
+        "wrong magic": b"JUNK" + good[4:],
+        "truncated recording": good + struct.pack(outbox.ENTRY_FMT, 5) + b"\0\3",
+        "garbage": bytes(range(200)),
+    }
+    for name, contents in damaged.items():
+        path = os.path.join(tempfile.mkdtemp(prefix="hrm-check-"), "outbox.bin")
+        with open(path, "wb") as file:
+            file.write(contents)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            box = outbox.Outbox(path)
+        assert len(box) == 0, name
+        assert "Outbox unreadable" in output.getvalue(), name
+        with open(path + ".bad", "rb") as file:
+            assert file.read() == contents, name
+        box.append([800, 810, 790])
+        assert list(outbox.Outbox(path).oldest()) == [800, 810, 790], name
+
+
+def check_interrupted_history_migration():
+    # history.txt is migrated again on the next boot if the first attempt
+    # was cut short, nothing is lost or duplicated
+    simulate.install(root=simulate.device_root())
+    import history
+
+    record = '{"timestamp": "2024-04-28T18:58:19", "mean_hr": 60.5, "mean_ppi": 991, '
+    record += '"rmssd": 50.1, "sdnn": 40.2, "sns": 0.31, "pns": -0.2}\n'
+    with open(history.OLD_HISTORY_FILE, "w") as file:
+        file.write(record * 3)
+
+    class PowerCut(Exception):
+        pass
+
+    def cut(self, results):
+        if self.count == 2:
+            raise PowerCut
+        append(self, results)
+
+    append = history.HistoryStore.append
+    history.HistoryStore.append = cut
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            history.HistoryStore()
+    except PowerCut:
+        pass
+    finally:
+        history.HistoryStore.append = append
+    assert not history.file_exists(history.HISTORY_FILE)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        store = history.HistoryStore()
+    assert store.count == 3, store.count
+    assert store.read(2)["mean_hr"] == 60.5, store.read(2)
+    assert history.file_exists(history.OLD_HISTORY_FILE + ".migrated")
+    assert not history.file_exists(history.HISTORY_FILE + ".tmp")
+
+
+def check_new_recording_keeps_the_last():
+    # Starting a recording (and maybe interrupting it) leaves the RRIs of the
+    # last complete one readable, e.g. for queueing it to Kubios
+    simulate.install(root=simulate.device_root())
+    from rri_store import RriStore
+
+    rris = synthetic_rris(300)
+    last = RriStore()
+    for rri in rris:
+        last.append(rri)
+    last.finish()
+    new = RriStore()
+    for rri in synthetic_rris(200, seed=2):
+        new.append(rri)
+    assert list(last) == rris
+    assert [last[idx] for idx in (0, 200, 10, 299, 130)] == [rris[idx] for idx in (0, 200, 10, 299, 130)]
+
+
+def check_interrupted_recording_not_sent():
+    # After an interrupted recording there's nothing for Kubios, the RRIs of
+    # the one before it aren't sent in its place
+    events = "3000:cwx4,3500:press,4000:cw,5000:press,310000:press,"
+    events += "312000:press,314000:press,320000:press,325000:cwx4,327000:press"
+    output = run_menu(None, events, 335)
+    assert "recording interrupted" in output, output
+    assert "Kubios selected" not in output, output
+
+
+def main():
+    checks = {
+        name[len("check_") :]: check
+        for name, check in globals().items()
+        if name.startswith("check_")
+    }
+    selected = sys.argv[1:] or list(checks)
+    failed = 0
+    for name in selected:
+        try:
+            checks[name]()
+            print(f"ok    {name}")
+        except Exception:
+            failed += 1
+            print(f"FAIL  {name}")
+            traceback.print_exc()
+    if failed:
+        sys.exit(f"{failed} of {len(selected)} checks failed")
+
+
+if __name__ == "__main__":
+    main()
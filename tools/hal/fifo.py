@@ -0,0 +1,43 @@
+# Host copy of pico-test's Fifo. Polling an empty Fifo costs virtual CPU
+# time so that the firmware's busy loops let the clock move forward.
+from array import array
+import sim
+
+
+class Fifo:
+    def __init__(self, size, typecode="H"):
+        self.data = array(typecode)
+        for i in range(size):
+            self.data.append(0)
+        self.head = 0
+        self.tail = 0
+        self.size = size
+        self.dc = 0
+
+    def put(self, value):
+        nh = (self.head + 1) % self.size
+        if nh != self.tail:
+            self.data[self.head] = value
+            self.head = nh
+        else:
+            self.dc += 1
+
+    def get(self):
+        val = self.data[self.tail]
+        self.tail = (self.tail + 1) % self.size
+        return val
+
+    def dropped(self):
+        return self.dc
+
+    def has_data(self):
+        if self.head == self.tail:
+            sim.clock.poll()
+            return False
+        return True
+
+    def empty(self):
+        if self.head == self.tail:
+            sim.clock.poll()
+            return True
+        return False
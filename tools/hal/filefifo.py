@@ -0,0 +1,20 @@
+# Host copy of pico-test's Filefifo, serves values from a capture file
+from fifo import Fifo
+
+
+class Filefifo(Fifo):
+    def __init__(self, size, typecode="i", name="data.txt", repeat=True):
+        super().__init__(size, typecode)
+        self.name = name
+        self.repeat = repeat
+        self.file = open(name, "r")
+
+    def get(self):
+        line = self.file.readline()
+        if not line and self.repeat:
+            self.file.seek(0)
+            line = self.file.readline()
+        return int(line)
+
+    def has_data(self):
+        return True
@@ -0,0 +1,166 @@
+# Host stand-in for MicroPython's framebuf, enough of it for the firmware's
+# drawing calls. Text uses placeholder glyphs, pixel-exact fonts aren't
+# needed to exercise or time the UI. Every call adds a rough estimate of
+# what it costs on the RP2040 to the virtual clock.
+import sim
+
+MONO_VLSB = 0
+MONO_HLSB = 3
+MONO_HMSB = 4
+
+CALL_NS = 5000  # interpreter overhead of one method call
+PIXEL_NS = 100  # per pixel touched in C
+
+
+class FrameBuffer:
+    def __init__(self, buffer, width, height, format, stride=None):
+        self.buffer = buffer
+        self.width = width
+        self.height = height
+        self.format = format
+        self.stride = width if stride is None else stride
+        if format != MONO_VLSB:
+            self.stride = (self.stride + 7) & ~7
+
+    def _index(self, x, y):
+        if self.format == MONO_VLSB:
+            return (y >> 3) * self.stride + x, y & 7
+        if self.format == MONO_HLSB:
+            return (y * self.stride + x) >> 3, 7 - (x & 7)
+        return (y * self.stride + x) >> 3, x & 7
+
+    def pixel(self, x, y, c=None):
+        sim.clock.cpu(CALL_NS)
+        return self._pixel(x, y, c)
+
+    def _pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        idx, bit = self._index(x, y)
+        if c is None:
+            return (self.buffer[idx] >> bit) & 1
+        if c:
+            self.buffer[idx] |= 1 << bit
+        else:
+            self.buffer[idx] &= ~(1 << bit) & 0xFF
+
+    def fill(self, c):
+        sim.clock.cpu(CALL_NS + len(self.buffer) * 8)
+        byte = 0xFF if c else 0x00
+        self.buffer[:] = bytes([byte]) * len(self.buffer)
+
+    def fill_rect(self, x, y, w, h, c):
+        sim.clock.cpu(CALL_NS + max(w, 0) * max(h, 0) * PIXEL_NS)
+        self._fill_rect(x, y, w, h, c)
+
+    def _fill_rect(self, x, y, w, h, c):
+        x0 = max(x, 0)
+        x1 = min(x + w, self.width)
+        y0 = max(y, 0)
+        y1 = min(y + h, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        if self.format == MONO_VLSB:  # a byte op per column and page instead of per pixel
+            buf = self.buffer
+            for page in range(y0 >> 3, ((y1 - 1) >> 3) + 1):
+                top = max(y0 - page * 8, 0)
+                bottom = min(y1 - page * 8, 8)
+                mask = ((1 << bottom) - 1) & ~((1 << top) - 1)
+                start = page * self.stride
+                if c:
+                    for i in range(start + x0, start + x1):
+                        buf[i] |= mask
+                else:
+                    mask = ~mask & 0xFF
+                    for i in range(start + x0, start + x1):
+                        buf[i] &= mask
+            return
+        for yy in range(y0, y1):
+            for xx in range(x0, x1):
+                self._pixel(xx, yy, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        sim.clock.cpu(CALL_NS + 2 * (w + h) * PIXEL_NS)
+        if f:
+            self._fill_rect(x, y, w, h, c)
+            return
+        self._fill_rect(x, y, w, 1, c)
+        self._fill_rect(x, y + h - 1, w, 1, c)
+        self._fill_rect(x, y, 1, h, c)
+        self._fill_rect(x + w - 1, y, 1, h, c)
+
+    def line(self, x1, y1, x2, y2, c):  # Bresenham
+        sim.clock.cpu(CALL_NS + (abs(x2 - x1) + abs(y2 - y1)) * PIXEL_NS)
+        dx = abs(x2 - x1)
+        dy = -abs(y2 - y1)
+        sx = 1 if x1 < x2 else -1
+        sy = 1 if y1 < y2 else -1
+        err = dx + dy
+        while True:
+            self._pixel(x1, y1, c)
+            if x1 == x2 and y1 == y2:
+                return
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x1 += sx
+            if e2 <= dx:
+                err += dx
+                y1 += sy
+
+    def ellipse(self, x, y, xr, yr, c, f=False, m=0b1111):
+        # m selects quadrants: bit 0 top right, 1 top left, 2 bottom left, 3 bottom right
+        sim.clock.cpu(CALL_NS + (4 * xr * yr if f else 4 * (xr + yr)) * PIXEL_NS)
+
+        def half_width(dy):
+            return int((xr * xr * (1 - (dy * dy) / (yr * yr))) ** 0.5) if yr else xr
+
+        def span(x0, x1, dy):  # columns x0..x1 out from the centre (0 <= x0 <= x1), both halves
+            top = dy <= 0
+            bottom = dy >= 0
+            if (top and m & 0b0001) or (bottom and m & 0b1000):
+                self._fill_rect(x + x0, y + dy, x1 - x0 + 1, 1, c)
+            if (top and m & 0b0010) or (bottom and m & 0b0100):
+                self._fill_rect(x - x1, y + dy, x1 - x0 + 1, 1, c)
+
+        for dy in range(-yr, yr + 1):
+            w = half_width(dy)
+            if f:
+                span(0, w, dy)
+                continue
+            # outline: edge pixels plus the run down to the next row's width
+            inner = min(w, half_width(dy + 1 if dy < 0 else dy - 1) + 1) if dy else w
+            span(inner, w, dy)
+
+    def text(self, s, x, y, c=1):
+        sim.clock.cpu(CALL_NS + len(s) * 64 * PIXEL_NS)
+        for n, char in enumerate(s):
+            if char == " ":
+                continue
+            pattern = (ord(char) * 2654435761) & 0xFFFFFFFFFFFF
+            for row in range(1, 7):
+                bits = (pattern >> (row * 6)) & 0x3F | 0x21
+                for col in range(6):
+                    if bits & (1 << col):
+                        self._pixel(x + n * 8 + col + 1, y + row, c)
+
+    def blit(self, fbuf, x, y, key=-1, palette=None):
+        sim.clock.cpu(CALL_NS + fbuf.width * fbuf.height * PIXEL_NS)
+        for yy in range(fbuf.height):
+            for xx in range(fbuf.width):
+                c = fbuf._pixel(xx, yy)
+                if c != key:
+                    self._pixel(x + xx, y + yy, c)
+
+    def scroll(self, xstep, ystep):
+        sim.clock.cpu(CALL_NS + self.width * self.height * PIXEL_NS)
+        old = FrameBuffer(bytearray(self.buffer), self.width, self.height, self.format, self.stride)
+        for yy in range(self.height):
+            for xx in range(self.width):
+                self._pixel(xx, yy, old._pixel(xx - xstep, yy - ystep) or 0)
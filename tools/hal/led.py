@@ -0,0 +1,27 @@
+# Host copy of pico-test's Led
+from machine import Pin, PWM
+
+
+class Led:
+    def __init__(self, pin, mode=Pin.OUT, brightness=1):
+        self.pin = Pin(pin, mode)
+        self.pwm = PWM(self.pin)
+        self.brightness = brightness
+        self.state = 0
+
+    def on(self):
+        self.state = 1
+
+    def off(self):
+        self.state = 0
+
+    def toggle(self):
+        self.state ^= 1
+
+    def value(self, state=None):
+        if state is None:
+            return self.state
+        self.state = state
+
+    def __call__(self, state=None):
+        return self.value(state)
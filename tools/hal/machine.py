@@ -0,0 +1,200 @@
+# Host stand-in for MicroPython's machine module, see sim.py
+import sim
+
+
+def idle():  # nothing to do until the next interrupt
+    sim.clock.idle()
+
+
+def lightsleep(ms=None):
+    sim.clock.advance((ms or 0) * 1000)
+
+
+def freq(hz=None):
+    return 125000000
+
+
+def reset():
+    raise sim.SimulationEnd("machine.reset()")
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=IN, pull=None, value=None):
+        self.id = id
+        self.mode = mode
+        self.level = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            self.level = value
+        self.handler = None
+        self.trigger = 0
+        sim.pins[id] = self
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self.handler = handler
+        self.trigger = trigger
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+        self.level = level
+
+    def __call__(self, level=None):
+        return self.value(level)
+
+    def on(self):
+        self.level = 1
+
+    def off(self):
+        self.level = 0
+
+    def toggle(self):
+        self.level ^= 1
+
+    def inject(self, level):  # drive the pin from outside, fires the IRQ like hardware would
+        old = self.level
+        self.level = level
+        if self.handler is None:
+            return
+        if (old == 1 and level == 0 and self.trigger & Pin.IRQ_FALLING) or (
+            old == 0 and level == 1 and self.trigger & Pin.IRQ_RISING
+        ):
+            self.handler(self)
+
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin.id if isinstance(pin, Pin) else pin
+
+    def read_u16(self):
+        return sim.adc_value(self.pin, sim.clock.now_us)
+
+
+# Register access. Only the ADC's free-running mode is modelled: START_MANY
+# in CS starts conversions every DIV + 1 cycles of the 48 MHz ADC clock,
+# which a DMA channel paced by DREQ_ADC (see rp2.py) reads from the FIFO.
+ADC_CS = 0x4004C000
+ADC_FCS = 0x4004C008
+ADC_FIFO = 0x4004C00C
+ADC_DIV = 0x4004C010
+ADC_CLOCK_HZ = 48000000
+
+
+class Mem32:
+    def __getitem__(self, addr):  # DMA takes conversions as they're made, FIFO stays empty
+        if addr == ADC_FIFO:
+            return 0
+        if addr == ADC_FCS:
+            return sim.registers.get(addr, 0) & ~(0xF << 16)  # LEVEL
+        return sim.registers.get(addr, 0)
+
+    def __setitem__(self, addr, value):
+        sim.registers[addr] = value & 0xFFFFFFFF
+        if addr == ADC_CS:
+            if value & (1 << 3):
+                start_free_running(26 + ((value >> 12) & 7))
+            else:
+                stop_free_running()
+
+
+mem32 = Mem32()
+
+
+def start_free_running(pin):
+    state = sim.free_running
+    div = sim.registers.get(ADC_DIV, 0) >> 8
+    state["period_us"] = max((div + 1) * 1000000 // ADC_CLOCK_HZ, 2)  # 500 kS/s at most
+    state["next_us"] = sim.clock.now_us + state["period_us"]
+    state["pin"] = pin
+    state["on"] = True
+    for dma in sim.dma_channels:
+        if dma is not None:
+            dma.adc_started()
+
+
+def stop_free_running():
+    sim.free_running["on"] = False
+    for dma in sim.dma_channels:
+        if dma is not None:
+            dma.adc_stopped()
+
+
+class I2C:
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.freq = freq
+
+    def writeto(self, addr, buf, stop=True):
+        self.transfer(len(buf))
+
+    def writevto(self, addr, bufs, stop=True):
+        self.transfer(sum(len(buf) for buf in bufs))
+
+    def transfer(self, nbytes):  # 9 clocks per byte with the ack bit, plus address byte
+        sim.stats["i2c_bytes"] += nbytes
+        sim.clock.advance((nbytes + 1) * 9 * 1000000 // self.freq)
+
+
+class PWM:
+    def __init__(self, pin, freq=1000, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+
+    def deinit(self):
+        pass
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self.entry = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self.deinit()
+        if freq > 0:
+            period = 1000 // freq
+        period_us = period * 1000
+        self.entry = sim.clock.schedule(
+            sim.clock.now_us + period_us,
+            lambda: callback(self),
+            period_us if mode == Timer.PERIODIC else 0,
+        )
+
+    def deinit(self):
+        if self.entry is not None:
+            sim.clock.cancel(self.entry)
+            self.entry = None
+
+
+class UART:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def write(self, buf):
+        return len(buf)
+
+    def read(self, nbytes=None):
+        return None
+
+    def any(self):
+        return 0
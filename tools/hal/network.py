@@ -0,0 +1,53 @@
+# Host stand-in for MicroPython's network module. The simulated access
+# point accepts sim_ssid/sim_password after connect_delay_ms of virtual time.
+import sim
+
+STA_IF = 0
+AP_IF = 1
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+sim_ssid = None  # None accepts any network
+sim_password = None
+connect_delay_ms = 2000
+
+
+class WLAN:
+    _status = STAT_IDLE  # shared like the one radio on the board
+    _connected_at = None
+
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = state
+
+    def connect(self, ssid=None, key=None):
+        if sim_ssid is not None and ssid != sim_ssid:
+            WLAN._status = STAT_NO_AP_FOUND
+        elif sim_password is not None and key != sim_password:
+            WLAN._status = STAT_WRONG_PASSWORD
+        else:
+            WLAN._status = STAT_CONNECTING
+            WLAN._connected_at = sim.clock.now_us + connect_delay_ms * 1000
+
+    def disconnect(self):
+        WLAN._status = STAT_IDLE
+
+    def status(self, param=None):
+        if WLAN._status == STAT_CONNECTING and sim.clock.now_us >= WLAN._connected_at:
+            WLAN._status = STAT_GOT_IP
+        return WLAN._status
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self, config=None):  # no DNS server, the firmware leaves names to the host
+        return ("192.168.4.2", "255.255.255.0", "192.168.4.1", "0.0.0.0")
@@ -0,0 +1,23 @@
+# Host stand-in for pico-test's Piotimer, driven by the virtual clock
+import sim
+
+
+class Piotimer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, mode=PERIODIC, freq=-1, period=-1, callback=None, sm_id=0):
+        if freq > 0:
+            period_us = 1000000 // freq
+        else:
+            period_us = period * 1000
+        self.entry = sim.clock.schedule(
+            sim.clock.now_us + period_us,
+            lambda: callback(self),
+            period_us if mode == Piotimer.PERIODIC else 0,
+        )
+
+    def deinit(self):
+        if self.entry is not None:
+            sim.clock.cancel(self.entry)
+            self.entry = None
@@ -0,0 +1,129 @@
+# Host stand-in for MicroPython's rp2 module, only DMA is provided. Channels
+# paced by DREQ_ADC read the free-running ADC modelled in machine.py: a
+# transfer of count samples completes when the last conversion is made, the
+# buffer is filled with the capture's values at each conversion time, then
+# chain_to is triggered and the IRQ handler runs.
+import sim
+
+DREQ_ADC = 36
+CHANNELS = 12
+
+
+class DMA:
+    def __init__(self):
+        if None in sim.dma_channels:
+            self.channel = sim.dma_channels.index(None)
+            sim.dma_channels[self.channel] = self
+        elif len(sim.dma_channels) < CHANNELS:
+            self.channel = len(sim.dma_channels)
+            sim.dma_channels.append(self)
+        else:
+            raise OSError("no free DMA channel")
+        self.read = 0
+        self.write = None
+        self.count = 0
+        self.ctrl = 0
+        self.handler = None
+        self.entry = None  # completion event while a transfer is running
+
+    @staticmethod
+    def pack_ctrl(
+        default=None,
+        enable=True,
+        high_pri=False,
+        size=2,
+        inc_read=True,
+        inc_write=True,
+        ring_size=0,
+        ring_sel=False,
+        chain_to=None,
+        treq_sel=0x3F,
+        irq_quiet=True,
+        bswap=False,
+        sniff_en=False,
+    ):
+        # bit layout of CHx_CTRL_TRIG, chain_to None means this channel (set in config)
+        return (
+            enable
+            | high_pri << 1
+            | size << 2
+            | inc_read << 4
+            | inc_write << 5
+            | ring_size << 6
+            | ring_sel << 10
+            | (0xF if chain_to is None else chain_to) << 11
+            | treq_sel << 15
+            | irq_quiet << 21
+            | bswap << 22
+            | sniff_en << 23
+        )
+
+    waiting = False  # triggered, waiting for the ADC to start converting
+
+    def config(self, read=None, write=None, count=None, ctrl=None, trigger=False):
+        if read is not None:
+            self.read = read
+        if write is not None:
+            self.write = write
+        if count is not None:
+            self.count = count
+        if ctrl is not None:
+            self.ctrl = ctrl
+        if trigger:
+            self.active(1)
+
+    def irq(self, handler=None, hard=False):
+        self.handler = handler
+
+    def active(self, value=None):
+        if value is None:
+            return self.entry is not None or self.waiting
+        if value:
+            self.waiting = True
+            self.adc_started()
+        else:
+            self.waiting = False
+            self.cancel()
+
+    def adc_started(self):
+        if not self.waiting or not sim.free_running["on"] or self.entry is not None:
+            return
+        if (self.ctrl >> 15) & 0x3F != DREQ_ADC:
+            raise NotImplementedError("only transfers paced by DREQ_ADC are simulated")
+        self.waiting = False
+        state = sim.free_running
+        first_us = state["next_us"]
+        period_us = state["period_us"]
+        count = self.count
+        state["next_us"] = first_us + count * period_us  # conversions this channel takes
+        last_us = first_us + (count - 1) * period_us
+        self.entry = sim.clock.schedule(
+            last_us, lambda: self.complete(first_us, period_us, count, state["pin"])
+        )
+
+    def adc_stopped(self):
+        if self.entry is not None:  # unfinished transfer waits for the ADC again
+            self.cancel()
+            self.waiting = True
+
+    def cancel(self):
+        if self.entry is not None:
+            sim.clock.cancel(self.entry)
+            self.entry = None
+
+    def complete(self, first_us, period_us, count, pin):
+        self.entry = None
+        buffer = self.write
+        for i in range(count):  # ADC FIFO holds 12 bit results
+            buffer[i] = sim.adc_value(pin, first_us + i * period_us) >> 4
+        chain_to = (self.ctrl >> 11) & 0xF
+        if chain_to != self.channel and chain_to < len(sim.dma_channels):
+            sim.dma_channels[chain_to].active(1)
+        if not (self.ctrl >> 21) & 1 and self.handler is not None:
+            self.handler(self)
+
+    def close(self):
+        self.cancel()
+        self.waiting = False
+        self.handler = None
+        sim.dma_channels[self.channel] = None
@@ -0,0 +1,255 @@
+# Virtual clock and simulation state shared by the host HAL modules.
+# Nothing here runs in real time: the clock only moves when the firmware
+# sleeps, pushes a frame over I2C or polls an empty Fifo, and every timer
+# or scripted IRQ that falls inside that step fires in order.
+
+import _thread
+import gc
+import heapq
+import threading
+import time as _time
+import tracemalloc
+
+
+class SimulationEnd(Exception):  # raised from the clock when the run is over
+    pass
+
+
+class Clock:
+    def __init__(self):
+        self.now_us = 0
+        self.limit_us = None  # stop the simulation at this virtual time
+        self.poll_us = 50  # cost of one poll of an empty Fifo (busy loop iteration)
+        self._cpu_ns = 0  # modelled CPU time not yet added to the clock
+        self._queue = []  # (due_us, seq, callback, period_us)
+        self._seq = 0
+        self.core1 = Core1(self)
+
+    def schedule(self, due_us, callback, period_us=0):
+        self._seq += 1
+        entry = [due_us, self._seq, callback, period_us]
+        heapq.heappush(self._queue, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None  # lazily dropped when it comes up
+
+    def advance(self, us):
+        if self.core1.current():  # core 1 waits for the virtual clock to get there
+            self.core1.wait_until(self.now_us + int(us))
+            return
+        target = self.now_us + int(us)
+        while self._queue and self._queue[0][0] <= target:
+            entry = heapq.heappop(self._queue)
+            due, _, callback, period = entry
+            if callback is None:
+                continue
+            self._check_limit(due)
+            self.now_us = max(self.now_us, due)
+            if period:
+                entry[0] = due + period
+                heapq.heappush(self._queue, entry)
+            callback()
+        self._check_limit(target)
+        self.now_us = target
+
+    def idle(self):  # machine.idle(): sleep until the next timer/IRQ, at most a 1 ms tick
+        due = self._queue[0][0] if self._queue else self.now_us + 1000
+        self.advance(max(min(due, self.now_us + 1000) - self.now_us, 1))
+
+    def cpu(self, ns):  # rough cost of work done in C on the device, e.g. drawing
+        if self.core1.current():  # core 1 time isn't modelled, it runs alongside
+            return
+        self._cpu_ns += ns
+        if self._cpu_ns >= 1000:
+            us = self._cpu_ns // 1000
+            self._cpu_ns -= us * 1000
+            self.advance(us)
+
+    def poll(self):  # hot path of every busy loop, skip advance() when nothing is due
+        if self.core1.current():
+            return
+        target = self.now_us + self.poll_us
+        if (self._queue and self._queue[0][0] <= target) or (
+            self.limit_us is not None and target > self.limit_us
+        ):
+            self.advance(self.poll_us)
+        else:
+            self.now_us = target
+
+    def _check_limit(self, us):
+        if self.limit_us is not None and us > self.limit_us:
+            self.now_us = self.limit_us
+            raise SimulationEnd("time limit")
+
+
+class Core1:
+    # The RP2040's second core as a host thread run in lockstep with the
+    # virtual clock. Only one core runs Python at a time: core 1 runs until
+    # it sleeps, then its wake-up is an ordinary clock event, so both cores
+    # see the same time and the run stays deterministic. Work done on core 1
+    # takes no virtual time.
+    def __init__(self, clock):
+        self.clock = clock
+        self.ident = None  # thread running core 1, None when it's stopped
+        self.turn = threading.Condition()
+        self.running = False  # core 1 has the turn
+        self.error = None  # exception core 1 ended with, raised on core 0
+
+    def current(self):
+        return self.ident is not None and threading.get_ident() == self.ident
+
+    def start(self, func, args=(), kwargs=None):  # _thread.start_new_thread
+        if self.ident is not None:
+            raise OSError("core 1 in use")
+
+        def body():
+            with self.turn:
+                while not self.running:
+                    self.turn.wait()
+            try:
+                func(*args, **(kwargs or {}))
+            except BaseException as error:  # e.g. SimulationEnd from the ADC
+                self.error = error
+            finally:
+                self.ident = None
+                with self.turn:
+                    self.running = False
+                    self.turn.notify_all()
+
+        thread = threading.Thread(target=body, daemon=True)
+        thread.start()
+        self.ident = thread.ident
+        self.resume()
+
+    def resume(self):  # core 0: let core 1 run until it sleeps or returns
+        with self.turn:
+            self.running = True
+            self.turn.notify_all()
+            while self.running:
+                self.turn.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait_until(self, due_us):  # core 1: sleep, core 0 runs meanwhile
+        self.clock.schedule(due_us, self.resume)
+        with self.turn:
+            self.running = False
+            self.turn.notify_all()
+            while not self.running:
+                self.turn.wait()
+
+
+class Capture:  # raw ADC values replayed at a fixed sample rate
+    def __init__(self, values, rate_hz=250, loop=False):
+        self.values = values
+        self.period_us = 1000000 // rate_hz
+        self.loop = loop
+
+    @classmethod
+    def from_file(cls, path, rate_hz=250, loop=False):
+        with open(path) as file:
+            values = [int(line) for line in file if line.strip()]
+        return cls(values, rate_hz, loop)
+
+    def value_at(self, now_us):
+        idx = now_us // self.period_us
+        if idx >= len(self.values):
+            if not self.loop:
+                raise SimulationEnd("capture ended")
+            idx %= len(self.values)
+        return self.values[idx]
+
+
+def adc_value(pin, now_us):  # 16 bit reading, like ADC.read_u16
+    stats["adc_reads"] += 1
+    source = adc_sources.get(pin, adc_sources.get("default"))
+    if source is None:
+        return 0
+    return source.value_at(now_us)
+
+
+clock = Clock()
+adc_sources = {}  # ADC pin/channel -> Capture, "default" is used for the rest
+pins = {}  # pin id -> machine.Pin, so scripts can inject IRQs
+displays = []  # every SSD1306_I2C created, newest last
+registers = {}  # machine.mem32 writes, address -> value
+dma_channels = []  # rp2.DMA objects, index is the channel number
+free_running = {"on": False, "next_us": 0, "period_us": 0, "pin": 26}  # ADC START_MANY
+stats = {"adc_reads": 0, "frames": 0, "i2c_bytes": 0}
+
+
+def reset():
+    global clock
+    clock = Clock()
+    adc_sources.clear()
+    pins.clear()
+    displays.clear()
+    registers.clear()
+    dma_channels.clear()
+    free_running["on"] = False
+    for key in stats:
+        stats[key] = 0
+
+
+# MicroPython's time extras, installed into CPython's time module
+def ticks_us():
+    return clock.now_us
+
+
+def ticks_ms():
+    return clock.now_us // 1000
+
+
+def ticks_diff(new, old):
+    return new - old
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def sleep(seconds):
+    clock.advance(seconds * 1000000)
+
+
+def sleep_ms(ms):
+    clock.advance(ms * 1000)
+
+
+def sleep_us(us):
+    clock.advance(us)
+
+
+def start_new_thread(func, args, kwargs=None):
+    clock.core1.start(func, args, kwargs)
+
+
+def install_thread():  # _thread.start_new_thread starts the simulated core 1
+    _thread.start_new_thread = start_new_thread
+
+
+# gc.mem_alloc/mem_free for the profiler. CPython frees by reference
+# counting, so this is live traced memory, and 0 unless tracemalloc runs.
+def mem_alloc():
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+def mem_free():
+    return 0
+
+
+def install_gc():
+    gc.mem_alloc = mem_alloc
+    gc.mem_free = mem_free
+
+
+def install_time():
+    _time.ticks_us = ticks_us
+    _time.ticks_ms = ticks_ms
+    _time.ticks_diff = ticks_diff
+    _time.ticks_add = ticks_add
+    _time.sleep = sleep
+    _time.sleep_ms = sleep_ms
+    _time.sleep_us = sleep_us
@@ -0,0 +1,96 @@
+# Host stand-in for the SSD1306 driver. Keeps the micropython-lib driver's
+# structure (show -> write_cmd/write_data over I2C) and models the panel's
+# own RAM, so what ends up on the "screen" can be checked after a run.
+import framebuf
+import sim
+
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+
+class SSD1306(framebuf.FrameBuffer):
+    def __init__(self, width, height, external_vcc):
+        self.width = width
+        self.height = height
+        self.external_vcc = external_vcc
+        self.pages = self.height // 8
+        self.buffer = bytearray(self.pages * self.width)
+        super().__init__(self.buffer, self.width, self.height, framebuf.MONO_VLSB)
+        self.ram = bytearray(len(self.buffer))  # what the panel is showing
+        self._cmd_args = []
+        self._col = [0, width - 1, 0]  # start, end, cursor
+        self._page = [0, self.pages - 1, 0]
+        sim.displays.append(self)
+
+    def poweroff(self):
+        pass
+
+    def poweron(self):
+        pass
+
+    def contrast(self, contrast):
+        pass
+
+    def invert(self, invert):
+        pass
+
+    def rotate(self, rotate):
+        pass
+
+    def show(self):
+        x0 = 0
+        x1 = self.width - 1
+        self.write_cmd(SET_COL_ADDR)
+        self.write_cmd(x0)
+        self.write_cmd(x1)
+        self.write_cmd(SET_PAGE_ADDR)
+        self.write_cmd(0)
+        self.write_cmd(self.pages - 1)
+        self.write_data(self.buffer)
+        sim.stats["frames"] += 1
+
+    # panel side of the protocol, horizontal addressing mode
+    def _panel_cmd(self, cmd):
+        if self._cmd_args:
+            self._cmd_args.append(cmd)
+            if len(self._cmd_args) == 3:
+                target = self._col if self._cmd_args[0] == SET_COL_ADDR else self._page
+                target[0] = target[2] = self._cmd_args[1]
+                target[1] = self._cmd_args[2]
+                self._cmd_args = []
+        elif cmd in (SET_COL_ADDR, SET_PAGE_ADDR):
+            self._cmd_args = [cmd]
+
+    def _panel_data(self, buf):
+        pos = 0
+        while pos < len(buf):  # copy one page row of the address window at a time
+            page, col = self._page[2], self._col[2]
+            n = min(self._col[1] - col + 1, len(buf) - pos)
+            start = page * self.width + col
+            self.ram[start : start + n] = buf[pos : pos + n]
+            pos += n
+            if col + n <= self._col[1]:
+                self._col[2] = col + n
+            else:
+                self._col[2] = self._col[0]
+                self._page[2] = page + 1 if page < self._page[1] else self._page[0]
+
+
+class SSD1306_I2C(SSD1306):
+    def __init__(self, width, height, i2c, addr=0x3C, external_vcc=False):
+        self.i2c = i2c
+        self.addr = addr
+        self.temp = bytearray(2)
+        self.write_list = [b"\x40", None]  # Co=0, D/C#=1
+        super().__init__(width, height, external_vcc)
+
+    def write_cmd(self, cmd):
+        self.temp[0] = 0x80  # Co=1, D/C#=0
+        self.temp[1] = cmd
+        self.i2c.writeto(self.addr, self.temp)
+        self._panel_cmd(cmd)
+
+    def write_data(self, buf):
+        self.write_list[1] = buf
+        self.i2c.writevto(self.addr, self.write_list)
+        self._panel_data(buf)
@@ -0,0 +1,163 @@
+# Local stand-in for the Kubios Cloud token and analysis endpoints, so
+# cloudconnection can be exercised without network access or an API key.
+# Point the device (or the simulator) at it with a kubios.json like
+#   {"token_url": "http://HOST:PORT/oauth2/token",
+#    "analysis_url": "http://HOST:PORT/v2/analytics/analyze"}
+#
+# usage: python tools/kubios_mock.py [--host HOST] [--port PORT] [--expires-in S] [--fail N]
+#
+# --fail answers the first N analysis requests with 503, for testing retries.
+
+import argparse
+import base64
+import json
+import math
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def readiness(rris):  # the subset of a readiness analysis the firmware reads
+    mean_rr = sum(rris) / len(rris)
+    diffs = [b - a for a, b in zip(rris, rris[1:])]
+    rmssd = math.sqrt(sum(d * d for d in diffs) / len(diffs)) if diffs else 0.0
+    sdnn = math.sqrt(sum((r - mean_rr) ** 2 for r in rris) / max(len(rris) - 1, 1))
+    return {
+        "create_timestamp": datetime.now(timezone.utc).isoformat(),
+        "mean_hr_bpm": 60000 / mean_rr,
+        "mean_rr_ms": mean_rr,
+        "rmssd_ms": rmssd,
+        "sdnn_ms": sdnn,
+        "sns_index": (900 - mean_rr) / 200,  # rough, not Kubios' model
+        "pns_index": (rmssd - 40) / 20,
+        "artefact_level": "GOOD",
+        # nested like the real response, with names the firmware must not pick up
+        "freq_domain": {"mean_hr_bpm": None, "lf_power": 1234.5, "hf_power": 567.8},
+        "rri_data": list(rris),
+    }
+
+
+class KubiosMock(ThreadingHTTPServer):
+    def __init__(self, address, expires_in=3600, fail=0, client_id=None, client_secret=None):
+        super().__init__(address, Handler)
+        self.expires_in = expires_in
+        self.fail = fail  # analysis requests still to fail
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tokens = {}  # access token -> expiry (time.time())
+        self.counts = {"token": 0, "analyze": 0, "unauthorized": 0, "failed": 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def config(self):  # kubios.json contents for this server
+        return {
+            "token_url": self.url + "/oauth2/token",
+            "analysis_url": self.url + "/v2/analytics/analyze",
+        }
+
+    def revoke(self):
+        self.tokens.clear()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        if self.path.endswith("/oauth2/token"):
+            self.token()
+        elif self.path.endswith("/analytics/analyze"):
+            self.analyze()
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def token(self):
+        server = self.server
+        form = parse_qs(self.body().decode())
+        if form.get("grant_type") != ["client_credentials"]:
+            return self.reply(400, {"error": "unsupported_grant_type"})
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Basic "):
+            return self.reply(401, {"error": "invalid_client"})
+        client_id, _, secret = base64.b64decode(auth[6:]).decode().partition(":")
+        if server.client_id is not None and (client_id, secret) != (
+            server.client_id,
+            server.client_secret,
+        ):
+            return self.reply(401, {"error": "invalid_client"})
+        server.counts["token"] += 1
+        access_token = secrets.token_urlsafe(24)
+        server.tokens[access_token] = time.time() + server.expires_in
+        self.reply(
+            200,
+            {"access_token": access_token, "expires_in": server.expires_in, "token_type": "Bearer"},
+        )
+
+    def analyze(self):
+        server = self.server
+        auth = self.headers.get("Authorization", "")
+        expiry = server.tokens.get(auth[7:]) if auth.startswith("Bearer ") else None
+        if expiry is None or time.time() >= expiry:
+            server.counts["unauthorized"] += 1
+            return self.reply(401, {"message": "Unauthorized"})
+        if not self.headers.get("X-Api-Key"):
+            return self.reply(403, {"message": "Forbidden"})
+        dataset = json.loads(self.body())
+        if server.fail:
+            server.fail -= 1
+            server.counts["failed"] += 1
+            return self.reply(503, {"message": "Service Unavailable"})
+        rris = dataset.get("data") or []
+        if dataset.get("type") != "RRI" or len(rris) < 2:
+            return self.reply(400, {"status": "error", "error": "invalid dataset"})
+        server.counts["analyze"] += 1
+        self.reply(200, {"status": "ok", "analysis": readiness(rris)})
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve(host="127.0.0.1", port=0, expires_in=3600, fail=0, quiet=True):
+    # Starts a server on a background thread, port 0 picks a free one
+    server = KubiosMock((host, port), expires_in, fail)
+    server.quiet = quiet
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Kubios Cloud stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--expires-in", type=int, default=3600, help="token lifetime in seconds")
+    parser.add_argument("--fail", type=int, default=0, help="analysis requests to fail first")
+    args = parser.parse_args()
+
+    server = KubiosMock((args.host, args.port), args.expires_in, args.fail)
+    server.quiet = False
+    print("Kubios mock on", server.url)
+    print("kubios.json:", json.dumps(server.config()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("requests:", server.counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# Runs the firmware under CPython on top of the host HAL in tools/hal.
+# Time is virtual, so a run goes as fast as the host can execute it.
+#
+# usage: python tools/simulate.py [menu|record|bpm|upload] [--capture FILE] [--rate HZ]
+#            [--until SECONDS] [--events SPEC] [--profile] [--root DIR] [--duration S]
+#            [--dual-core] [--block-capture] [--kubios URL | --kubios-mock] [--uploads N]
+#            [--mock-fail N] [--wlan-delay MS] [--stages]
+#
+# --events is a comma separated list of TIME_MS:ACTION[xCOUNT], where ACTION is
+# press (encoder knob), back (menu button at pin 9), cw or ccw (one encoder step).
+# Example, open HRV from the menu after the intro: 3000:cwx4,3500:press
+#
+# upload records 50 beats, queues it --uploads times in the outbox and runs
+# the background sync until everything is sent. --kubios-mock runs
+# tools/kubios_mock.py in-process (--mock-fail N fails its first N analysis
+# requests), --kubios points the device at an already running server.
+# --wlan-delay sets how long the simulated access point takes to associate.
+#
+# --stages turns the firmware's own profiler (project/profiler.py) on for the
+# run and prints its table at the end, timed with the host clock and with
+# heap use from tracemalloc.
+
+import argparse
+import builtins
+import json
+import cProfile
+import os
+import pstats
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+HAL_DIR = os.path.join(TOOLS_DIR, "hal")
+PROJECT_DIR = os.path.join(TOOLS_DIR, "..", "project")
+
+for path in (TOOLS_DIR, PROJECT_DIR, HAL_DIR):  # HAL ends up first
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import sim  # noqa: E402
+from synth_ppg import ppg  # noqa: E402
+
+
+def install(capture=None, rate_hz=250, root=None, loop=False):
+    # Set up the virtual clock, ADC source and device filesystem root
+    sim.reset()
+    sim.install_time()
+    sim.install_gc()
+    sim.install_thread()
+    if capture is None:
+        values = ppg(600, rate_hz)
+    elif isinstance(capture, str):
+        values = sim.Capture.from_file(capture, rate_hz).values
+    else:
+        values = list(capture)
+    sim.adc_sources["default"] = sim.Capture(values, rate_hz, loop)
+    if root is not None:
+        install_fs(root)
+
+
+def install_fs(root):  # the device's "/" maps to root
+    root = os.path.abspath(root)
+    host_open = getattr(builtins.open, "host_open", builtins.open)
+
+    def device_open(file, *args, **kwargs):
+        if isinstance(file, str) and file.startswith("/"):
+            top = file.split("/")[1]
+            if os.path.exists(os.path.join(root, top)):
+                file = os.path.join(root, file[1:])
+        return host_open(file, *args, **kwargs)
+
+    device_open.host_open = host_open
+    builtins.open = device_open
+    os.chdir(root)
+
+
+def device_root():  # scratch copy of the project so runs don't write into the repo
+    root = tempfile.mkdtemp(prefix="hrm-sim-")
+    for name in os.listdir(PROJECT_DIR):
+        src = os.path.join(PROJECT_DIR, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(root, name))
+        elif not name.endswith(".py"):
+            shutil.copy(src, root)
+    return root
+
+
+def press(pin_id):
+    pin = sim.pins[pin_id]
+    pin.inject(0)
+    sim.clock.schedule(sim.clock.now_us + 50000, lambda: pin.inject(1))
+
+
+def rotate(step):  # encoder A on pin 10, B on pin 11, B low means clockwise
+    sim.pins[11].value(0 if step > 0 else 1)
+    sim.pins[10].inject(0)
+    sim.pins[10].inject(1)  # handler fires on the rising edge
+
+
+ACTIONS = {
+    "press": lambda: press(12),
+    "back": lambda: press(9),
+    "cw": lambda: rotate(1),
+    "ccw": lambda: rotate(-1),
+}
+
+
+def schedule_events(spec):
+    for item in filter(None, spec.split(",")):
+        when, action = item.split(":")
+        action, _, count = action.partition("x")
+        for n in range(int(count or 1)):
+            due = int(when) * 1000 + n * 20000
+            sim.clock.schedule(due, ACTIONS[action.strip()])
+
+
+class Encoder:  # stand-in for menu.Encoder when a mode is run without the menu
+    def __init__(self):
+        from fifo import Fifo
+
+        self.fifo = Fifo(100, typecode="i")
+        self.knob_fifo = Fifo(30, typecode="i")
+
+
+class Screen:  # stand-in for menu.Screen when a mode is run without the menu
+    def __init__(self):
+        from display import get_display
+
+        self.display = get_display()
+
+    def show_progress(self, percentage, *args):
+        self.display.fill(0)
+        self.display.text(str(percentage) + "%", 56, 56, 1)
+        self.display.show()
+
+
+def run_menu():
+    runpy.run_path(os.path.join(PROJECT_DIR, "menu.py"), run_name="__main__")
+
+
+def run_record(duration_s=None, dual_core=False, block_capture=False):
+    from data_processor import record_heart_rate
+
+    recording = record_heart_rate(Encoder(), Screen(), duration_s, dual_core, block_capture)
+    if recording:
+        rris, hrv = recording
+        print(f"{len(rris)} RRIs:", list(rris) if len(rris) <= 100 else "(long recording)")
+        if not hrv.enough_data():
+            print("not enough RRIs to analyze")
+            return
+        hrv.analyze()
+        print(f"SDNN {hrv.sdnn:.2f} ms, RMSSD {hrv.rmssd:.2f} ms, mean HR {hrv.mean_hr:.1f}")
+
+
+def use_kubios(url, root):  # kubios.json on the device pointing at url
+    config = {
+        "token_url": url + "/oauth2/token",
+        "analysis_url": url + "/v2/analytics/analyze",
+    }
+    with open(os.path.join(root, "kubios.json"), "w") as file:
+        json.dump(config, file)
+
+
+def run_upload(uploads=2):
+    from cloudconnection import KubiosSync, SYNC_POLL_MS
+    from data_processor import record_heart_rate
+    from outbox import Outbox
+    from scheduler import Scheduler
+
+    recording = record_heart_rate(Encoder(), Screen())
+    if not recording:
+        return
+    rris, _ = recording
+    outbox = Outbox()
+    for _ in range(uploads):
+        outbox.append(rris)
+    start = sim.clock.now_us
+    loop = Scheduler()
+
+    sent = 0
+
+    def on_result(results):  # called before the recording leaves the outbox
+        nonlocal sent
+        print(f"{(sim.clock.now_us - start) / 1000:.0f} ms: {results}")
+        sent += 1
+        if sent == uploads:
+            loop.stop()
+
+    loop.every(SYNC_POLL_MS, KubiosSync(outbox, on_result).poll)
+    loop.run()
+
+
+def run_bpm():
+    from measureHR import display_bpm
+
+    display_bpm(Encoder(), Screen())
+
+
+MODES = {"menu": run_menu, "record": run_record, "bpm": run_bpm, "upload": run_upload}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the firmware on the host HAL")
+    parser.add_argument("mode", nargs="?", default="menu", choices=MODES)
+    parser.add_argument("--capture", help="raw ADC values, one per line (default: synthetic)")
+    parser.add_argument("--rate", type=int, default=250, help="capture sample rate in Hz")
+    parser.add_argument("--until", type=float, help="stop after this many virtual seconds")
+    parser.add_argument("--events", default="", help="scripted input, see above")
+    parser.add_argument("--profile", action="store_true", help="print a cProfile report")
+    parser.add_argument("--root", help="device filesystem root (default: scratch copy)")
+    parser.add_argument("--duration", type=int, help="record mode: recording length in seconds")
+    parser.add_argument("--dual-core", action="store_true", help="record mode: sample on core 1")
+    parser.add_argument(
+        "--block-capture", action="store_true", help="record mode: 1 kHz ADC blocks by DMA"
+    )
+    parser.add_argument("--kubios", metavar="URL", help="Kubios server the device talks to")
+    parser.add_argument(
+        "--kubios-mock", action="store_true", help="start tools/kubios_mock.py and use it"
+    )
+    parser.add_argument("--uploads", type=int, default=2, help="upload mode: recordings to queue")
+    parser.add_argument("--mock-fail", type=int, default=0, help="mock fails this many analyses")
+    parser.add_argument("--wlan-delay", type=int, help="Wi-Fi association time in ms")
+    parser.add_argument("--stages", action="store_true", help="print the firmware profiler table")
+    args = parser.parse_args()
+
+    if args.wlan_delay is not None:
+        import network
+
+        network.connect_delay_ms = args.wlan_delay
+    root = args.root or device_root()
+    mock = None
+    if args.kubios_mock:
+        import kubios_mock
+
+        mock = kubios_mock.serve(fail=args.mock_fail)
+        args.kubios = mock.url
+    if args.kubios:
+        use_kubios(args.kubios, root)
+    install(args.capture, args.rate, root)
+    if args.until is not None:
+        sim.clock.limit_us = int(args.until * 1000000)
+    schedule_events(args.events)
+
+    if args.stages:
+        import profiler as stages
+        import tracemalloc
+
+        stages.timer = lambda: time.perf_counter_ns() // 1000
+        tracemalloc.start()
+        stages.enable()
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    try:
+        mode = MODES[args.mode]
+        if args.mode == "record":
+            mode = lambda: run_record(  # noqa: E731
+                args.duration, args.dual_core, args.block_capture
+            )
+        elif args.mode == "upload":
+            mode = lambda: run_upload(args.uploads)  # noqa: E731
+        if profiler:
+            profiler.runcall(mode)
+        else:
+            mode()
+        reason = "finished"
+    except sim.SimulationEnd as end:
+        reason = str(end)
+    wall = time.perf_counter() - start
+    virtual = sim.clock.now_us / 1000000
+    print(
+        f"{reason}: {virtual:.2f} s virtual in {wall:.2f} s wall "
+        f"({virtual / wall if wall else 0:.1f}x real time)"
+    )
+    print(
+        f"frames {sim.stats['frames']}, i2c bytes {sim.stats['i2c_bytes']}, "
+        f"adc reads {sim.stats['adc_reads']}"
+    )
+    if mock:
+        print("kubios mock requests:", mock.counts)
+    if args.stages:
+        stages.dump()
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    main()
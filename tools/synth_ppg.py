@@ -0,0 +1,43 @@
+# Synthetic PPG generator for when no real capture is at hand. Produces raw
+# 16-bit ADC values with beat-to-beat variation, respiration drift, noise and
+# the odd missed beat, roughly what the Crowtail pulse sensor gives.
+#
+# usage: python tools/synth_ppg.py seconds [rate_hz] [seed] > capture.txt
+
+import math
+import random
+import sys
+
+
+def ppg(seconds, rate_hz=250, seed=1, mean_rri_ms=800):
+    rng = random.Random(seed)
+    beats = [0.0]
+    while beats[-1] < seconds + 2:
+        rri = mean_rri_ms / 1000 + rng.gauss(0, 0.04)
+        if rng.random() < 0.01:  # missed beat
+            rri += mean_rri_ms / 2000
+        beats.append(beats[-1] + rri)
+    values = []
+    beat = 0
+    for n in range(int(seconds * rate_hz)):
+        t = n / rate_hz
+        while beats[beat + 1] <= t:
+            beat += 1
+        phase = t - beats[beat]
+        value = (
+            30000
+            + 12000 * math.exp(-(((phase - 0.15) / 0.07) ** 2))  # systolic peak
+            + 4000 * math.exp(-(((phase - 0.4) / 0.1) ** 2))  # dicrotic wave
+            + 2000 * math.sin(2 * math.pi * 0.25 * t)  # breathing
+            + rng.gauss(0, 300)
+        )
+        values.append(max(0, min(0xFFFF, int(value))))
+    return values
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    for value in ppg(seconds, rate, seed):
+        print(value)